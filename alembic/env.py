@@ -5,7 +5,7 @@ from logging.config import fileConfig
 from sqlalchemy import engine_from_config, pool
 
 from alembic import context
-from ghstats.config import DB_CONNECTION_STRING
+from ghstats.config import db_connection_string
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -39,7 +39,7 @@ def run_migrations_offline():
 
     """
     context.configure(
-        url=DB_CONNECTION_STRING, target_metadata=target_metadata, literal_binds=True)
+        url=db_connection_string(), target_metadata=target_metadata, literal_binds=True)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -55,7 +55,7 @@ def run_migrations_online():
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix='sqlalchemy.',
-        url=DB_CONNECTION_STRING,
+        url=db_connection_string(),
         poolclass=pool.NullPool)
 
     with connectable.connect() as connection:
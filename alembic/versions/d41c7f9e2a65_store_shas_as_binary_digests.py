@@ -0,0 +1,32 @@
+"""Store commit shas as 20 byte binary digests instead of their hex encoding
+
+Revision ID: d41c7f9e2a65
+Revises: b3a8d15e6f20
+Create Date: 2026-10-17 14:22:19.513806
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd41c7f9e2a65'
+down_revision = 'b3a8d15e6f20'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    # the length of a bytea is not part of its type in postgres, so only the values change. Only rows still holding
+    # a 40 byte hex encoding are converted, so this is safe to re-run after a partial failure
+    op.execute("UPDATE commits SET sha = decode(convert_from(sha, 'UTF8'), 'hex') WHERE length(sha) = 40")
+    op.execute(
+        "UPDATE sync_state SET head_sha = decode(convert_from(head_sha, 'UTF8'), 'hex') WHERE length(head_sha) = 40")
+    # rebuild the unique index without the entries of the old row versions, at about half its previous size
+    op.execute('REINDEX INDEX uq_commits_sha')
+
+
+def downgrade():
+    op.execute("UPDATE commits SET sha = convert_to(encode(sha, 'hex'), 'UTF8') WHERE length(sha) = 20")
+    op.execute(
+        "UPDATE sync_state SET head_sha = convert_to(encode(head_sha, 'hex'), 'UTF8') WHERE length(head_sha) = 20")
+    op.execute('REINDEX INDEX uq_commits_sha')
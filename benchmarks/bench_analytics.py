@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the vectorized stats of ghstats.analytics against the equivalent SQL on the configured database
+"""
+
+import argparse
+import tempfile
+import time
+
+from sqlalchemy import text
+
+from ghstats.analytics import CommitStore
+from ghstats.session import SessionManager, get_session_maker
+
+# each stat as computed by the store, and the equivalent query
+STATS = (
+    ('churn per author', lambda store: store.churn('author'), '''
+        SELECT author_id, sum(additions + deletions) FROM commits WHERE author_id IS NOT NULL GROUP BY author_id
+    '''),
+    ('churn per repo', lambda store: store.churn('repo'), '''
+        SELECT repo_id, sum(additions + deletions) FROM commits GROUP BY repo_id
+    '''),
+    ('churn per path', lambda store: store.churn('path'), '''
+        SELECT path_id, sum(additions + deletions) FROM files GROUP BY path_id
+    '''),
+    ('top 10 authors', lambda store: store.top(store.commit_counts('author'), 10), '''
+        SELECT author_id, count(*) AS commits FROM commits WHERE author_id IS NOT NULL
+        GROUP BY author_id ORDER BY commits DESC LIMIT 10
+    '''),
+    ('hour of day', lambda store: store.hour_histogram(), '''
+        SELECT extract(hour FROM authored_at) AS hour, count(*) FROM commits WHERE authored_at IS NOT NULL
+        GROUP BY hour
+    '''),
+    ('day of week', lambda store: store.weekday_histogram(), '''
+        SELECT extract(isodow FROM authored_at) AS dow, count(*) FROM commits WHERE authored_at IS NOT NULL
+        GROUP BY dow
+    '''),
+    ('7 day rolling commits', lambda store: store.rolling(7), '''
+        SELECT day, sum(commits) OVER (ORDER BY day RANGE BETWEEN INTERVAL '6 days' PRECEDING AND CURRENT ROW)
+        FROM (SELECT CAST(authored_at AS DATE) AS day, count(*) AS commits FROM commits
+              WHERE authored_at IS NOT NULL GROUP BY day) AS daily
+    '''),
+)
+
+
+def best_of(repeat, fn):
+    """
+    :return: the fastest of repeat runs of fn, in seconds
+    :rtype: float
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs to take the fastest of')
+    return parser
+
+
+def main(args):
+    with SessionManager(get_session_maker()) as db_session, tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        store = CommitStore.load(db_session)
+        loaded = time.perf_counter() - start
+        store.save(cache_dir)
+        opened = best_of(args.repeat, lambda: CommitStore.from_cache(cache_dir))
+        store = CommitStore.from_cache(cache_dir)
+        print('{} commits, {} files: loaded from the database in {:.3f}s, memory-mapped in {:.6f}s'.format(
+            len(store), len(store.file_commit), loaded, opened))
+        print('{:<25}{:>12}{:>12}{:>10}'.format('stat', 'numpy (s)', 'sql (s)', 'speedup'))
+        for name, stat, query in STATS:
+            vectorized = best_of(args.repeat, lambda: stat(store))
+            sql = best_of(args.repeat, lambda: db_session.execute(text(query)).fetchall())
+            print('{:<25}{:>12.6f}{:>12.6f}{:>9.1f}x'.format(name, vectorized, sql, sql / vectorized))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
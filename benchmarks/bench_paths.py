@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the storage of file paths and the subtree queries served by the paths table on the configured database:
+the size of the files and paths tables against the size the repeated filename column would take, and the time of a
+subtree aggregate with the prefix index against a full scan
+"""
+
+import argparse
+import time
+
+from sqlalchemy import text
+
+from ghstats.session import SessionManager, get_session_maker
+from ghstats.stats import subtree_churn
+
+SIZES_QUERY = text('''
+SELECT pg_total_relation_size('files'), pg_total_relation_size('paths'),
+       (SELECT coalesce(sum(pg_column_size(paths.path)), 0) FROM files JOIN paths ON paths.id = files.path_id),
+       (SELECT count(*) FROM files), (SELECT count(*) FROM paths)
+''')
+# the directories with the most files changed, to query
+PREFIXES_QUERY = text('''
+SELECT substring(path FROM '^(.*/)') AS directory FROM paths JOIN files ON files.path_id = paths.id
+WHERE path LIKE '%/%' GROUP BY directory ORDER BY count(*) DESC LIMIT :limit
+''')
+
+
+def megabytes(size):
+    return size / 1024 / 1024
+
+
+def best_of(repeat, fn):
+    """
+    :return: the fastest of repeat runs of fn, in seconds
+    :rtype: float
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def scanned(db_session, prefix):
+    """
+    run subtree_churn with index scans disabled, as a query of the repeated filename column would run
+    """
+    db_session.execute('SET LOCAL enable_indexscan = off')
+    db_session.execute('SET LOCAL enable_bitmapscan = off')
+    try:
+        return subtree_churn(db_session, prefix)
+    finally:
+        db_session.rollback()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs to take the fastest of')
+    parser.add_argument('--prefixes', type=int, default=5, help='number of directories to query')
+    return parser
+
+
+def main(args):
+    with SessionManager(get_session_maker()) as db_session:
+        files_size, paths_size, filenames_size, files, paths = db_session.execute(SIZES_QUERY).fetchone()
+        print('{} files, {} distinct paths'.format(files, paths))
+        print('files table (with indexes): {:.1f}MB, paths table (with indexes): {:.1f}MB'.format(
+            megabytes(files_size), megabytes(paths_size)))
+        print('a filename column would hold {:.1f}MB of text in place of {:.1f}MB of path ids'.format(
+            megabytes(filenames_size), megabytes(files * 4)))
+        prefixes = [prefix for prefix, in db_session.execute(PREFIXES_QUERY, {'limit': args.prefixes})]
+        db_session.rollback()
+        print('{:<50}{:>12}{:>12}{:>10}'.format('prefix', 'index (s)', 'scan (s)', 'speedup'))
+        for prefix in prefixes:
+            indexed = best_of(args.repeat, lambda: subtree_churn(db_session, prefix))
+            scan = best_of(args.repeat, lambda: scanned(db_session, prefix))
+            print('{:<50}{:>12.6f}{:>12.6f}{:>9.1f}x'.format(prefix[-50:], indexed, scan, scan / indexed))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
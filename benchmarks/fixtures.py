@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Generate a synthetic set of github api responses for the benchmarks, or record real ones
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from benchmarks.stub import BASE_URL_TOKEN, fixture_name
+
+ORG = 'bench-org'
+REPO = 'bench-repo'
+REPO_PATH = '/repos/{}/{}'.format(ORG, REPO)
+# response headers worth keeping from a recording
+RECORDED_HEADERS = ('link', 'etag', 'last-modified', 'x-ratelimit-limit', 'x-ratelimit-remaining', 'x-ratelimit-reset')
+
+
+def list_commits_path(page_size, page=1):
+    """
+    :return: the path of a page of the commit listing of the generated repo
+    :rtype: str
+    """
+    path = '{}/commits?per_page={}'.format(REPO_PATH, page_size)
+    return path if page == 1 else '{}&page={}'.format(path, page)
+
+
+def write_fixture(directory, path, body, status=200, headers=None):
+    """
+    record the response to a request
+
+    :param directory: the directory of recorded responses
+    :type directory: str
+    :param path: the path and query string of the request
+    :type path: str
+    :param body: the decoded json body of the response
+    :param status: the status code of the response
+    :type status: int
+    :param headers: the headers of the response
+    :type headers: Union[Dict[str, str], None]
+    """
+    headers = dict(headers or {})
+    headers.setdefault('x-ratelimit-remaining', '4999')
+    headers.setdefault('x-ratelimit-reset', '9999999999')
+    with open(os.path.join(directory, fixture_name(path)), 'w') as f:
+        json.dump({'status': status, 'headers': headers, 'body': body}, f)
+
+
+def _sha(i):
+    return hashlib.sha1('bench commit {}'.format(i).encode()).hexdigest()
+
+
+def _user(i):
+    return {'login': 'bench-user-{}'.format(i), 'id': 1000000 + i, 'type': 'User'}
+
+
+def _patch(commit, file, lines):
+    hunk = '@@ -1,{0} +1,{0} @@\n'.format(lines)
+    return hunk + '\n'.join('+    value_{}_{}_{} = compute(value_{})'.format(commit, file, line, line)
+                             for line in range(lines))
+
+
+def generate(directory, commits=2000, users=50, files_per_commit=5, patch_lines=40, page_size=100):
+    """
+    write the responses for a repo with a linear history of `commits` commits by `users` users: the pages of the
+    commit listing, the details of each commit and each user's profile
+
+    :param directory: the directory to write the responses to
+    :type directory: str
+    :param commits: the number of commits in the repo
+    :type commits: int
+    :param users: the number of users authoring the commits
+    :type users: int
+    :param files_per_commit: the number of files each commit changes
+    :type files_per_commit: int
+    :param patch_lines: the number of lines of the patch of each file
+    :type patch_lines: int
+    :param page_size: the number of commits per page of the listing
+    :type page_size: int
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = datetime(2020, 1, 1)
+    details = []
+    for i in range(commits):
+        date = (start - timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        author = _user(i % users)
+        files = [
+            {'filename': 'src/module{}/file{}.py'.format(i % 20, j), 'status': 'modified', 'additions': j + 1,
+             'deletions': j, 'patch': _patch(i, j, patch_lines)}
+            for j in range(files_per_commit)
+        ]
+        details.append({
+            'sha': _sha(i),
+            'parents': [{'sha': _sha(i + 1)}] if i + 1 < commits else [],
+            'commit': {
+                'message': 'change {}'.format(i),
+                'author': {'email': '{}@example.com'.format(author['login']), 'date': date},
+                'committer': {'email': '{}@example.com'.format(author['login']), 'date': date},
+            },
+            'author': author,
+            'committer': author,
+            'stats': {
+                'additions': sum(file['additions'] for file in files),
+                'deletions': sum(file['deletions'] for file in files),
+            },
+            'files': files,
+        })
+    pages = (commits + page_size - 1) // page_size
+    for page in range(1, pages + 1):
+        listed = [
+            {key: value for key, value in detail.items() if key not in ('stats', 'files')}
+            for detail in details[(page - 1) * page_size:page * page_size]
+        ]
+        headers = {}
+        if page < pages:
+            headers['link'] = '<{}{}>; rel="next"'.format(BASE_URL_TOKEN, list_commits_path(page_size, page + 1))
+        write_fixture(directory, list_commits_path(page_size, page), listed, headers=headers)
+    for detail in details:
+        write_fixture(directory, '{}/commits/{}'.format(REPO_PATH, detail['sha']), detail)
+    for i in range(users):
+        user = _user(i)
+        write_fixture(directory, '/users/{}'.format(user['login']),
+                      dict(user, email='{}@example.com'.format(user['login'])))
+
+
+def record(gh_session, paths, directory, base_url):
+    """
+    record the responses of the github api to the given requests, following pagination
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param paths: the paths and query strings to request
+    :type paths: Iterable[str]
+    :param directory: the directory to write the responses to
+    :type directory: str
+    :param base_url: the base url of the github api
+    :type base_url: str
+    """
+    os.makedirs(directory, exist_ok=True)
+    for path in paths:
+        while path is not None:
+            response = gh_session.get(base_url + path)
+            headers = {
+                key: response.headers[key].replace(base_url, BASE_URL_TOKEN)
+                for key in RECORDED_HEADERS if key in response.headers
+            }
+            body = json.loads(response.text.replace(base_url, BASE_URL_TOKEN))
+            write_fixture(directory, path, body, status=response.status_code, headers=headers)
+            next_page = response.links.get('next', {}).get('url')
+            path = next_page[len(base_url):] if next_page else None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', help='directory to write the responses to')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    generate_parser = subparsers.add_parser('generate', help='generate the responses for a synthetic repo')
+    generate_parser.add_argument('--commits', type=int, default=2000)
+    generate_parser.add_argument('--users', type=int, default=50)
+    generate_parser.add_argument('--files-per-commit', type=int, default=5)
+    record_parser = subparsers.add_parser('record', help='record the responses of the github api')
+    record_parser.add_argument('paths', nargs='+', help='api paths to request, eg /repos/org/repo/commits')
+    return parser
+
+
+def main(args):
+    if args.command == 'generate':
+        generate(args.directory, commits=args.commits, users=args.users, files_per_commit=args.files_per_commit)
+    else:
+        from ghstats.config import BASE_GH_URL
+        from ghstats.session import get_gh_session
+        record(get_gh_session(cache_path=None), args.paths, args.directory, BASE_GH_URL)
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -0,0 +1,125 @@
+"""
+A local stand-in for the github api that serves recorded responses, so benchmarks measure the client and not the
+network or github. POST requests (eg to the graphql endpoint) are answered by handlers, as their responses depend on
+the body of the request.
+"""
+
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+# stands for the base url of the api in recorded responses (eg in the Link header), replaced by the stub's own url
+BASE_URL_TOKEN = '{base_url}'
+
+
+def fixture_name(path):
+    """
+    :param path: the path and query string of a request, eg /repos/org/repo/commits?per_page=100
+    :type path: str
+    :return: the name of the file the response to the request is recorded in
+    :rtype: str
+    """
+    return quote(path.lstrip('/'), safe='') + '.json'
+
+
+def fixture_path(name):
+    """
+    :return: the request path and query string a fixture file is the response to
+    :rtype: str
+    """
+    return '/' + unquote(name[:-len('.json')])
+
+
+def load_fixtures(directory, base_url):
+    """
+    :param directory: the directory of recorded responses
+    :type directory: str
+    :param base_url: the url the stub is served on
+    :type base_url: str
+    :return: the status, headers and encoded body of each recorded response, keyed by request path and query string
+    :rtype: Dict[str, Tuple[int, Dict[str, str], bytes]]
+    """
+    responses = {}
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            recorded = json.load(f)
+        headers = {key: value.replace(BASE_URL_TOKEN, base_url) for key, value in recorded['headers'].items()}
+        body = json.dumps(recorded['body']).replace(BASE_URL_TOKEN, base_url).encode()
+        responses[fixture_path(name)] = (recorded['status'], headers, body)
+    return responses
+
+
+NOT_FOUND = (404, {}, b'{"message": "Not Found"}')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._respond(*self.server.responses.get(self.path, NOT_FOUND))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        handler = self.server.post_handlers.get(self.path)
+        if handler is None:
+            self._respond(*NOT_FOUND)
+            return
+        status, headers, response = handler(json.loads(body) if body else None)
+        self._respond(status, headers, json.dumps(response).encode())
+
+    def _respond(self, status, headers, body):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(object):
+    """
+    Serves the recorded responses in a directory on a free local port, in a background thread:
+
+        with StubServer('benchmarks/fixtures') as base_url:
+            get_all(gh_session, base_url + '/repos/org/repo/commits')
+
+    and answers POST requests with the handler of their path, which is called with the decoded json body of each
+    request and returns the status, headers and (json serialisable) body of the response:
+
+        with StubServer(post_handlers={'/graphql': lambda request: (200, {}, {'data': ...})}) as base_url:
+            query(gh_session, document, variables, url=base_url + '/graphql')
+    """
+
+    def __init__(self, directory=None, post_handlers=None):
+        """
+        :param directory: the directory of recorded responses, if any
+        :type directory: Union[str, None]
+        :param post_handlers: the handler of each path POST requests are answered on
+        :type post_handlers: Union[Dict[str, Callable[[Any], Tuple[int, Dict[str, str], Any]]], None]
+        """
+        self.directory = directory
+        self.post_handlers = dict(post_handlers or {})
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        base_url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        self._server.responses = load_fixtures(self.directory, base_url) if self.directory is not None else {}
+        self._server.post_handlers = self.post_handlers
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return base_url
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        return False
@@ -0,0 +1,332 @@
+"""
+An in-memory columnar copy of the commits and files tables for interactive analysis. Each column is a numpy array:
+users, repos and paths are integer codes into dictionaries, timestamps are datetime64 and line counts are int32, so
+stats over the whole history are a handful of vectorized operations rather than a scan of ORM objects or rows.
+
+The store is saved as one .npy file per column, which later sessions memory-map instead of loading from the database:
+
+    store = CommitStore.open(db_session)
+    authors, churn = store.top(store.churn('author'), 10)
+"""
+
+import json
+import logging
+import os
+from array import array
+
+from sqlalchemy import select, func
+
+from ghstats.config import ANALYTICS_CACHE_DIR, EXPORT_CHUNK_SIZE
+from ghstats.orm.orm import Commit, File, Path, Repo, Organisation, User
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DICTIONARIES_FILE = 'dictionaries.json'
+# the typecode of the array each column is built up in while loading, and its numpy dtype
+COMMIT_COLUMNS = {
+    'commit_repo': ('i', 'int32'),
+    'commit_author': ('i', 'int32'),
+    'authored_at': ('q', 'datetime64[s]'),
+    'commit_additions': ('i', 'int32'),
+    'commit_deletions': ('i', 'int32'),
+}
+FILE_COLUMNS = {
+    'file_commit': ('i', 'int32'),
+    'file_path': ('i', 'int32'),
+    'file_additions': ('i', 'int32'),
+    'file_deletions': ('i', 'int32'),
+}
+# code of an unknown author, and the stored value of a missing timestamp (numpy's NaT)
+UNKNOWN = -1
+NAT = -2 ** 63
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('analytics needs numpy, install it with `pip install ghstats[analytics]`')
+
+
+def _stream(db_session, q, chunk_size):
+    result = db_session.connection().execution_options(stream_results=True).execute(q)
+    for chunk in iter(lambda: result.fetchmany(chunk_size), []):
+        yield from chunk
+    result.close()
+
+
+class CommitStore(object):
+    """
+    The commits and files tables as numpy columns. Commit columns are indexed by commit number and file columns by
+    file number, with file_commit holding the commit number of each file.
+
+    :ivar users: the login of each user code
+    :ivar repos: the 'org/repo' name of each repo code
+    :ivar paths: the path of each path code
+    """
+
+    def __init__(self, columns, users, repos, paths):
+        """
+        :param columns: the arrays of each column in COMMIT_COLUMNS and FILE_COLUMNS
+        :type columns: Dict[str, numpy.ndarray]
+        :param users: the login of each user code
+        :type users: List[str]
+        :param repos: the name of each repo code
+        :type repos: List[str]
+        :param paths: the path of each path code
+        :type paths: List[str]
+        """
+        for name, values in columns.items():
+            setattr(self, name, values)
+        self.users = users
+        self.repos = repos
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.authored_at)
+
+    @classmethod
+    def load(cls, db_session, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        load the store from the database, streaming rows through a server side cursor
+
+        :param db_session: the database session
+        :type db_session: sqlalchemy.orm.session.Session
+        :param chunk_size: number of rows to fetch at once
+        :type chunk_size: int
+        :return: the loaded store
+        :rtype: CommitStore
+        """
+        _require_numpy()
+        users, user_codes = [], {}
+        for user_id, login in db_session.query(User.id, User.name):
+            user_codes[user_id] = len(users)
+            users.append(login)
+        repos, repo_codes = [], {}
+        for repo_id, org_name, repo_name in db_session.query(Repo.id, Organisation.name, Repo.name).join(Repo.org):
+            repo_codes[repo_id] = len(repos)
+            repos.append('{}/{}'.format(org_name, repo_name))
+
+        built = {name: array(typecode) for name, (typecode, _) in dict(COMMIT_COLUMNS, **FILE_COLUMNS).items()}
+        commit_numbers = {}
+        commits = select([
+            Commit.id, Commit.repo_id, Commit.author_id, func.extract('epoch', Commit.authored_at),
+            func.coalesce(Commit.additions, 0), func.coalesce(Commit.deletions, 0),
+        ])
+        for row in _stream(db_session, commits, chunk_size):
+            commit_id, repo_id, author_id, authored_at, additions, deletions = row
+            commit_numbers[commit_id] = len(commit_numbers)
+            built['commit_repo'].append(repo_codes.get(repo_id, UNKNOWN))
+            built['commit_author'].append(user_codes.get(author_id, UNKNOWN))
+            built['authored_at'].append(int(authored_at) if authored_at is not None else NAT)
+            built['commit_additions'].append(additions)
+            built['commit_deletions'].append(deletions)
+
+        paths, path_codes = [], {}
+        for path_id, path in db_session.query(Path.id, Path.path):
+            path_codes[path_id] = len(paths)
+            paths.append(path)
+        files = select([File.commit_id, File.path_id, File.additions, File.deletions])
+        for commit_id, path_id, additions, deletions in _stream(db_session, files, chunk_size):
+            if commit_id not in commit_numbers:
+                continue
+            built['file_commit'].append(commit_numbers[commit_id])
+            built['file_path'].append(path_codes[path_id])
+            built['file_additions'].append(additions)
+            built['file_deletions'].append(deletions)
+
+        columns = {
+            name: np.frombuffer(built[name], dtype='int64' if typecode == 'q' else 'int32').view(dtype)
+            for name, (typecode, dtype) in dict(COMMIT_COLUMNS, **FILE_COLUMNS).items()
+        }
+        logger.info('loaded {} commits and {} files'.format(len(commit_numbers), len(columns['file_commit'])))
+        return cls(columns, users, repos, paths)
+
+    def save(self, path):
+        """
+        save the store as a directory of .npy files, one per column, and the dictionaries as json
+
+        :param path: the directory to save to
+        :type path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in dict(COMMIT_COLUMNS, **FILE_COLUMNS):
+            np.save(os.path.join(path, '{}.npy'.format(name)), getattr(self, name))
+        with open(os.path.join(path, DICTIONARIES_FILE), 'w') as f:
+            json.dump({'users': self.users, 'repos': self.repos, 'paths': self.paths}, f)
+
+    @classmethod
+    def from_cache(cls, path, mmap_mode='r'):
+        """
+        open a saved store. The columns are memory-mapped, so this takes the same time whatever the size of the store
+
+        :param path: the directory the store was saved to
+        :type path: str
+        :param mmap_mode: how to map the columns (see numpy.load), or None to read them into memory
+        :type mmap_mode: Union[str, None]
+        :return: the store
+        :rtype: CommitStore
+        """
+        _require_numpy()
+        columns = {
+            name: np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+            for name in dict(COMMIT_COLUMNS, **FILE_COLUMNS)
+        }
+        with open(os.path.join(path, DICTIONARIES_FILE)) as f:
+            dictionaries = json.load(f)
+        return cls(columns, dictionaries['users'], dictionaries['repos'], dictionaries['paths'])
+
+    @classmethod
+    def open(cls, db_session, path=ANALYTICS_CACHE_DIR, refresh=False):
+        """
+        open the store saved at path, loading it from the database (and saving it) if there is none or refresh is set
+
+        :param db_session: the database session
+        :type db_session: sqlalchemy.orm.session.Session
+        :param path: the directory the store is saved to
+        :type path: str
+        :param refresh: whether to reload the store from the database
+        :type refresh: bool
+        :return: the store
+        :rtype: CommitStore
+        """
+        if not refresh and os.path.exists(os.path.join(path, DICTIONARIES_FILE)):
+            return cls.from_cache(path)
+        store = cls.load(db_session)
+        store.save(path)
+        return store
+
+    def commit_mask(self, since=None, until=None, repo=None, author=None):
+        """
+        :param since: only include commits authored at or after this time
+        :type since: Union[datetime.datetime, numpy.datetime64, None]
+        :param until: only include commits authored before this time
+        :type until: Union[datetime.datetime, numpy.datetime64, None]
+        :param repo: only include commits to the repo with this name ('org/repo')
+        :type repo: Union[str, None]
+        :param author: only include commits authored by the user with this login
+        :type author: Union[str, None]
+        :return: the boolean mask of the commits to include
+        :rtype: numpy.ndarray
+        """
+        mask = ~np.isnat(self.authored_at)
+        if since is not None:
+            mask &= self.authored_at >= np.datetime64(since, 's')
+        if until is not None:
+            mask &= self.authored_at < np.datetime64(until, 's')
+        if repo is not None:
+            mask &= self.commit_repo == self.repos.index(repo)
+        if author is not None:
+            mask &= self.commit_author == self.users.index(author)
+        return mask
+
+    def churn(self, by='author', mask=None):
+        """
+        the lines added plus the lines deleted per author, repo or path
+
+        :param by: one of 'author', 'repo' or 'path'
+        :type by: str
+        :param mask: the commits to include (see commit_mask), or None for all of them
+        :type mask: Union[numpy.ndarray, None]
+        :return: the churn of each code of the dictionary grouped by (users, repos or paths)
+        :rtype: numpy.ndarray
+        """
+        if by == 'path':
+            lines = self.file_additions.astype('int64') + self.file_deletions
+            keep = mask[self.file_commit] if mask is not None else slice(None)
+            return np.bincount(self.file_path[keep], weights=lines[keep], minlength=len(self.paths)).astype('int64')
+        codes, size = self._codes(by)
+        lines = self.commit_additions.astype('int64') + self.commit_deletions
+        keep = (codes != UNKNOWN) if mask is None else (codes != UNKNOWN) & mask
+        return np.bincount(codes[keep], weights=lines[keep], minlength=size).astype('int64')
+
+    def commit_counts(self, by='author', mask=None):
+        """
+        :param by: one of 'author' or 'repo'
+        :type by: str
+        :param mask: the commits to include (see commit_mask), or None for all of them
+        :type mask: Union[numpy.ndarray, None]
+        :return: the number of commits of each code of the dictionary grouped by (users or repos)
+        :rtype: numpy.ndarray
+        """
+        codes, size = self._codes(by)
+        keep = (codes != UNKNOWN) if mask is None else (codes != UNKNOWN) & mask
+        return np.bincount(codes[keep], minlength=size)
+
+    def _codes(self, by):
+        if by == 'author':
+            return self.commit_author, len(self.users)
+        if by == 'repo':
+            return self.commit_repo, len(self.repos)
+        raise ValueError('unknown grouping: {}'.format(by))
+
+    def hour_histogram(self, mask=None):
+        """
+        :param mask: the commits to include (see commit_mask), or None for all of them
+        :type mask: Union[numpy.ndarray, None]
+        :return: the number of commits authored in each hour of the day (utc)
+        :rtype: numpy.ndarray
+        """
+        authored_at = self.authored_at[self.commit_mask() if mask is None else mask]
+        hours = (authored_at - authored_at.astype('datetime64[D]')).astype('timedelta64[h]').astype('int64')
+        return np.bincount(hours, minlength=24)
+
+    def weekday_histogram(self, mask=None):
+        """
+        :param mask: the commits to include (see commit_mask), or None for all of them
+        :type mask: Union[numpy.ndarray, None]
+        :return: the number of commits authored on each day of the week (utc), from monday
+        :rtype: numpy.ndarray
+        """
+        days = self.authored_at[self.commit_mask() if mask is None else mask].astype('datetime64[D]').astype('int64')
+        return np.bincount((days + EPOCH_WEEKDAY) % 7, minlength=7)
+
+    def rolling(self, window=7, mask=None, values='commits'):
+        """
+        a rolling sum over the days between the first and last commit
+
+        :param window: the number of days in the window
+        :type window: int
+        :param mask: the commits to include (see commit_mask), or None for all of them
+        :type mask: Union[numpy.ndarray, None]
+        :param values: what to sum: 'commits', 'additions', 'deletions' or 'churn'
+        :type values: str
+        :return: each day and the sum over the window ending on it
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        """
+        mask = self.commit_mask() if mask is None else mask
+        days = self.authored_at[mask].astype('datetime64[D]')
+        if not len(days):
+            return np.array([], dtype='datetime64[D]'), np.array([], dtype='int64')
+        weights = {
+            'commits': None,
+            'additions': self.commit_additions,
+            'deletions': self.commit_deletions,
+            'churn': self.commit_additions.astype('int64') + self.commit_deletions,
+        }[values]
+        first = days.min()
+        offsets = (days - first).astype('int64')
+        daily = np.bincount(offsets, weights=weights[mask] if weights is not None else None).astype('int64')
+        totals = np.cumsum(daily)
+        totals[window:] = totals[window:] - totals[:-window]
+        return first + np.arange(len(daily)), totals
+
+    @staticmethod
+    def top(values, n=10):
+        """
+        :param values: a value per code, eg from churn or commit_counts
+        :type values: numpy.ndarray
+        :param n: the number of codes to return
+        :type n: int
+        :return: the codes with the n largest values, largest first, and their values
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        """
+        n = min(n, len(values))
+        codes = np.argpartition(values, -n)[-n:] if n else np.array([], dtype='int64')
+        codes = codes[np.argsort(values[codes])[::-1]]
+        return codes, values[codes]
@@ -0,0 +1,147 @@
+"""
+An append-only archive of the github payloads a sync stores, so the database can be rebuilt from them (see
+ghstats.reingest) without going back to the api.
+
+The archive is partitioned by org (orgs/<org>/: the org, its members and teams) and by repo (repos/<org>/<repo>/: the
+repo and its commits). Each process appends to its own segment file in each partition it writes to, as gzip members of
+json lines, so concurrent syncs never write to the same file and a file is never rewritten. Commits are archived as
+decoded from the api, before they are projected onto records (see ghstats.records), so a field the database does not
+store yet can be added by reingesting. Only the patches of their files are left out.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import uuid
+import zlib
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+# buffered payloads are compressed and appended to their segment once they take up this many bytes
+BUFFER_SIZE = 1024 * 1024
+
+
+def org_partition(org_name):
+    """
+    :return: the partition of the payloads of an org, its members and its teams
+    :rtype: Tuple[str, ...]
+    """
+    return 'orgs', org_name
+
+
+def repo_partition(org_name, repo_name):
+    """
+    :return: the partition of the payloads of a repo and its commits
+    :rtype: Tuple[str, ...]
+    """
+    return 'repos', org_name, repo_name
+
+
+class PayloadArchive(object):
+    """
+    Buffers payloads per partition and appends them to the segment files of this archive. flush() must be called before
+    the rows built from the payloads are committed, so every committed row can be rebuilt from the archive.
+    """
+
+    def __init__(self, directory, buffer_size=BUFFER_SIZE):
+        """
+        :param directory: the root directory of the archive
+        :type directory: str
+        :param buffer_size: number of bytes of payloads to buffer per partition before appending them to its segment
+        :type buffer_size: int
+        """
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self._segment = '{}-{}-{}{}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S'), os.getpid(), uuid.uuid4().hex[:8], SEGMENT_SUFFIX)
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def append(self, partition, kind, payload):
+        """
+        :param partition: the partition to add the payload to, see org_partition and repo_partition
+        :type partition: Tuple[str, ...]
+        :param kind: what the payload is, eg 'commit'
+        :type kind: str
+        :param payload: the payload as decoded from the api
+        :type payload: Any
+        """
+        line = json.dumps({'kind': kind, 'at': datetime.utcnow().isoformat(), 'payload': payload},
+                          separators=(',', ':')).encode() + b'\n'
+        with self._lock:
+            lines, size = self._buffers.get(partition, ([], 0))
+            lines.append(line)
+            self._buffers[partition] = lines, size + len(line)
+            if size + len(line) >= self.buffer_size:
+                self._write(partition)
+
+    def flush(self):
+        """
+        append the buffered payloads of every partition to their segments
+        """
+        with self._lock:
+            for partition in list(self._buffers):
+                self._write(partition)
+
+    def _write(self, partition):
+        lines, _ = self._buffers.pop(partition)
+        directory = os.path.join(self.directory, *partition)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, self._segment), 'ab') as f:
+            f.write(gzip.compress(b''.join(lines)))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def list_partitions(directory, kind):
+    """
+    :param directory: the root directory of the archive
+    :type directory: str
+    :param kind: 'orgs' or 'repos'
+    :type kind: str
+    :return: the partitions of the given kind in the archive, sorted
+    :rtype: List[Tuple[str, ...]]
+    """
+    depth = 1 if kind == 'orgs' else 2
+    root = os.path.join(directory, kind)
+    partitions = []
+    for path, dirs, files in os.walk(root):
+        parts = tuple(os.path.relpath(path, root).split(os.sep))
+        if len(parts) == depth and parts != ('.',):
+            partitions.append((kind,) + parts)
+            dirs[:] = []
+    return sorted(partitions)
+
+
+def iter_partition(directory, partition, kinds=None):
+    """
+    read every payload of a partition, oldest segment first. A segment whose last member was cut short (eg by a crash
+    while it was appended to) is read up to the damaged member.
+
+    :param directory: the root directory of the archive
+    :type directory: str
+    :param partition: the partition to read
+    :type partition: Tuple[str, ...]
+    :param kinds: only read the payloads of these kinds, which skips decoding the others
+    :type kinds: Union[Iterable[str], None]
+    :return: an iterator of the kind and payload of each archived payload
+    :rtype: Iterator[Tuple[str, Any]]
+    """
+    path = os.path.join(directory, *partition)
+    # entries are written with their kind first, so they can be filtered without decoding them
+    prefixes = tuple('{{"kind":{}'.format(json.dumps(kind)).encode() for kind in kinds) if kinds is not None else None
+    segments = sorted(name for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX)) if os.path.isdir(path) else []
+    for segment in segments:
+        try:
+            with gzip.open(os.path.join(path, segment)) as f:
+                for line in f:
+                    if prefixes is not None and not line.startswith(prefixes):
+                        continue
+                    record = json.loads(line)
+                    yield record['kind'], record['payload']
+        except (EOFError, OSError, zlib.error, ValueError):
+            logger.warning('{}: stopped reading at a damaged entry'.format(os.path.join(path, segment)))
@@ -0,0 +1,171 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+CACHED_HEADERS = ('content-type', 'etag', 'last-modified', 'link')
+# responses that are fetched once and never revalidated, which would only push the listings (the responses that are
+# requested again by every sync) out of the cache: the details of a commit, with the patch of every file it changed
+UNCACHED_PATH = re.compile(r'/commits/[0-9a-f]{40}$')
+
+CacheEntry = namedtuple('CacheEntry', ['etag', 'last_modified', 'headers', 'body'])
+
+
+class ResponseCache(object):
+    """
+    A size bounded, on-disk store of github response bodies and their validators (ETag / Last-Modified), keyed by url.
+    Once the stored bodies take up more than max_size bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        :param path: path of the sqlite file to store the cache in
+        :type path: str
+        :param max_size: maximum total size in bytes of the cached response bodies
+        :type max_size: int
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, body BLOB, '
+            'size INTEGER NOT NULL, used_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_used_at_index ON responses (used_at)')
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        """
+        get the cached response for the given url
+
+        :param url: the url of the request
+        :type url: str
+        :return: the cached entry, if there is one
+        :rtype: Union[CacheEntry, None]
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT etag, last_modified, headers, body FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE responses SET used_at = ? WHERE url = ?', (time.time(), url))
+        etag, last_modified, headers, body = row
+        return CacheEntry(etag, last_modified, json.loads(headers), body)
+
+    def put(self, url, etag, last_modified, headers, body):
+        """
+        store a response for the given url, evicting the least recently used entries if the cache is now too large
+
+        :param url: the url of the request
+        :type url: str
+        :param etag: the ETag header of the response
+        :type etag: Union[str, None]
+        :param last_modified: the Last-Modified header of the response
+        :type last_modified: Union[str, None]
+        :param headers: the response headers needed to rebuild the response
+        :type headers: Dict[str, str]
+        :param body: the response body
+        :type body: bytes
+        """
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, last_modified, headers, body, size, used_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, json.dumps(headers), body, len(body), time.time())
+            )
+            self._size += len(body) - (old[0] if old is not None else 0)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size:
+            oldest = self._conn.execute('SELECT url, size FROM responses ORDER BY used_at LIMIT 100').fetchall()
+            if not oldest:
+                self._size = 0
+                return
+            for url, size in oldest:
+                self._conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self._size -= size
+                if self._size <= self.max_size:
+                    return
+
+    def record(self, hit):
+        """
+        count a request as answered from the cache (hit) or downloaded (miss)
+
+        :param hit: whether the request was answered from the cache
+        :type hit: bool
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """
+        :return: the number of requests answered from the cache and the number that had to be downloaded in this run
+        :rtype: Tuple[int, int]
+        """
+        return self.hits, self.misses
+
+    def close(self):
+        self._conn.close()
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter which makes every GET a conditional request when there is a cached copy of the response. A
+    `304 Not Modified` (which github does not count against the rate limit) is turned back into a 200 using the cached
+    body, so callers can not tell the difference. Responses whose path matches UNCACHED_PATH are never cached.
+    """
+
+    def __init__(self, cache, **kwargs):
+        """
+        :param cache: the cache to store responses in
+        :type cache: ResponseCache
+        """
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET' or UNCACHED_PATH.search(urlsplit(request.url).path):
+            return super().send(request, **kwargs)
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            if entry.etag:
+                request.headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request.headers['If-Modified-Since'] = entry.last_modified
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.record(hit=True)
+            response.content  # release the connection
+            response._content = entry.body
+            response.status_code = 200
+            response.reason = 'OK'
+            response.headers.update(entry.headers)
+        elif response.status_code == 200:
+            self.cache.record(hit=False)
+            etag = response.headers.get('etag')
+            last_modified = response.headers.get('last-modified')
+            if etag or last_modified:
+                headers = {k: response.headers[k] for k in CACHED_HEADERS if k in response.headers}
+                self.cache.put(request.url, etag, last_modified, headers, response.content)
+        return response
@@ -5,21 +5,155 @@ import os
 config = configparser.ConfigParser()
 config.read(os.getenv('GH_DATA_CONFIG', 'config.ini'))
 
-BASE_GH_URL = config.get('GITHUB', 'api_url', fallback='https://api.github.com')
-GITHUB_USERNAME = os.getenv('GITHUB_LOGIN', config.get('GITHUB', 'login'))
-GITHUB_OAUTH_TOKEN = os.getenv('GITHUB_TOKEN', config.get('GITHUB', 'token'))
-ORGANISATIONS = json.loads(config.get('DETAILS', 'orgs'))
+BASE_GH_URL = os.getenv('GH_API_URL', config.get('GITHUB', 'api_url', fallback='https://api.github.com'))
+HTTP_GH_URL = config.get('GITHUB', 'http_url', fallback='https://github.com')
+# github.com serves graphql next to the rest api, github enterprise serves it from /api/graphql next to /api/v3
+_API_URL = BASE_GH_URL.rstrip('/')
+GRAPHQL_URL = config.get('GITHUB', 'graphql_url', fallback='{}/graphql'.format(
+    _API_URL[:-len('/v3')] if _API_URL.endswith('/api/v3') else _API_URL))
+# extra [login, token] pairs (e.g. service accounts) whose rate limit budgets are shared by the requests
+GITHUB_EXTRA_CREDENTIALS = json.loads(
+    os.getenv('GITHUB_EXTRA_CREDENTIALS', config.get('GITHUB', 'extra_credentials', fallback='[]')))
+
+# number of orgs to sync at once, each in its own worker process
+SYNC_PROCESSES = int(os.getenv('GH_SYNC_PROCESSES', config.get('SYNC', 'processes', fallback='1')))
+# how commits are listed: 'rest' (one request per commit), 'graphql' (100 commits with stats per request) or 'mirror'
+# (walk the history of local mirror clones)
+COMMIT_BACKEND = os.getenv('GH_COMMIT_BACKEND', config.get('SYNC', 'backend', fallback='rest'))
+# which branches to sync: 'default' (only the default branch) or 'all' (every branch whose head has moved)
+COMMIT_BRANCHES = os.getenv('GH_SYNC_BRANCHES', config.get('SYNC', 'branches', fallback='default'))
+# whether to fetch the files changed by each commit when the backend does not list them (graphql)
+COMMIT_FILES = config.getboolean('SYNC', 'files', fallback=True)
+# number of commit details to fetch from github concurrently
+COMMIT_FETCH_WORKERS = int(os.getenv('GH_SYNC_WORKERS', config.get('SYNC', 'workers', fallback='1')))
+# number of connections each github session keeps open, by default enough for every commit fetch worker. Requests made
+# while all of them are in use open a connection that is closed afterwards
+HTTP_POOL_SIZE = int(os.getenv('GH_HTTP_POOL_SIZE', config.get(
+    'GITHUB', 'http_pool_size', fallback=str(max(10, COMMIT_FETCH_WORKERS)))))
+# number of user profiles to fetch from github concurrently, and to fetch before linking their emails and committing,
+# when the sync fetches the profiles of new users once their orgs are synced
+PROFILE_FETCH_WORKERS = int(os.getenv('GH_PROFILE_WORKERS', config.get(
+    'SYNC', 'profile_workers', fallback=str(COMMIT_FETCH_WORKERS))))
+PROFILE_BATCH_SIZE = config.getint('SYNC', 'profile_batch_size', fallback=100)
+# new commits are buffered and written in batches of this many, or at least every flush_interval seconds
+WRITE_BATCH_SIZE = config.getint('SYNC', 'batch_size', fallback=500)
+WRITE_FLUSH_INTERVAL = config.getfloat('SYNC', 'flush_interval', fallback=30.0)
+# whether each batch of new commits also refreshes the daily contributions rollup of the days it touches
+REFRESH_ROLLUPS = config.getboolean('SYNC', 'rollups', fallback=True)
+# maximum number of emails and of users kept in the in-process identity cache while syncing commits
+IDENTITY_CACHE_SIZE = config.getint('SYNC', 'identity_cache_size', fallback=100000)
+# maximum number of file paths whose ids are kept in memory while writing files
+PATH_CACHE_SIZE = config.getint('SYNC', 'path_cache_size', fallback=200000)
+# how batches are written: 'insert' (multi-row INSERT) or 'copy' (postgres COPY)
+WRITE_METHOD = config.get('SYNC', 'write_method', fallback='insert')
+
+# where the mirror clones of each repo are kept, and how many repos to update and parse at once, for the mirror backend
+MIRROR_DIR = os.getenv('GH_MIRROR_DIR', config.get('MIRROR', 'path', fallback='mirrors'))
+MIRROR_PROCESSES = config.getint('MIRROR', 'processes', fallback=4)
+
+# where `ghstats export` writes its parquet datasets, how many rows it holds in memory at once, and how old (in seconds)
+# a commit must be to be exported, so batches a running sync is still writing are left for the next export
+EXPORT_DIR = os.getenv('GH_EXPORT_DIR', config.get('EXPORT', 'path', fallback='export'))
+EXPORT_CHUNK_SIZE = config.getint('EXPORT', 'chunk_size', fallback=100000)
+EXPORT_SETTLE_SECONDS = config.getfloat('EXPORT', 'settle_seconds', fallback=300.0)
+
+# where the columnar store of ghstats.analytics is saved for later sessions to memory-map
+ANALYTICS_CACHE_DIR = os.getenv('GH_ANALYTICS_CACHE', config.get('ANALYTICS', 'path', fallback='analytics-cache'))
+
+# the job queue shared by `ghstats worker` processes: number of jobs each worker runs at once, how long a job is leased
+# for (the lease is renewed while the job runs), how often and how long after a failure a job is retried (the delay
+# doubles with each attempt), how long an idle worker waits before looking for jobs again, and how many commits each
+# commit_details job fetches
+WORKER_THREADS = int(os.getenv('GH_WORKER_THREADS', config.get('QUEUE', 'threads', fallback='4')))
+JOB_LEASE_SECONDS = config.getfloat('QUEUE', 'lease_seconds', fallback=300.0)
+JOB_MAX_ATTEMPTS = config.getint('QUEUE', 'max_attempts', fallback=5)
+JOB_RETRY_DELAY = config.getfloat('QUEUE', 'retry_delay', fallback=60.0)
+JOB_POLL_INTERVAL = config.getfloat('QUEUE', 'poll_interval', fallback=10.0)
+COMMIT_DETAILS_BATCH = config.getint('QUEUE', 'commit_details_batch', fallback=100)
+
+# directory the payloads stored by a sync are archived in, for `ghstats reingest`. Empty to not archive them
+ARCHIVE_DIR = os.getenv('GH_ARCHIVE_DIR', config.get('ARCHIVE', 'path', fallback=''))
+# number of repos `ghstats reingest` replays at once, each in its own worker process
+REINGEST_PROCESSES = config.getint('ARCHIVE', 'processes', fallback=4)
+
+# file `ghstats sync` writes its metrics to at the end of a run: json if it ends in .json, otherwise the prometheus text
+# format. Empty to only log the summary
+METRICS_PATH = os.getenv('GH_METRICS_PATH', config.get('METRICS', 'path', fallback=''))
+# pipeline stages to run under cProfile, and the directory the profiles are saved in
+PROFILE_STAGES = [stage for stage in os.getenv(
+    'GH_PROFILE_STAGES', config.get('METRICS', 'profile_stages', fallback='')).split(',') if stage]
+PROFILE_DIR = config.get('METRICS', 'profile_dir', fallback='profiles')
+
+# on-disk cache of github responses used to make conditional requests. An empty path disables the cache
+RESPONSE_CACHE_PATH = os.getenv('GH_CACHE_PATH', config.get('CACHE', 'path', fallback='ghstats-cache.sqlite'))
+RESPONSE_CACHE_MAX_SIZE = int(config.get('CACHE', 'max_size_mb', fallback='1024')) * 1024 * 1024
 
 DB_HOST = os.getenv('GH_PG_HOST', config.get('DATABASE', 'host', fallback='localhost'))
 DB_PORT = os.getenv('GH_PG_PORT', config.get('DATABASE', 'port', fallback='5432'))
 DB_NAME = os.getenv('GH_PG_DB', config.get('DATABASE', 'db', fallback='ghdata'))
-DB_USERNAME = os.getenv('GH_PG_UN', config.get('DATABASE', 'username'))
-DB_PASSWORD = os.getenv('GH_PG_PW', config.get('DATABASE', 'password'))
-
-DB_CONNECTION_STRING = "postgresql+psycopg2://{un}:{pw}@{host}:{port}/{db}".format(
-    un=DB_USERNAME,
-    pw=DB_PASSWORD,
-    host=DB_HOST,
-    port=DB_PORT,
-    db=DB_NAME
-)
+# number of database connections each process keeps open, and how many more it may open while they are all in use
+DB_POOL_SIZE = int(os.getenv('GH_PG_POOL_SIZE', config.get('DATABASE', 'pool_size', fallback='5')))
+DB_MAX_OVERFLOW = int(os.getenv('GH_PG_MAX_OVERFLOW', config.get('DATABASE', 'max_overflow', fallback='10')))
+
+# Settings without a sensible default (the github credentials, the orgs to sync and the database login) are only read
+# when first needed, through the functions below, so importing the package (eg for analytics) does not require them.
+
+
+def _required(section, option, env=None):
+    """
+    :return: the value of the env var if it is set, otherwise the value of the option
+    :rtype: str
+    :raises configparser.NoOptionError: if neither is set
+    """
+    value = os.getenv(env) if env is not None else None
+    if value is None:
+        value = config.get(section, option, fallback=None)
+    if value is None:
+        raise configparser.NoOptionError(option, section)
+    return value
+
+
+def github_login():
+    """
+    :return: the login of the github account requests are made as
+    :rtype: str
+    """
+    return _required('GITHUB', 'login', 'GITHUB_LOGIN')
+
+
+def github_token():
+    """
+    :return: the oauth token of the github account requests are made as
+    :rtype: str
+    """
+    return _required('GITHUB', 'token', 'GITHUB_TOKEN')
+
+
+def github_credentials():
+    """
+    :return: the (login, token) pairs whose rate limit budgets are shared by the requests, the configured account first
+    :rtype: List[Tuple[str, str]]
+    """
+    return [(github_login(), github_token())] + [tuple(c) for c in GITHUB_EXTRA_CREDENTIALS]
+
+
+def organisations():
+    """
+    :return: the names of the orgs to sync
+    :rtype: List[str]
+    """
+    return json.loads(_required('DETAILS', 'orgs'))
+
+
+def db_connection_string():
+    """
+    :return: the sqlalchemy url of the database
+    :rtype: str
+    """
+    return "postgresql+psycopg2://{un}:{pw}@{host}:{port}/{db}".format(
+        un=_required('DATABASE', 'username', 'GH_PG_UN'),
+        pw=_required('DATABASE', 'password', 'GH_PG_PW'),
+        host=DB_HOST,
+        port=DB_PORT,
+        db=DB_NAME
+    )
@@ -0,0 +1,250 @@
+"""
+Exports commits and their file changes to Parquet datasets for analysis outside the database. Rows are streamed from a
+server side cursor a chunk at a time, so memory use does not depend on the size of the history, and written to hive
+partitioned datasets (org=/repo=/month=) with identifiers dictionary encoded.
+
+Exports are incremental: each run only writes the commits added to the database since the previous run, which is
+recorded in a watermark file next to the datasets.
+"""
+
+import json
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, text
+from sqlalchemy.orm import aliased
+
+from ghstats.config import EXPORT_DIR, EXPORT_CHUNK_SIZE, EXPORT_SETTLE_SECONDS
+from ghstats.orm.orm import Commit, File, Path, Repo, Organisation, User, Email
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_FILE = '_watermark.json'
+PARTITION_COLUMNS = ['org', 'repo', 'month']
+# string columns with few distinct values, which are stored as dictionaries (read back as categoricals by pandas)
+DICTIONARY_COLUMNS = {'author', 'author_email', 'committer', 'committer_email', 'status'}
+# the start of the oldest transaction open on the database, other than this one. Only the sessions of the same role are
+# visible to a role without pg_read_all_stats, so the export has to connect as the role the syncs write with
+OLDEST_TRANSACTION_QUERY = text('''
+SELECT timezone('utc', min(xact_start)) FROM pg_stat_activity
+WHERE datname = current_database() AND pid <> pg_backend_pid()
+''')
+
+
+def _commits_query(since, until):
+    """
+    :return: the query of the commits added to the database in (since, until], one row per commit
+    :rtype: sqlalchemy.sql.expression.Select
+    """
+    author, committer = aliased(User), aliased(User)
+    author_email, committer_email = aliased(Email), aliased(Email)
+    q = select([
+        Organisation.name.label('org'),
+        Repo.name.label('repo'),
+        func.to_char(Commit.authored_at, 'YYYY-MM').label('month'),
+        Commit.sha.label('sha'),
+        Commit.name.label('message'),
+        author.name.label('author'),
+        author_email.email.label('author_email'),
+        Commit.authored_at.label('authored_at'),
+        committer.name.label('committer'),
+        committer_email.email.label('committer_email'),
+        Commit.committed_at.label('committed_at'),
+        Commit.additions.label('additions'),
+        Commit.deletions.label('deletions'),
+        Commit.added_at.label('added_at'),
+    ]).select_from(
+        Commit.__table__
+        .join(Repo.__table__, Repo.id == Commit.repo_id)
+        .join(Organisation.__table__, Organisation.id == Repo.org_id)
+        .outerjoin(author, author.id == Commit.author_id)
+        .outerjoin(author_email, author_email.id == Commit.author_email_id)
+        .outerjoin(committer, committer.id == Commit.committer_id)
+        .outerjoin(committer_email, committer_email.id == Commit.committer_email_id)
+    )
+    return _added_between(q, since, until)
+
+
+def _files_query(since, until):
+    """
+    :return: the query of the file changes of the commits added to the database in (since, until], one row per file
+    :rtype: sqlalchemy.sql.expression.Select
+    """
+    q = select([
+        Organisation.name.label('org'),
+        Repo.name.label('repo'),
+        func.to_char(Commit.authored_at, 'YYYY-MM').label('month'),
+        Commit.sha.label('sha'),
+        Path.path.label('filename'),
+        File.status.label('status'),
+        File.additions.label('additions'),
+        File.deletions.label('deletions'),
+        Commit.added_at.label('added_at'),
+    ]).select_from(
+        File.__table__
+        .join(Path.__table__, Path.id == File.path_id)
+        .join(Commit.__table__, Commit.id == File.commit_id)
+        .join(Repo.__table__, Repo.id == Commit.repo_id)
+        .join(Organisation.__table__, Organisation.id == Repo.org_id)
+    )
+    return _added_between(q, since, until)
+
+
+def _added_between(q, since, until):
+    if since is not None:
+        q = q.where(Commit.added_at > since)
+    return q.where(Commit.added_at <= until)
+
+
+def _column_type(name):
+    if name in ('additions', 'deletions'):
+        return pa.int32()
+    if name in ('authored_at', 'committed_at', 'added_at'):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def _to_table(columns, rows):
+    """
+    convert a chunk of rows into an arrow table, dictionary encoding the identifier columns
+
+    :param columns: the names of the columns
+    :type columns: List[str]
+    :param rows: the rows of the chunk
+    :type rows: List[Tuple[Any, ...]]
+    :return: the table of the chunk
+    :rtype: pyarrow.Table
+    """
+    arrays = []
+    for name, values in zip(columns, zip(*rows)):
+        if name == 'sha':
+            values = [bytes(sha).hex() for sha in values]
+        array = pa.array(values, type=_column_type(name))
+        if name in DICTIONARY_COLUMNS:
+            array = array.dictionary_encode()
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=columns)
+
+
+def export_query(db_session, q, path, run_id, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    stream the rows of a query through a server side cursor and append them to the parquet dataset at path, one chunk
+    of rows at a time
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param q: the query to export. It must have the PARTITION_COLUMNS
+    :type q: sqlalchemy.sql.expression.Select
+    :param path: the root directory of the dataset
+    :type path: str
+    :param run_id: identifies the files written by this run
+    :type run_id: str
+    :param chunk_size: number of rows to hold in memory and write at once
+    :type chunk_size: int
+    :return: the number of rows exported
+    :rtype: int
+    """
+    result = db_session.connection().execution_options(stream_results=True).execute(q)
+    columns = list(result.keys())
+    exported = 0
+    for chunk in iter(lambda: result.fetchmany(chunk_size), []):
+        pq.write_to_dataset(
+            _to_table(columns, chunk), path, partition_cols=PARTITION_COLUMNS,
+            basename_template='{}-{}-{{i}}.parquet'.format(run_id, exported // chunk_size),
+            existing_data_behavior='overwrite_or_ignore',
+        )
+        exported += len(chunk)
+        logger.debug('{}: exported {} rows'.format(path, exported))
+    result.close()
+    return exported
+
+
+def read_watermark(export_dir):
+    """
+    :param export_dir: the directory the datasets are exported to
+    :type export_dir: str
+    :return: the time up to which commits added to the database have been exported, or None if nothing has been
+    :rtype: Union[datetime.datetime, None]
+    """
+    try:
+        with open(os.path.join(export_dir, WATERMARK_FILE)) as f:
+            return datetime.strptime(json.load(f)['added_at'], '%Y-%m-%dT%H:%M:%S.%f')
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(export_dir, added_at):
+    """
+    record that commits added to the database up to added_at have been exported
+
+    :param export_dir: the directory the datasets are exported to
+    :type export_dir: str
+    :param added_at: the time up to which commits have been exported
+    :type added_at: datetime.datetime
+    """
+    path = os.path.join(export_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'added_at': added_at.strftime('%Y-%m-%dT%H:%M:%S.%f')}, f)
+    os.replace(path + '.tmp', path)
+
+
+def export(db_session, export_dir=EXPORT_DIR, full=False, chunk_size=EXPORT_CHUNK_SIZE,
+           settle_seconds=EXPORT_SETTLE_SECONDS):
+    """
+    export the commits (and their file changes) added to the database since the last export to the 'commits' and
+    'files' parquet datasets in export_dir
+
+    The added_at of a commit is the start of the transaction that wrote it, which may commit long after (eg a whole
+    `reingest --replace` of a repo is one transaction). So commits are only exported up to the start of the oldest
+    transaction still open, which is the earliest added_at a commit that is not visible yet can have, and commits
+    added in the last settle_seconds are left for the next run too. The watermark is only moved once both datasets are
+    written, so a failed run is retried from the same point, leaving the files of the failed run (named after its run
+    id) to be removed by hand.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param export_dir: the directory to export the datasets to
+    :type export_dir: str
+    :param full: whether to replace the datasets with a fresh export of all commits
+    :type full: bool
+    :param chunk_size: number of rows to hold in memory and write at once
+    :type chunk_size: int
+    :param settle_seconds: only export commits added at least this many seconds ago
+    :type settle_seconds: float
+    :return: the number of commits and of files exported
+    :rtype: Tuple[int, int]
+    """
+    if pa is None:
+        raise RuntimeError('exporting needs pyarrow, install it with `pip install ghstats[export]`')
+    datasets = {'commits': _commits_query, 'files': _files_query}
+    if full:
+        for name in datasets:
+            shutil.rmtree(os.path.join(export_dir, name), ignore_errors=True)
+    os.makedirs(export_dir, exist_ok=True)
+    since = None if full else read_watermark(export_dir)
+    now = db_session.execute(text("SELECT timezone('utc', now())")).scalar()
+    until = now - timedelta(seconds=settle_seconds)
+    oldest = db_session.execute(OLDEST_TRANSACTION_QUERY).scalar()
+    if oldest is not None and oldest <= until:
+        logger.info('exporting the commits added before {}, when the oldest open transaction started'.format(oldest))
+        # its commits are added at the very time it started
+        until = oldest - timedelta(microseconds=1)
+    if since is not None and until <= since:
+        return 0, 0
+    run_id = '{}-{}'.format(until.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+    counts = [
+        export_query(db_session, query(since, until), os.path.join(export_dir, name), run_id, chunk_size)
+        for name, query in sorted(datasets.items())
+    ]
+    write_watermark(export_dir, until)
+    logger.info('exported {} commits and {} files added up to {}'.format(*counts, until))
+    return tuple(counts)
@@ -1,12 +1,132 @@
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from typing import List, Tuple
+from urllib.parse import urlencode
 
-from ghstats.config import BASE_GH_URL
-from ghstats.orm.orm import Repo, Organisation, Team, User, Email, Commit, File
-from ghstats.utils import get_all, parse_gh_date
+from sqlalchemy import literal, literal_column, func, select, text
+from sqlalchemy.dialects.postgresql import insert, UUID
+
+from ghstats.archive import org_partition, repo_partition
+from ghstats.config import BASE_GH_URL, COMMIT_FETCH_WORKERS, COMMIT_BACKEND, COMMIT_FILES, COMMIT_BRANCHES, \
+    PROFILE_FETCH_WORKERS, PROFILE_BATCH_SIZE, REFRESH_ROLLUPS
+from ghstats.graphql import iter_history, HISTORY_PAGE_SIZE
+from ghstats.identity import IdentityCache
+from ghstats.metrics import METRICS
+from ghstats.orm.orm import Repo, Organisation, Team, User, Email, Commit, Ref, SyncState, organisation_user_table, \
+    team_user_table
+from ghstats.records import commit_record
+from ghstats.shaindex import ShaIndex
+from ghstats.stats import refresh_days
+from ghstats.utils import get_all, iter_all, iter_pages, bounded_map
+from ghstats.writer import CommitWriter
 
 logger = logging.getLogger(__file__)
 
+# link the commits made with the given emails that have no user to the users the emails have since been linked to
+RELINK_AUTHORS_QUERY = text('''
+UPDATE commits SET author_id = emails.user_id
+FROM emails
+WHERE commits.author_email_id = emails.id AND commits.author_id IS NULL AND emails.user_id IS NOT NULL
+    AND emails.id = ANY(CAST(:email_ids AS UUID[]))
+RETURNING commits.repo_id, CAST(commits.authored_at AS DATE)
+''')
+RELINK_COMMITTERS_QUERY = text('''
+UPDATE commits SET committer_id = emails.user_id
+FROM emails
+WHERE commits.committer_email_id = emails.id AND commits.committer_id IS NULL AND emails.user_id IS NOT NULL
+    AND emails.id = ANY(CAST(:email_ids AS UUID[]))
+''')
+
+
+def _upsert_by_ext_id(db_session, model, rows, update_columns):
+    """
+    insert the given rows into the table of the model in a single statement, updating update_columns of any row whose
+    ext_id already exists
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param model: the row class to upsert into
+    :type model: type
+    :param rows: the values of each row, keyed by column name
+    :type rows: List[Dict[str, Any]]
+    :param update_columns: the columns to update when the row already exists
+    :type update_columns: Iterable[str]
+    :return: the id of each row and whether it was newly inserted, keyed by ext_id
+    :rtype: Dict[int, Tuple[uuid.UUID, bool]]
+    """
+    rows = list({row['ext_id']: row for row in rows}.values())
+    if not rows:
+        return {}
+    db_session.flush()
+    table = model.__table__
+    stmt = insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.ext_id],
+        set_={column: getattr(stmt.excluded, column) for column in update_columns},
+    ).returning(table.c.ext_id, table.c.id, literal_column('xmax = 0'))
+    return {ext_id: (row_id, inserted) for ext_id, row_id, inserted in db_session.execute(stmt)}
+
+
+def _load_by_ext_id(db_session, model, ext_ids):
+    """
+    load the row objects with the given ext_ids, refreshing any that are already in the session
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param model: the row class to load
+    :type model: type
+    :param ext_ids: the github ids of the rows
+    :type ext_ids: Iterable[int]
+    :return: the row objects
+    :rtype: list
+    """
+    ext_ids = list(ext_ids)
+    if not ext_ids:
+        return []
+    return db_session.query(model).filter(model.ext_id.in_(ext_ids)).populate_existing().all()
+
+
+def _archive(gh_session, partition, kind, payload):
+    """
+    add a payload to the archive of the session, if it has one (see ghstats.archive)
+
+    :param gh_session: the requests session with the github api, or None when reingesting from the archive
+    :type gh_session: Union[requests.sessions.Session, None]
+    :param partition: the partition to add the payload to
+    :type partition: Tuple[str, ...]
+    :param kind: what the payload is, eg 'commit'
+    :type kind: str
+    :param payload: the payload as decoded from the github api
+    :type payload: Any
+    """
+    archive = getattr(gh_session, 'archive', None)
+    if archive is not None:
+        archive.append(partition, kind, payload)
+
+
+def _archive_commit(gh_session, partition, commit):
+    """
+    add a github commit object to the archive of the session, as decoded but without the patches of its files, which
+    can be megabytes and are never stored
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param partition: the partition of the commit's repo, or None to not archive it
+    :type partition: Union[Tuple[str, ...], None]
+    :param commit: github commit object from api
+    :type commit: dict
+    """
+    if partition is None or getattr(gh_session, 'archive', None) is None:
+        return
+    if commit.get('files'):
+        commit = dict(commit, files=[
+            {key: value for key, value in file.items() if key != 'patch'} for file in commit['files']
+        ])
+    _archive(gh_session, partition, 'commit', commit)
+
 
 def get_orgs(db_session, gh_session, orgs):
     """
@@ -23,47 +143,121 @@ def get_orgs(db_session, gh_session, orgs):
     """
     existing = db_session.query(Organisation).all()  # type: List[Organisation]
     new = set(orgs) - {row.name for row in existing}
+    rows = []
     for org in new:
         (org,), _ = get_all(gh_session, '{}/orgs/{}'.format(BASE_GH_URL, org))
-        # ensure this isn't just a name change and if so, update the name
-        org_row = db_session.query(Organisation).filter(Organisation.ext_id == org['id']).scalar()  # type: Organisation
-        if org_row is not None:
-            org_row.name = org['login']
-        else:
-            org_row = Organisation(ext_id=org['id'], name=org['login'])
-            db_session.add(org_row)
-            existing.append(org_row)
+        _archive(gh_session, org_partition(org['login']), 'org', org)
+        rows.append(dict(ext_id=org['id'], name=org['login']))
+    # if this is just a name change, update the name
+    if _upsert_by_ext_id(db_session, Organisation, rows, ['name']):
+        existing = db_session.query(Organisation).populate_existing().all()
     return existing
 
 
-def get_team(db_session, gh_session, team, org):
+def _user_ids(db_session, ext_ids):
     """
-    get or create the team from the given team object from the github api
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param ext_ids: github ids of users
+    :type ext_ids: Iterable[int]
+    :return: the ids of the User rows of those of the users that are in the DB
+    :rtype: List[uuid.UUID]
+    """
+    ext_ids = list(ext_ids)
+    if not ext_ids:
+        return []
+    return [user_id for user_id, in db_session.query(User.id).filter(User.ext_id.in_(ext_ids))]
+
+
+def _sync_membership(db_session, group_column, group_id, user_ids, remove=True):
+    """
+    make the given users the members of a team or an org: the current members are diffed against them, then the new
+    members are added with one statement and (with remove) those who left are removed with another
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
+    :param group_column: the column of the association table holding the team or org, eg team_user_table.c.team_id
+    :type group_column: sqlalchemy.Column
+    :param group_id: the id of the Team or Organisation row
+    :type group_id: uuid.UUID
+    :param user_ids: the ids of the User rows of every member
+    :type user_ids: Iterable[uuid.UUID]
+    :param remove: whether to remove the current members that are not in user_ids. Only pass True when user_ids holds
+        every member, not just those seen so far
+    :type remove: bool
+    :return: the number of members added and removed
+    :rtype: Tuple[int, int]
+    """
+    table = group_column.table
+    user_ids = set(user_ids)
+    current = {user_id for user_id, in db_session.execute(select([table.c.user_id]).where(group_column == group_id))}
+    added = user_ids - current
+    removed = current - user_ids if remove else set()
+    if added:
+        db_session.execute(insert(table).values([
+            {group_column.name: group_id, 'user_id': user_id} for user_id in added
+        ]).on_conflict_do_nothing())
+    if removed:
+        db_session.execute(table.delete().where(group_column == group_id).where(table.c.user_id.in_(list(removed))))
+    return len(added), len(removed)
+
+
+def _list_all(gh_session, url):
+    """
     :param gh_session: the requests session with the github api
     :type gh_session: requests.sessions.Session
-    :param team: a github team object from API
-    :type team: dict
-    :param org: an Organisation row object
-    :type org: ghstats.orm.orm.Organisation
-    :return: a Team row object
-    :rtype: ghstats.orm.orm.Team
-    """
-    team_row = db_session.query(Team).filter(Team.ext_id == team['id']).scalar()  # type: Team
-    if team_row is not None:
-        if team_row.name != team['slug']:
-            team_row.name = team['slug']
-    else:
-        team_row = Team(ext_id=team['id'], name=team['slug'], org=org)
-        db_session.add(team_row)
-    members, _ = get_all(gh_session, '{}/teams/{}/members'.format(BASE_GH_URL, team_row.ext_id))
-    member_rows = db_session.query(User).filter(User.ext_id.in_([member['id'] for member in members])).all()
-    for member_row in member_rows:
-        if member_row not in team_row.users:
-            team_row.users.append(member_row)
-    return team_row
+    :param url: github api url to get
+    :type url: str
+    :return: the results of every page that was listed successfully, and whether every page was
+    :rtype: Tuple[list, bool]
+    """
+    items, complete = [], True
+    for page, status_code in iter_pages(gh_session, url):
+        if status_code == 200:
+            items.extend(page)
+        else:
+            complete = False
+    return items, complete
+
+
+def _sync_team_members(db_session, gh_session, team_row):
+    """
+    make the members of the team on github that are in the DB the members of the team. If the members could not all be
+    listed, members who left are kept until the next sync.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param team_row: a Team row object
+    :type team_row: ghstats.orm.orm.Team
+    """
+    members, complete = _list_all(gh_session, '{}/teams/{}/members'.format(BASE_GH_URL, team_row.ext_id))
+    if not complete:
+        logger.warning('{}/{}: could not list every member, none are removed'.format(team_row.org.name, team_row.name))
+    _archive(gh_session, org_partition(team_row.org.name), 'team_members',
+             {'team': team_row.ext_id, 'members': members, 'complete': complete})
+    _store_team_members(db_session, team_row, members, remove=complete)
+
+
+def _store_team_members(db_session, team_row, members, remove=True):
+    """
+    make the given members of a team that are in the DB the members of the team
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param team_row: a Team row object
+    :type team_row: ghstats.orm.orm.Team
+    :param members: github user objects of the members of the team
+    :type members: List[Dict[str, Union[str, bool, int]]]
+    :param remove: whether to remove the members of the team that are not in members
+    :type remove: bool
+    """
+    user_ids = _user_ids(db_session, (member['id'] for member in members))
+    added, removed = _sync_membership(
+        db_session, team_user_table.c.team_id, _row_id(db_session, team_row), user_ids, remove)
+    if added or removed:
+        logger.debug('{}: {} members added, {} removed'.format(team_row.name, added, removed))
 
 
 def get_teams(db_session, gh_session, orgs):
@@ -82,31 +276,31 @@ def get_teams(db_session, gh_session, orgs):
     """
     team_rows = []
     for org in orgs:
-        teams, _ = get_all(gh_session, '{}/orgs/{}/teams'.format(BASE_GH_URL, org.name))
-        for team in teams:
-            team_rows.append(get_team(db_session, gh_session, team, org))
+        org_id = _row_id(db_session, org)
+        for teams, _ in iter_pages(gh_session, '{}/orgs/{}/teams'.format(BASE_GH_URL, org.name)):
+            for team in teams:
+                _archive(gh_session, org_partition(org.name), 'team', team)
+            for team_row in _store_teams(db_session, org_id, teams):
+                _sync_team_members(db_session, gh_session, team_row)
+                team_rows.append(team_row)
     return team_rows
 
 
-def get_repo(db_session, repo, org):
+def _store_teams(db_session, org_id, teams):
     """
-    get or create the Repo row object from the given repo object from the github api
+    insert or update the given teams of an org
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
-    :param repo: repo object from the github api
-    :type repo: dict
-    :param org: Organisation row object
-    :type org: ghstats.orm.orm.Organisation
-    """
-    repo_row = db_session.query(Repo).filter(Repo.ext_id == repo['id']).scalar()  # type: Repo
-    if repo_row is not None:
-        if repo_row.name != repo['name']:
-            repo_row.name = repo['name']
-    else:
-        repo_row = Repo(ext_id=repo['id'], name=repo['name'], org=org)
-        db_session.add(repo_row)
-    return repo_row
+    :param org_id: the id of the Organisation row
+    :type org_id: uuid.UUID
+    :param teams: github team objects
+    :type teams: List[dict]
+    :return: the Team row objects
+    :rtype: List[ghstats.orm.orm.Team]
+    """
+    rows = [dict(ext_id=team['id'], name=team['slug'], org_id=org_id) for team in teams]
+    return _load_by_ext_id(db_session, Team, _upsert_by_ext_id(db_session, Team, rows, ['name']))
 
 
 def get_repos(db_session, gh_session, orgs):
@@ -125,16 +319,40 @@ def get_repos(db_session, gh_session, orgs):
     """
     repo_rows = []
     for org in orgs:
-        repos, _ = get_all(gh_session, '{}/orgs/{}/repos'.format(BASE_GH_URL, org.name))
-        for repo in repos:
-            repo_rows.append(get_repo(db_session, repo, org))
+        org_id = _row_id(db_session, org)
+        for repos, _ in iter_pages(gh_session, '{}/orgs/{}/repos'.format(BASE_GH_URL, org.name)):
+            for repo in repos:
+                _archive(gh_session, repo_partition(org.name, repo['name']), 'repo', repo)
+            repo_rows.extend(_store_repos(db_session, org_id, repos))
     return repo_rows
 
 
+def _store_repos(db_session, org_id, repos):
+    """
+    insert or update the given repos of an org
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param org_id: the id of the Organisation row
+    :type org_id: uuid.UUID
+    :param repos: github repo objects
+    :type repos: List[dict]
+    :return: the Repo row objects
+    :rtype: List[ghstats.orm.orm.Repo]
+    """
+    rows = [
+        dict(ext_id=repo['id'], name=repo['name'], org_id=org_id, default_branch=repo.get('default_branch'))
+        for repo in repos
+    ]
+    upserted = _upsert_by_ext_id(db_session, Repo, rows, ['name', 'org_id', 'default_branch'])
+    return _load_by_ext_id(db_session, Repo, upserted)
+
+
 def get_user(db_session, gh_session, user, org=None):
     """
-    Given a github user object (and optionally an Organisation row object), get the user info from github and store it
-    to the DB if it does not already exist
+    Given a github user object (and optionally an Organisation row object), store the user to the DB if it does not
+    already exist. The profile of a new user is not fetched here, so storing commits never waits for it: see
+    enrich_users.
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
@@ -147,25 +365,141 @@ def get_user(db_session, gh_session, user, org=None):
     :return: the User row object associated with the given user
     :rtype: Union[ghstats.orm.orm.User, None]
     """
-    user_row = db_session.query(User).filter(User.ext_id == user['id']).scalar()  # type: User
-    if user_row is not None:
-        if user_row.name != user['login']:
-            user_row.name = user['login']
-        if org is not None and org not in user_row.orgs:
-            user_row.orgs.append(org)
-    else:
-        user_row = User(ext_id=user['id'], name=user['login'])
-        if org is not None:
-            user_row.orgs.append(org)
-        db_session.add(user_row)
-        (user_info,), _ = get_all(gh_session, user_row.url)
-        email = user_info['email']
-        if email is not None:
-            email_row = db_session.query(Email).filter(Email.email == email).scalar()  # type: Email
-            if email_row is None:
-                email_row = Email(email, user_row)
-                db_session.add(email_row)
-    return user_row
+    upserted = _upsert_by_ext_id(db_session, User, [dict(ext_id=user['id'], name=user['login'])], ['name'])
+    user_id, _ = upserted[user['id']]
+    if org is not None:
+        db_session.execute(insert(organisation_user_table).values(
+            org_id=_row_id(db_session, org), user_id=user_id
+        ).on_conflict_do_nothing())
+    return _load_by_ext_id(db_session, User, [user['id']])[0]
+
+
+def _upsert_emails(db_session, rows):
+    """
+    insert the given emails in a single statement. Emails that already exist are linked to the given user if they are
+    not linked to one yet.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param rows: the email address and (optional) user id of each email
+    :type rows: List[Dict[str, Union[str, uuid.UUID, None]]]
+    :return: the id of each email's row and the id of the user it is linked to, keyed by email address
+    :rtype: Dict[str, Tuple[uuid.UUID, Union[uuid.UUID, None]]]
+    """
+    rows = list({row['email']: row for row in rows}.values())
+    if not rows:
+        return {}
+    table = Email.__table__
+    stmt = insert(table).values([dict(row, id=uuid.uuid4()) for row in rows])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.email],
+        set_={'user_id': func.coalesce(table.c.user_id, stmt.excluded.user_id)},
+    ).returning(table.c.email, table.c.id, table.c.user_id)
+    return {email: (email_id, user_id) for email, email_id, user_id in db_session.execute(stmt)}
+
+
+def _fetch_profile(gh_session, login):
+    """
+    fetch the profile of a github user. Safe to call from worker threads as it does not touch the database.
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param login: the login of the user
+    :type login: str
+    :return: the github user object with the user's public email, or None if the user no longer exists
+    :rtype: Union[Dict[str, Union[str, bool, int]], None]
+    :raises IOError: if github fails to return the profile, so it is fetched again by the next run
+    """
+    user_info, status_code = get_all(gh_session, '{}/users/{}'.format(BASE_GH_URL, login))
+    if status_code == 404:
+        return None
+    if status_code != 200 or not user_info:
+        raise IOError('{}: got a {} fetching the profile'.format(login, status_code))
+    return user_info[0]
+
+
+def _relink_commits(db_session, email_ids, refresh_rollups=REFRESH_ROLLUPS):
+    """
+    link the commits made with the given emails that have no author or committer to the users the emails are linked
+    to, refreshing the daily contributions of the days whose authors changed
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param email_ids: the ids of the Email rows
+    :type email_ids: List[uuid.UUID]
+    :param refresh_rollups: whether to refresh the daily contributions of the commits given an author
+    :type refresh_rollups: bool
+    :return: the number of commits given an author and the number given a committer
+    :rtype: Tuple[int, int]
+    """
+    if not email_ids:
+        return 0, 0
+    params = {'email_ids': [str(email_id) for email_id in email_ids]}
+    authored = db_session.execute(RELINK_AUTHORS_QUERY, params).fetchall()
+    committed = db_session.execute(RELINK_COMMITTERS_QUERY, params).rowcount
+    if refresh_rollups:
+        refresh_days(db_session, {(repo_id, day) for repo_id, day in authored})
+    return len(authored), committed
+
+
+def enrich_users(db_session, gh_session, workers=PROFILE_FETCH_WORKERS, batch_size=PROFILE_BATCH_SIZE, identities=None):
+    """
+    fetch the profiles of the users stored without one, `workers` at a time, adding their public emails. Once a batch
+    of profiles is fetched, the emails are linked to their users in bulk, and so are the commits made with them that
+    have no user yet, then the batch is committed, so an interrupted run only fetches the profiles left.
+
+    Profiles github fails to return are left to be fetched by the next run.
+
+    The linked emails are invalidated in the given identity cache, which would otherwise go on resolving commits made
+    with them to no user.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param workers: number of profiles to fetch from github concurrently
+    :type workers: int
+    :param batch_size: number of profiles to fetch per batch
+    :type batch_size: int
+    :param identities: the identity cache commits are being stored with, if any
+    :type identities: Union[ghstats.identity.IdentityCache, None]
+    :return: the number of profiles fetched
+    :rtype: int
+    """
+    fetched, last_id = 0, None
+    fetch = METRICS.bind(partial(_fetch_profile, gh_session))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while True:
+            query = db_session.query(User.id, User.name).filter(User.profile_fetched_at.is_(None))
+            if last_id is not None:
+                query = query.filter(User.id > last_id)
+            batch = query.order_by(User.id).limit(batch_size).all()
+            if not batch:
+                return fetched
+            last_id = batch[-1].id
+            futures = [(user_id, executor.submit(fetch, login)) for user_id, login in batch]
+            done, rows = [], []
+            for user_id, future in futures:
+                try:
+                    user_info = future.result()
+                except IOError as e:
+                    logger.warning(str(e))
+                    continue
+                done.append(user_id)
+                if user_info is not None and user_info.get('email'):
+                    rows.append(dict(email=user_info['email'], user_id=user_id))
+            emails = {email: ids for email, ids in _upsert_emails(db_session, rows).items() if ids[1] is not None}
+            authored, committed = _relink_commits(db_session, [email_id for email_id, _ in emails.values()])
+            if done:
+                db_session.query(User).filter(User.id.in_(done)).update(
+                    {User.profile_fetched_at: func.timezone('utc', func.now())}, synchronize_session=False)
+            db_session.commit()
+            if identities is not None:
+                for email in emails:
+                    identities.invalidate(email=email)
+            fetched += len(done)
+            logger.debug('fetched {} profiles: {} emails, {} commits authored and {} committed linked'.format(
+                len(done), len(rows), authored, committed))
 
 
 def get_users(db_session, gh_session, orgs):
@@ -184,139 +518,519 @@ def get_users(db_session, gh_session, orgs):
     """
     user_rows = []
     for org in orgs:
-        users, _ = get_all(gh_session, '{}/orgs/{}/members'.format(BASE_GH_URL, org.name))
-        for user in users:
-            user_rows.append(get_user(db_session, gh_session, user, org=org))
+        org_id = _row_id(db_session, org)
+        member_ids, member_rows, complete = [], [], True
+        for users, status_code in iter_pages(gh_session, '{}/orgs/{}/members'.format(BASE_GH_URL, org.name)):
+            if status_code != 200:
+                complete = False
+                continue
+            for user in users:
+                _archive(gh_session, org_partition(org.name), 'member', user)
+            member_ids.extend(user['id'] for user in users)
+            member_rows.extend(_store_members(db_session, users))
+        if not complete:
+            logger.warning('{}: could not list every member, none are removed'.format(org.name))
+        _archive(gh_session, org_partition(org.name), 'membership', {'members': member_ids, 'complete': complete})
+        added, removed = _sync_membership(
+            db_session, organisation_user_table.c.org_id, org_id, [row.id for row in member_rows], complete)
+        logger.debug('{}: {} members added, {} removed'.format(org.name, added, removed))
+        user_rows.extend(member_rows)
     return user_rows
 
 
-def get_user_from_email(db_session, email):
+def _store_members(db_session, users):
     """
-    given an email address, see if it's in the database and return the associated user.
+    insert or update the given members of an org. They are not added to the org, which is left to _sync_membership
+    once every member is known, and the profiles of new members are left to enrich_users
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
-    :param email: the email to find the associated User from
-    :type email: str
-    :return: the user associated with the email address, if it exists
-    :rtype: Union[ghstats.orm.orm.User, None]
+    :param users: github user objects
+    :type users: List[Dict[str, Union[str, bool, int]]]
+    :return: the User row objects
+    :rtype: List[ghstats.orm.orm.User]
     """
-    if email is None:
-        return None
-    email_row = db_session.query(Email).filter(Email.email == email).scalar()  # type: Email
-    if email_row is not None:
-        return email_row.user
-    return None
+    upserted = _upsert_by_ext_id(
+        db_session, User, [dict(ext_id=user['id'], name=user['login']) for user in users], ['name'])
+    if not upserted:
+        return []
+    return _load_by_ext_id(db_session, User, upserted)
 
 
-def _get_user_info_from_commit(db_session, gh_session, gh_commit, kind):
+def _get_user_id(db_session, gh_session, identities, user):
     """
-    given a github commit, return the User and Email row objects of either the 'author' or 'committer'
+    get the id of the User row for the given github user object, only going to the database if the user is not in the
+    identity cache or has changed their login
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
     :param gh_session: the requests session with the github api
     :type gh_session: requests.sessions.Session
-    :param gh_commit: github commit object from api
-    :type gh_commit: dict
+    :param identities: the identity cache
+    :type identities: ghstats.identity.IdentityCache
+    :param user: github user object.
+    :type user: Dict[str, Union[str, bool, int]]
+    :return: the id of the User row
+    :rtype: uuid.UUID
+    """
+    cached = identities.get_user(user['id'])
+    if cached is not None and cached[1] == user['login']:
+        return cached[0]
+    user_row = get_user(db_session, gh_session, user)
+    user_id = _row_id(db_session, user_row)
+    identities.put_user(user['id'], user_id, user['login'])
+    return user_id
+
+
+def _get_identity_from_commit(db_session, gh_session, identities, commit, kind):
+    """
+    given a github commit, return the ids of the User and Email rows of either the 'author' or 'committer', creating
+    them if needed. Lookups go through the identity cache, so known identities cost no database queries.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param identities: the identity cache
+    :type identities: ghstats.identity.IdentityCache
+    :param commit: the record of the github commit
+    :type commit: ghstats.records.CommitRecord
     :param kind: one of 'author' or 'committer'
     :type kind: str
-    :return: A User row object (if it exists or can be inferred) and an Email row object
-    :rtype: Tuple[ghstats.orm.orm.User, ghstats.orm.orm.Email]
-    """
-    email = gh_commit['commit'][kind]['email']
-    gh_user = gh_commit[kind]
-    email_row = None
-    if email:
-        email_row = db_session.query(Email).filter(Email.email == email).scalar()
-        if email_row is None:
-            email_row = Email(email)
-            db_session.add(email_row)
-    if gh_user is not None:
-        user_row = get_user(db_session, gh_session, gh_user)
-        if email_row is not None and email_row.user_id is None:
-            email_row.user = user_row
+    :return: the id of the User row (if it exists or can be inferred) and the id of the Email row
+    :rtype: Tuple[Union[uuid.UUID, None], Union[uuid.UUID, None]]
+    """
+    email = getattr(commit, '{}_email'.format(kind))
+    gh_user = getattr(commit, kind)
+    user_id = _get_user_id(db_session, gh_session, identities, gh_user) if gh_user is not None else None
+    if not email:
+        return user_id, None
+    cached = identities.get_email(email)
+    if cached is None or (cached[1] is None and user_id is not None):
+        cached = _upsert_emails(db_session, [dict(email=email, user_id=user_id)])[email]
+        identities.put_email(email, *cached)
+    email_id, email_user_id = cached
+    return (user_id if gh_user is not None else email_user_id), email_id
+
+
+def _fetch_commit(gh_session, repo_url, listed, partition=None):
+    """
+    fetch the full github commit object (including stats and files) for a listed commit, archive it and project it onto
+    a record, dropping the rest of the payload. Safe to call from worker threads as it does not touch the database.
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param repo_url: the github api url of the repo the commit belongs to
+    :type repo_url: str
+    :param listed: the sha of the commit and the record it was listed with
+    :type listed: Tuple[bytes, Union[ghstats.records.CommitRecord, None]]
+    :param partition: the archive partition of the repo (see _archive_commit), or None to not archive the commit
+    :type partition: Union[Tuple[str, ...], None]
+    :return: the sha and the record of the commit
+    :rtype: Tuple[bytes, ghstats.records.CommitRecord]
+    """
+    commit_sha, _ = listed
+    (commit,), _ = get_all(gh_session, '{}/commits/{}'.format(repo_url, commit_sha.hex()))
+    _archive_commit(gh_session, partition, commit)
+    return commit_sha, commit_record(commit)
+
+
+def _row_id(db_session, row):
+    """
+    get the primary key of a row object, flushing the session first if the row has not been inserted yet
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param row: the row object, if any
+    :type row: Union[ghstats.orm.GHDBase, None]
+    :return: the primary key of the row
+    :rtype: Union[uuid.UUID, None]
+    """
+    if row is None:
+        return None
+    if row.id is None:
+        db_session.flush()
+    return row.id
+
+
+def _store_commit(db_session, gh_session, writer, identities, repo_id, commit_sha, commit):
+    """
+    buffer the given github commit and its file changes to be written to the database
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param writer: the writer buffering new commits
+    :type writer: ghstats.writer.CommitWriter
+    :param identities: the identity cache
+    :type identities: ghstats.identity.IdentityCache
+    :param repo_id: the id of the repo the commit belongs to
+    :type repo_id: uuid.UUID
+    :param commit_sha: the sha of the commit
+    :type commit_sha: bytes
+    :param commit: the record of the github commit
+    :type commit: ghstats.records.CommitRecord
+    """
+    committer_id, committer_email_id = _get_identity_from_commit(
+        db_session, gh_session, identities, commit, 'committer')
+    author_id, author_email_id = _get_identity_from_commit(db_session, gh_session, identities, commit, 'author')
+    writer.add(
+        dict(
+            name=commit.message,
+            sha=commit_sha,
+            repo_id=repo_id,
+            additions=commit.additions,
+            deletions=commit.deletions,
+            committer_id=committer_id,
+            committer_email_id=committer_email_id,
+            committed_at=commit.committed_at,
+            author_id=author_id,
+            author_email_id=author_email_id,
+            authored_at=commit.authored_at,
+        ),
+        [
+            dict(
+                filename=file.filename,
+                status=file.status,
+                additions=file.additions,
+                deletions=file.deletions,
+            )
+            for file in commit.files
+        ],
+        list(commit.parents),
+    )
+
+
+def _get_sync_state(db_session, repo, branch):
+    """
+    get or create the SyncState row object for the given branch of the repo
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param repo: the Repo row object
+    :type repo: ghstats.orm.orm.Repo
+    :param branch: the name of the branch
+    :type branch: str
+    :return: the SyncState row object
+    :rtype: ghstats.orm.orm.SyncState
+    """
+    sync_state = db_session.query(SyncState).filter(
+        SyncState.repo_id == repo.id, SyncState.branch == branch
+    ).scalar()  # type: SyncState
+    if sync_state is None:
+        sync_state = SyncState(repo=repo, branch=branch)
+        db_session.add(sync_state)
+    return sync_state
+
+
+def _list_commits_url(repo_url, branch):
+    """
+    build the url listing the commits of a branch. It is not limited with since: github filters on the commit date, so
+    commits merged after the last sync but dated before it would be left out, and the listing is only read until every
+    line of history reaches a known commit anyway (see _walk_new_commits)
+
+    :param repo_url: the github api url of the repo
+    :type repo_url: str
+    :param branch: the name of the branch, or None for the default branch
+    :type branch: Union[str, None]
+    :return: the url of the commit listing
+    :rtype: str
+    """
+    params = {'per_page': HISTORY_PAGE_SIZE}
+    if branch is not None:
+        params['sha'] = branch
+    return '{}/commits?{}'.format(repo_url, urlencode(params))
+
+
+def _list_commits(gh_session, repo, branch, backend, partition=None):
+    """
+    list the commits of a branch, newest first, from its head (see _list_commits_url)
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param repo: the Repo row object
+    :type repo: ghstats.orm.orm.Repo
+    :param branch: the name of the branch, or None for the default branch
+    :type branch: Union[str, None]
+    :param backend: 'rest' to list commit summaries (without stats or files), 'graphql' to list commits with stats
+    :type backend: str
+    :param partition: the archive partition of the repo to add each listed commit to, when the commits are not fetched
+        in full. The known commits listed with the new ones are archived again, which reingesting skips
+    :type partition: Union[Tuple[str, ...], None]
+    :return: an iterator of the records of the commits
+    :rtype: Iterator[ghstats.records.CommitRecord]
+    """
+    if backend == 'graphql':
+        listing = iter_history(gh_session, repo.org.name, repo.name, branch=branch)
+    elif backend == 'rest':
+        listing = iter_all(gh_session, _list_commits_url(repo.url, branch))
     else:
-        user_row = get_user_from_email(db_session, email)
-    return user_row, email_row
+        raise ValueError('unknown commit backend: {}'.format(backend))
+    # an empty repo lists an error message instead of commits
+    for c in listing:
+        if 'sha' in c:
+            _archive_commit(gh_session, partition, c)
+            yield commit_record(c)
 
 
-def get_author(db_session, gh_session, gh_commit):
+def _new_commits(db_session, gh_session, repo, repo_id, branch, sync_state, backend, listed, partition=None):
     """
-    given a github commit, return the User and Email row objects of the author
+    list the commits of a branch that are not in the database yet, newest first, walking back from its head until
+    every line of history reaches a known commit (see _walk_new_commits).
+
+    The head the branch had when it was last synced counts as known, but the listing does not stop there: it is in
+    commit date order, so the commits of a branch merged since then are listed after the previous head when they are
+    dated before it.
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
     :param gh_session: the requests session with the github api
     :type gh_session: requests.sessions.Session
-    :param gh_commit: github commit object from api
-    :type gh_commit: dict
-    :return: A User row object (if it exists or can be inferred) and an Email row object
-    :rtype: Tuple[ghstats.orm.orm.User, ghstats.orm.orm.Email]
+    :param repo: the Repo row object
+    :type repo: ghstats.orm.orm.Repo
+    :param repo_id: the id of the Repo row
+    :type repo_id: uuid.UUID
+    :param branch: the name of the branch, or None for the default branch
+    :type branch: Union[str, None]
+    :param sync_state: the SyncState row object of the branch, if there is one
+    :type sync_state: Union[ghstats.orm.orm.SyncState, None]
+    :param backend: how to list commits: 'rest' or 'graphql'
+    :type backend: str
+    :param listed: an empty list, to which the sha of the newest commit listed is added
+    :type listed: List[bytes]
+    :param partition: the archive partition to add the listed commits to, if they are not fetched in full
+    :type partition: Union[Tuple[str, ...], None]
+    :return: an iterator of the sha and the listed record of each new commit
+    :rtype: Iterator[Tuple[bytes, ghstats.records.CommitRecord]]
+    """
+    seen, index = set(), None
+    if sync_state is not None and sync_state.head_sha is not None:
+        seen.add(bytes(sync_state.head_sha))
+    else:
+        # without a previous head the whole history is walked, most of which is usually already stored
+        index = ShaIndex.load(db_session, repo_id)
+    listing = _list_commits(gh_session, repo, branch, backend, partition)
+    return _walk_new_commits(db_session, listing, seen, listed, index)
+
+
+def _known_shas(db_session, shas):
+    """
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param shas: the commit shas to look up
+    :type shas: List[bytes]
+    :return: the shas of the given commits that are already in the database
+    :rtype: Set[bytes]
+    """
+    if not shas:
+        return set()
+    return {bytes(sha) for sha, in db_session.query(Commit.sha).filter(Commit.sha.in_(shas))}
+
+
+def _get_refs(db_session, repo_id):
+    """
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param repo_id: the id of the Repo row
+    :type repo_id: uuid.UUID
+    :return: the sha of the head of each ref of the repo (None if the head is not known), keyed by ref name
+    :rtype: Dict[str, Union[bytes, None]]
     """
-    return _get_user_info_from_commit(db_session, gh_session, gh_commit, 'author')
+    refs = db_session.query(Ref.name, Commit.sha).outerjoin(Commit, Ref.head_id == Commit.id).filter(
+        Ref.repo_id == repo_id)
+    return {name: bytes(sha) if sha is not None else None for name, sha in refs}
 
 
-def get_committer(db_session, gh_session, gh_commit):
+def _update_refs(db_session, repo_id, heads, prune=True):
     """
-    given a github commit, return the User and Email row objects of the committer
+    record the head commit of the given refs of a repo. Heads are looked up by sha, so they must be written first.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param repo_id: the id of the Repo row
+    :type repo_id: uuid.UUID
+    :param heads: the sha of the head of each ref, keyed by ref name
+    :type heads: Dict[str, bytes]
+    :param prune: whether to delete the refs of the repo that are not in heads
+    :type prune: bool
+    """
+    table = Ref.__table__
+    for name, sha in heads.items():
+        head = select([literal(repo_id, UUID(as_uuid=True)), literal(name), Commit.id]).where(Commit.sha == sha)
+        stmt = insert(table).from_select(['repo_id', 'name', 'head_id'], head)
+        stmt = stmt.on_conflict_do_update(
+            constraint='unique_ref_name_per_repo', set_={'head_id': stmt.excluded.head_id})
+        db_session.execute(stmt)
+    if prune:
+        db_session.query(Ref).filter(Ref.repo_id == repo_id, Ref.name.notin_(list(heads))).delete(
+            synchronize_session=False)
+
+
+def _walk_new_commits(db_session, commits, seen, listed, index=None):
+    """
+    go through the commits listed from a ref head, newest first, yielding the ones not yet stored. Only commits that
+    are reachable from the head without passing through a known commit are considered, and the walk stops as soon as
+    every line of history has reached a known commit, so it costs requests in proportion to the new commits rather
+    than to the length of the history.
+
+    The listing must never return a commit before its children, which holds for the history listings of github.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param commits: the history of the ref, newest first, with the parents of each commit
+    :type commits: Iterable[ghstats.records.CommitRecord]
+    :param seen: the shas of commits already stored (or being stored) this sync. New commits are added to it
+    :type seen: Set[bytes]
+    :param listed: the sha of the head of the ref is appended to this once the first commit is listed
+    :type listed: List[bytes]
+    :param index: the index of the commits of the repo to look up listed commits in before the database, if any
+    :type index: Union[ghstats.shaindex.ShaIndex, None]
+    :return: an iterator of the sha and the listed record of each new commit
+    :rtype: Iterator[Tuple[bytes, ghstats.records.CommitRecord]]
+    """
+    commits = iter(commits)
+    frontier = None
+    while frontier is None or frontier:
+        batch = [(c.sha, c) for c in islice(commits, HISTORY_PAGE_SIZE)]
+        if not batch:
+            return
+        if frontier is None:
+            listed.append(batch[0][0])
+            frontier = {batch[0][0]}
+        unseen = [sha for sha, _ in batch if sha not in seen]
+        known = index.known(db_session, unseen) if index is not None else _known_shas(db_session, unseen)
+        for sha, c in batch:
+            if not frontier:
+                return
+            if sha not in frontier:
+                continue
+            frontier.discard(sha)
+            if sha in seen or sha in known:
+                continue
+            seen.add(sha)
+            frontier.update(c.parents)
+            yield sha, c
+
+
+def _sync_branches(db_session, gh_session, executor, writer, identities, repo, workers, backend, fetch_details):
+    """
+    store the new commits of every branch of the repo whose head has moved since it was last synced, then record the
+    heads in refs. Commits shared between branches are only listed until the first known one, and never fetched twice.
 
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
     :param gh_session: the requests session with the github api
     :type gh_session: requests.sessions.Session
-    :param gh_commit: github commit object from api
-    :type gh_commit: dict
-    :return: A User row object (if it exists or can be inferred) and an Email row object
-    :rtype: Tuple[ghstats.orm.orm.User, ghstats.orm.orm.Email]
+    :param executor: the thread pool to fetch commit details in
+    :type executor: concurrent.futures.Executor
+    :param writer: the writer buffering new commits
+    :type writer: ghstats.writer.CommitWriter
+    :param identities: the identity cache
+    :type identities: ghstats.identity.IdentityCache
+    :param repo: the Repo row object
+    :type repo: ghstats.orm.orm.Repo
+    :param workers: number of commit details to fetch from github concurrently
+    :type workers: int
+    :param backend: how to list commits: 'rest' or 'graphql'
+    :type backend: str
+    :param fetch_details: whether to fetch the details of each commit
+    :type fetch_details: bool
     """
-    return _get_user_info_from_commit(db_session, gh_session, gh_commit, 'committer')
+    repo_id = _row_id(db_session, repo)
+    partition = repo_partition(repo.org.name, repo.name)
+    known_heads = _get_refs(db_session, repo_id)
+    heads = {branch['name']: bytes.fromhex(branch['commit']['sha'])
+             for branch in iter_all(gh_session, '{}/branches'.format(repo.url))}
+    seen = set()
+    for name in sorted(heads, key=lambda branch: branch != repo.default_branch):
+        if known_heads.get(name) == heads[name]:
+            continue
+        listed, stored = [], len(seen)
+        listing = _list_commits(gh_session, repo, name, backend, None if fetch_details else partition)
+        commits = _walk_new_commits(db_session, listing, seen, listed)
+        if fetch_details:
+            fetch = METRICS.bind(partial(_fetch_commit, gh_session, repo.url, partition=partition))
+            commits = bounded_map(executor, fetch, commits, max(workers, 1))
+        for commit_sha, commit in commits:
+            _store_commit(db_session, gh_session, writer, identities, repo_id, commit_sha, commit)
+        if listed:
+            heads[name] = listed[0]
+        logger.debug('{}/{}: {} new commits on {}'.format(repo.org.name, repo.name, len(seen) - stored, name))
+    writer.flush()
+    _update_refs(db_session, repo_id, heads)
+    db_session.commit()
 
 
-def get_commits(db_session, gh_session, repos):
+def get_commits(db_session, gh_session, repos, workers=COMMIT_FETCH_WORKERS, identities=None, backend=COMMIT_BACKEND,
+                fetch_files=COMMIT_FILES, branches=COMMIT_BRANCHES):
     """
     given a list of Repo row object get all associated commits and file changes (on the default branch) for each repo.
 
+    The default branch (and with branches='all', every branch whose head differs from the one recorded in refs) is
+    walked back from its head until each line of history reaches a known commit (see _walk_new_commits), so commits
+    merged since the last sync are picked up whatever their dates.
+
+    With the 'rest' backend the details of each commit are fetched one request at a time. With the 'graphql' backend
+    commits are listed with their stats 100 at a time, and details are only fetched to get the files changed (if
+    fetch_files).
+
+    Commit details are fetched from github by a pool of `workers` threads, while all database work happens on the
+    calling thread in the order the commits were listed. New commits are written in batches by a CommitWriter.
+
     :param db_session: the database session
     :type db_session: sqlalchemy.orm.session.Session
     :param gh_session: the requests session with the github api
     :type gh_session: requests.sessions.Session
     :param repos: list of Repo row objects
     :type repos: List[ghstats.orm.orm.Repo]
+    :param workers: number of commit details to fetch from github concurrently
+    :type workers: int
+    :param identities: the identity cache to resolve authors and committers with. A preloaded one is created if None
+    :type identities: Union[ghstats.identity.IdentityCache, None]
+    :param backend: how to list commits: 'rest' or 'graphql'
+    :type backend: str
+    :param fetch_files: whether to fetch the files changed by each commit when the backend does not list them
+    :type fetch_files: bool
+    :param branches: which branches to sync: 'default' or 'all'
+    :type branches: str
+    :return: the number of new commits stored
+    :rtype: int
     """
-    for repo in repos:
-        get_commit_q = db_session.query(Commit.sha).filter(Commit.repo_id == repo.id)
-        existing_commits = {commit.sha for commit in get_commit_q.all()}
-        commits, _ = get_all(gh_session, '{}/commits'.format(repo.url))
-        new_commits = (sha for sha in (c['sha'].encode() for c in commits if 'sha' in c) if sha not in existing_commits)
-        for commit_sha in new_commits:
-            exists = db_session.query(Commit.sha).filter(Commit.sha == commit_sha).scalar()
-            if exists:
-                continue
-            (commit,), _ = get_all(gh_session, '{}/commits/{}'.format(repo.url, commit_sha.decode()))
-            committer, committer_email = get_committer(db_session, gh_session, commit)
-            author, author_email = get_author(db_session, gh_session, commit)
-            new_commit = Commit(
-                name=commit['commit']['message'],
-                sha=commit_sha,
-                repo=repo,
-                additions=commit['stats']['additions'],
-                deletions=commit['stats']['deletions'],
-                committer=committer,
-                committer_email=committer_email,
-                committed_at=parse_gh_date(commit['commit']['committer']['date']),
-                author=author,
-                author_email=author_email,
-                authored_at=parse_gh_date(commit['commit']['author']['date']),
-            )
-            db_session.add(new_commit)
-            for file in commit['files']:
-                new_file = File(
-                    commit=new_commit,
-                    filename=file['filename'],
-                    status=file['status'],
-                    additions=file['additions'],
-                    deletions=file['deletions'],
-                )
-                db_session.add(new_file)
-            db_session.commit()
+    if branches not in ('default', 'all'):
+        raise ValueError('unknown branches to sync: {}'.format(branches))
+    fetch_details = backend == 'rest' or fetch_files
+    if identities is None:
+        identities = IdentityCache().preload(db_session)
+    writer = CommitWriter(db_session, archive=gh_session.archive)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor, writer:
+        for repo in repos:
+            with METRICS.labels(repo='{}/{}'.format(repo.org.name, repo.name)):
+                if branches == 'all':
+                    _sync_branches(db_session, gh_session, executor, writer, identities, repo, workers, backend,
+                                   fetch_details)
+                    continue
+                repo_id = _row_id(db_session, repo)
+                repo_url = repo.url
+                partition = repo_partition(repo.org.name, repo.name)
+                branch = repo.default_branch
+                sync_state = _get_sync_state(db_session, repo, branch) if branch is not None else None
+                listed = []
+                last_commit_at = sync_state.last_commit_at if sync_state is not None else None
+                commits = _new_commits(db_session, gh_session, repo, repo_id, branch, sync_state, backend, listed,
+                                       None if fetch_details else partition)
+                if fetch_details:
+                    fetch = METRICS.bind(partial(_fetch_commit, gh_session, repo_url, partition=partition))
+                    commits = bounded_map(executor, fetch, commits, max(workers, 1))
+                for commit_sha, commit in commits:
+                    _store_commit(db_session, gh_session, writer, identities, repo_id, commit_sha, commit)
+                    if last_commit_at is None or commit.committed_at > last_commit_at:
+                        last_commit_at = commit.committed_at
+                if sync_state is not None and listed:
+                    sync_state.head_sha = listed[0]
+                    sync_state.last_commit_at = last_commit_at
+                writer.flush()
+                if branch is not None and listed:
+                    _update_refs(db_session, repo_id, {branch: listed[0]}, prune=False)
+                    db_session.commit()
+    return writer.commits_written
@@ -0,0 +1,159 @@
+import logging
+from datetime import datetime, timezone
+
+from ghstats.config import GRAPHQL_URL
+from ghstats.utils import format_gh_date, decode_json
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 100
+
+_ACTOR_FIELDS = 'email date user { databaseId login }'
+_HISTORY_FIELDS = '''
+history(first: $first, since: $since, after: $cursor) {
+  pageInfo { hasNextPage endCursor }
+  nodes {
+    oid
+    message
+    parents(first: 100) { nodes { oid } }
+    additions
+    deletions
+    author { %s }
+    committer { %s }
+  }
+}
+''' % (_ACTOR_FIELDS, _ACTOR_FIELDS)
+
+BRANCH_HISTORY_QUERY = '''
+query($owner: String!, $name: String!, $branch: String!, $first: Int!, $since: GitTimestamp, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    ref(qualifiedName: $branch) { target { ... on Commit { %s } } }
+  }
+}
+''' % _HISTORY_FIELDS
+
+DEFAULT_BRANCH_HISTORY_QUERY = '''
+query($owner: String!, $name: String!, $first: Int!, $since: GitTimestamp, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    ref: defaultBranchRef { target { ... on Commit { %s } } }
+  }
+}
+''' % _HISTORY_FIELDS
+
+
+class GraphQLError(Exception):
+    def __init__(self, errors):
+        super().__init__('; '.join(error.get('message', str(error)) for error in errors))
+        self.errors = errors
+
+
+def query(gh_session, document, variables, url=GRAPHQL_URL):
+    """
+    run a query against the github graphql api
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param document: the graphql query
+    :type document: str
+    :param variables: the variables of the query
+    :type variables: Dict[str, Any]
+    :param url: the graphql endpoint
+    :type url: str
+    :return: the data returned by the query
+    :rtype: dict
+    """
+    response = gh_session.post(url, json={'query': document, 'variables': variables})
+    response.raise_for_status()
+    resp = decode_json(response)
+    if resp.get('errors'):
+        raise GraphQLError(resp['errors'])
+    return resp['data']
+
+
+def _utc_date(date):
+    """
+    convert a graphql GitTimestamp (which carries the committer's utc offset) to the utc format of the rest api
+
+    :param date: a timestamp in ISO 8601 format with a utc offset, eg 2016-06-19T17:26:57+10:00
+    :type date: str
+    :return: a timestamp in ISO 8601 format: YYYY-MM-DDTHH:MM:SSZ
+    :rtype: str
+    """
+    parsed = datetime.fromisoformat(date.replace('Z', '+00:00'))
+    return format_gh_date(parsed.astimezone(timezone.utc))
+
+
+def _user(actor):
+    user = actor.get('user')
+    if user is None:
+        return None
+    return {'id': user['databaseId'], 'login': user['login']}
+
+
+def to_rest_commit(node):
+    """
+    convert a commit from the graphql history connection into the shape of a commit from the rest api. The 'files' of
+    the commit are left empty as graphql does not provide them.
+
+    :param node: a commit node from the graphql api
+    :type node: dict
+    :return: github commit object as returned by the rest api
+    :rtype: dict
+    """
+    return {
+        'sha': node['oid'],
+        'parents': [{'sha': parent['oid']} for parent in node['parents']['nodes']],
+        'commit': {
+            'message': node['message'],
+            'author': {'email': node['author']['email'], 'date': _utc_date(node['author']['date'])},
+            'committer': {'email': node['committer']['email'], 'date': _utc_date(node['committer']['date'])},
+        },
+        'author': _user(node['author']),
+        'committer': _user(node['committer']),
+        'stats': {'additions': node['additions'], 'deletions': node['deletions']},
+        'files': [],
+    }
+
+
+def iter_history(gh_session, owner, name, branch=None, since=None, page_size=HISTORY_PAGE_SIZE, url=GRAPHQL_URL):
+    """
+    go through the history of a branch, newest first, yielding each commit (with its stats, but without files) in the
+    shape of the rest api
+
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param owner: the login of the org owning the repo
+    :type owner: str
+    :param name: the name of the repo
+    :type name: str
+    :param branch: the name of the branch, or None for the default branch
+    :type branch: Union[str, None]
+    :param since: only list commits since this time
+    :type since: Union[datetime.datetime, None]
+    :param page_size: number of commits to get per request (at most 100)
+    :type page_size: int
+    :param url: the graphql endpoint
+    :type url: str
+    :return: an iterator of github commit objects
+    :rtype: Iterator[dict]
+    """
+    variables = {'owner': owner, 'name': name, 'first': page_size, 'cursor': None}
+    if since is not None:
+        variables['since'] = format_gh_date(since)
+    if branch is not None:
+        document = BRANCH_HISTORY_QUERY
+        variables['branch'] = 'refs/heads/{}'.format(branch)
+    else:
+        document = DEFAULT_BRANCH_HISTORY_QUERY
+    while True:
+        data = query(gh_session, document, variables, url)
+        ref = (data['repository'] or {}).get('ref')
+        if ref is None or not ref.get('target'):
+            logger.warning('{}/{}: no history found for {}'.format(owner, name, branch or 'the default branch'))
+            return
+        history = ref['target']['history']
+        for node in history['nodes']:
+            yield to_rest_commit(node)
+        if not history['pageInfo']['hasNextPage']:
+            return
+        variables['cursor'] = history['pageInfo']['endCursor']
@@ -0,0 +1,125 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from ghstats.config import IDENTITY_CACHE_SIZE
+from ghstats.orm.orm import Email, User
+
+logger = logging.getLogger(__name__)
+
+
+class IdentityCache(object):
+    """
+    A bounded, least recently used, in-process cache of the email and user identities seen in commits, so resolving
+    the author and committer of a commit does not have to query the database every time.
+
+    Emails are keyed by address and map to (email id, user id). Users are keyed by github id (ext_id) and map to
+    (user id, login). Whoever inserts or changes one of these rows is responsible for putting it back in the cache (or
+    invalidating it).
+    """
+
+    def __init__(self, max_size=IDENTITY_CACHE_SIZE):
+        """
+        :param max_size: maximum number of emails and of users to keep
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._emails = OrderedDict()
+        self._users = OrderedDict()
+
+    def preload(self, db_session):
+        """
+        fill the cache with the emails and users already in the database, up to max_size of each
+
+        :param db_session: the database session
+        :type db_session: sqlalchemy.orm.session.Session
+        :return: self
+        :rtype: IdentityCache
+        """
+        for email_id, email, user_id in db_session.query(Email.id, Email.email, Email.user_id).limit(self.max_size):
+            self.put_email(email, email_id, user_id)
+        for user_id, ext_id, name in db_session.query(User.id, User.ext_id, User.name).limit(self.max_size):
+            self.put_user(ext_id, user_id, name)
+        logger.debug('preloaded {} emails and {} users'.format(len(self._emails), len(self._users)))
+        return self
+
+    @staticmethod
+    def _get(store, key):
+        value = store.get(key)
+        if value is not None:
+            store.move_to_end(key)
+        return value
+
+    def _put(self, store, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_size:
+            store.popitem(last=False)
+
+    def get_email(self, email):
+        """
+        :param email: the email address
+        :type email: str
+        :return: the id of the Email row and the id of its User, if the email is cached
+        :rtype: Union[Tuple[uuid.UUID, Union[uuid.UUID, None]], None]
+        """
+        with self._lock:
+            return self._get(self._emails, email)
+
+    def put_email(self, email, email_id, user_id):
+        """
+        :param email: the email address
+        :type email: str
+        :param email_id: the id of the Email row
+        :type email_id: uuid.UUID
+        :param user_id: the id of the User the email belongs to, if known
+        :type user_id: Union[uuid.UUID, None]
+        """
+        with self._lock:
+            self._put(self._emails, email, (email_id, user_id))
+
+    def get_user(self, ext_id):
+        """
+        :param ext_id: the github id of the user
+        :type ext_id: int
+        :return: the id of the User row and the login it was stored with, if the user is cached
+        :rtype: Union[Tuple[uuid.UUID, str], None]
+        """
+        with self._lock:
+            return self._get(self._users, ext_id)
+
+    def put_user(self, ext_id, user_id, name):
+        """
+        :param ext_id: the github id of the user
+        :type ext_id: int
+        :param user_id: the id of the User row
+        :type user_id: uuid.UUID
+        :param name: the login the user is stored with
+        :type name: str
+        """
+        with self._lock:
+            self._put(self._users, ext_id, (user_id, name))
+
+    def invalidate(self, email=None, ext_id=None):
+        """
+        forget the given email and/or user, so the next lookup goes to the database
+
+        :param email: the email address to forget
+        :type email: Union[str, None]
+        :param ext_id: the github id of the user to forget
+        :type ext_id: Union[int, None]
+        """
+        with self._lock:
+            if email is not None:
+                self._emails.pop(email, None)
+            if ext_id is not None:
+                self._users.pop(ext_id, None)
+
+    def clear(self):
+        """
+        forget everything
+        """
+        with self._lock:
+            self._emails.clear()
+            self._users.clear()
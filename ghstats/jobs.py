@@ -0,0 +1,499 @@
+"""
+A work queue kept in the jobs table, so a sync can be spread over any number of `ghstats worker` processes on any
+number of hosts, and a run that crashed carries on from the queue instead of listing everything again.
+
+Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so no two workers ever claim the same job, and hold them on a
+lease that a background thread renews (along with the job's progress) while the job runs. A job whose worker died is
+claimed again once its lease expires, and a job whose lease could not be renewed is stopped at its next commit, so two
+workers never both write its work. A job that fails is retried with an exponential backoff until it has been attempted
+max_attempts times. A job is marked done in the same transaction as the last of its work.
+
+The kinds of job are:
+    members {org_id}: sync the members and teams of an org
+    repos {org_id}: sync the repos of an org and queue a commits job for each
+    commits {repo_id}: list the new commits of a repo and queue commit_details jobs for them, in batches
+    commit_details {repo_id, shas}: fetch and store a batch of commits
+    parents {links}: link commits to parents that were not stored yet when the commits were
+    profiles {}: fetch the profiles of the users stored without one, queued by the members and commit_details jobs
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from sqlalchemy import event, text, func, null
+from sqlalchemy.dialects.postgresql import insert
+
+from ghstats.archive import repo_partition
+from ghstats.config import COMMIT_BACKEND, COMMIT_BRANCHES, COMMIT_FILES, COMMIT_FETCH_WORKERS, WORKER_THREADS, \
+    JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, JOB_POLL_INTERVAL, COMMIT_DETAILS_BATCH, HTTP_POOL_SIZE, \
+    organisations
+from ghstats.gh import get_orgs, get_users, get_teams, get_repos, get_commits, _get_sync_state, _new_commits, \
+    _fetch_commit, _store_commit, _row_id, _update_refs, enrich_users
+from ghstats.identity import IdentityCache
+from ghstats.metrics import METRICS
+from ghstats.mirror import ingest_repo
+from ghstats.orm.orm import Job, Organisation, Repo
+from ghstats.session import SessionManager, get_session_maker, get_engine, get_gh_session
+from ghstats.shaindex import ShaIndex
+from ghstats.utils import bounded_map
+from ghstats.writer import CommitWriter
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('pending', 'running', 'done', 'failed')
+
+CLAIM_QUERY = text('''
+UPDATE jobs SET status = 'running', attempts = attempts + 1, leased_by = :worker,
+    lease_expires_at = timezone('utc', now()) + make_interval(secs => :lease)
+WHERE id = (
+    SELECT id FROM jobs
+    WHERE ((status = 'pending' AND run_after <= timezone('utc', now()))
+           OR (status = 'running' AND lease_expires_at < timezone('utc', now())))
+        AND attempts < max_attempts
+        AND kind = ANY(CAST(:kinds AS TEXT[]))
+    ORDER BY run_after, id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, kind, payload, attempts, max_attempts
+''')
+# jobs whose last attempt's lease expired can not be claimed again
+EXPIRE_QUERY = text('''
+UPDATE jobs SET status = 'failed', error = 'the lease of the last attempt expired', finished_at = timezone('utc', now())
+WHERE status = 'running' AND lease_expires_at < timezone('utc', now()) AND attempts >= max_attempts
+''')
+RENEW_QUERY = text('''
+UPDATE jobs SET lease_expires_at = timezone('utc', now()) + make_interval(secs => :lease),
+    progress = CAST(:progress AS JSONB)
+WHERE id = :id AND leased_by = :worker AND attempts = :attempts AND status = 'running'
+''')
+COMPLETE_QUERY = text('''
+UPDATE jobs SET status = 'done', progress = CAST(:progress AS JSONB), error = NULL,
+    finished_at = timezone('utc', now())
+WHERE id = :id AND leased_by = :worker AND attempts = :attempts AND status = 'running'
+''')
+FAIL_QUERY = text('''
+UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+    run_after = timezone('utc', now()) + make_interval(secs => :delay * 2 ^ (attempts - 1)),
+    progress = CAST(:progress AS JSONB), error = :error, lease_expires_at = NULL,
+    finished_at = CASE WHEN attempts >= max_attempts THEN timezone('utc', now()) END
+WHERE id = :id AND leased_by = :worker AND attempts = :attempts AND status = 'running'
+''')
+
+HANDLERS = {}
+
+# a single job for every profile left to fetch, so however many jobs queue it, the profiles are fetched in batches
+PROFILES_JOB = ('profiles', 'profiles', {})
+
+# the identity cache of this worker process, preloaded on first use and cleared whenever a job is rolled back
+_identities = None
+_identities_lock = threading.Lock()
+
+
+class RetryLater(Exception):
+    """
+    raised by a job that can not finish yet, to be attempted again after the backoff without logging a failure
+    """
+
+
+class LeaseLost(Exception):
+    """
+    raised when a job's lease has expired before the job finished, as another worker may be running it by now
+    """
+
+
+class Lease(object):
+    """
+    A job claimed by a worker. The job reports its progress with report(), which is saved with each lease renewal, and
+    should check() that it still holds the lease between batches of work.
+    """
+
+    def __init__(self, job_id, kind, payload, attempts, max_attempts, worker):
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.worker = worker
+        self.progress = {}
+        self.lost = False
+
+    @property
+    def last_attempt(self):
+        return self.attempts >= self.max_attempts
+
+    def report(self, **progress):
+        """
+        record the progress of the job, eg lease.report(commits=120)
+        """
+        self.progress = dict(self.progress, **progress)
+
+    def check(self):
+        """
+        :raises LeaseLost: if the lease could not be renewed, so the job must stop without committing anything more
+        """
+        if self.lost:
+            raise LeaseLost('job {} ({}): lost its lease'.format(self.id, self.kind))
+
+    def params(self, **params):
+        # a job claimed again by the same worker is told apart by its attempts
+        return dict(params, id=self.id, worker=self.worker, attempts=self.attempts, progress=json.dumps(self.progress))
+
+
+def handler(kind):
+    """
+    register the function that runs the jobs of a kind. It is called with the database session, the github session
+    and the Lease of the job.
+    """
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(db_session, jobs, max_attempts=JOB_MAX_ATTEMPTS, delay=0):
+    """
+    add jobs to the queue in a single statement. A job whose key is already queued or running is left as it is, and
+    one whose key is done or failed is queued again.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param jobs: the kind, key and payload of each job
+    :type jobs: Iterable[Tuple[str, str, dict]]
+    :param max_attempts: number of times to attempt each job before giving up on it
+    :type max_attempts: int
+    :param delay: number of seconds to wait before the jobs can be claimed
+    :type delay: float
+    :return: the number of jobs queued
+    :rtype: int
+    """
+    rows = list({key: dict(kind=kind, key=key, payload=payload, max_attempts=max_attempts)
+                 for kind, key, payload in jobs}.values())
+    if not rows:
+        return 0
+    table = Job.__table__
+    run_after = func.timezone('utc', func.now()) + func.make_interval(0, 0, 0, 0, 0, 0, delay)
+    stmt = insert(table).values([dict(row, run_after=run_after) for row in rows])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.key],
+        set_=dict(status='pending', payload=stmt.excluded.payload, attempts=0, max_attempts=stmt.excluded.max_attempts,
+                  run_after=stmt.excluded.run_after, progress=null(), error=None, finished_at=None),
+        where=table.c.status.in_(('done', 'failed')),
+    )
+    return db_session.execute(stmt).rowcount
+
+
+def enqueue_sync(db_session, gh_session, org_names=None):
+    """
+    queue a sync of the given orgs: the members and teams, and the repos (and so the commits) of each
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param org_names: list of organisation login names, the configured ones if None
+    :type org_names: Union[List[str], None]
+    :return: the number of jobs queued
+    :rtype: int
+    """
+    org_names = organisations() if org_names is None else org_names
+    orgs = [org for org in get_orgs(db_session, gh_session, org_names) if org.name in org_names]
+    return enqueue(db_session, [
+        (kind, '{}:{}'.format(kind, org.id), {'org_id': str(org.id)})
+        for org in orgs for kind in ('members', 'repos')
+    ])
+
+
+def claim(db_session, worker, kinds=None, lease=JOB_LEASE_SECONDS):
+    """
+    lease the next job that is due, if there is one. The lease has to be committed before the job is run
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param worker: the name of the worker claiming the job
+    :type worker: str
+    :param kinds: only claim jobs of these kinds, any kind if None
+    :type kinds: Union[Iterable[str], None]
+    :param lease: number of seconds the job is leased for
+    :type lease: float
+    :return: the leased job
+    :rtype: Union[Lease, None]
+    """
+    db_session.execute(EXPIRE_QUERY)
+    row = db_session.execute(CLAIM_QUERY, {
+        'worker': worker, 'lease': lease, 'kinds': sorted(kinds if kinds is not None else HANDLERS),
+    }).fetchone()
+    return Lease(*row, worker=worker) if row is not None else None
+
+
+class _Heartbeat(threading.Thread):
+    """
+    renews the lease of a job (and saves its progress) every third of the lease until stopped
+    """
+
+    def __init__(self, lease, seconds=JOB_LEASE_SECONDS):
+        super().__init__(daemon=True)
+        self.lease = lease
+        self.seconds = seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.seconds / 3):
+            try:
+                with get_engine().begin() as connection:
+                    renewed = connection.execute(RENEW_QUERY, self.lease.params(lease=self.seconds)).rowcount
+            except Exception:
+                # the lease may expire before the database is back, so the job must not carry on as if it held it
+                logger.exception('job {} ({}): could not renew its lease'.format(self.lease.id, self.lease.kind))
+                renewed = False
+            if not renewed:
+                logger.warning('job {} ({}): lost its lease'.format(self.lease.id, self.lease.kind))
+                self.lease.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(lease, gh_session, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    run a leased job, marking it done in the same transaction as the last of its work, or failed (to be retried if it
+    has attempts left). If the lease is lost while the job runs, the job is stopped at its next commit and the work it
+    has not committed yet is rolled back, leaving the job to whichever worker claimed it again.
+
+    :param lease: the leased job
+    :type lease: Lease
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param lease_seconds: number of seconds the lease is renewed for at a time
+    :type lease_seconds: float
+    :return: whether the job succeeded
+    :rtype: bool
+    """
+    heartbeat = _Heartbeat(lease, lease_seconds)
+    heartbeat.start()
+    try:
+        with METRICS.labels(stage=lease.kind), SessionManager(get_session_maker()) as db_session:
+            event.listen(db_session, 'before_commit', lambda session: lease.check())
+            HANDLERS[lease.kind](db_session, gh_session, lease)
+            if gh_session.archive is not None:
+                gh_session.archive.flush()
+            lease.check()
+            if not db_session.execute(COMPLETE_QUERY, lease.params()).rowcount:
+                lease.lost = True
+                lease.check()
+    except LeaseLost as e:
+        heartbeat.stop()
+        _forget_identities()
+        logger.warning('{}, rolled back its uncommitted work'.format(e))
+        return False
+    except Exception as e:
+        heartbeat.stop()
+        _forget_identities()
+        if isinstance(e, RetryLater):
+            logger.debug('job {} ({}): {}, retrying later'.format(lease.id, lease.kind, e))
+        else:
+            logger.exception('job {} ({}): attempt {} of {} failed'.format(
+                lease.id, lease.kind, lease.attempts, lease.max_attempts))
+        error = str(e) if isinstance(e, RetryLater) else traceback.format_exc()
+        with get_engine().begin() as connection:
+            failed = connection.execute(FAIL_QUERY, lease.params(delay=JOB_RETRY_DELAY, error=error)).rowcount
+        if not failed:
+            logger.warning('job {} ({}): lost its lease, so the failure was not recorded'.format(lease.id, lease.kind))
+        return False
+    heartbeat.stop()
+    logger.info('job {} ({}): done {}'.format(lease.id, lease.kind, lease.progress or ''))
+    return True
+
+
+def _work(worker, gh_session, kinds, drain, stop, poll_interval):
+    while not stop.is_set():
+        with SessionManager(get_session_maker()) as db_session:
+            lease = claim(db_session, worker, kinds)
+        if lease is not None:
+            run_job(lease, gh_session)
+        elif drain:
+            return
+        else:
+            stop.wait(poll_interval)
+
+
+def run_worker(threads=WORKER_THREADS, kinds=None, drain=False, poll_interval=JOB_POLL_INTERVAL):
+    """
+    claim and run jobs from the queue on `threads` threads until interrupted (or, with drain, until no job is due)
+
+    :param threads: number of jobs to run at once
+    :type threads: int
+    :param kinds: only run jobs of these kinds, any kind if None
+    :type kinds: Union[Iterable[str], None]
+    :param drain: whether to stop once there is no job to claim rather than waiting for more
+    :type drain: bool
+    :param poll_interval: number of seconds to wait before looking for a job again when there is none
+    :type poll_interval: float
+    """
+    # every job thread may fetch commit details with its own pool of workers, all through the one session
+    gh_session = get_gh_session(pool_size=max(HTTP_POOL_SIZE, threads * max(COMMIT_FETCH_WORKERS, 1)))
+    stop = threading.Event()
+    name = '{}:{}'.format(socket.gethostname(), os.getpid())
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(_work, '{}:{}'.format(name, i), gh_session, kinds, drain, stop, poll_interval)
+            for i in range(threads)
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            logger.info('stopping once the running jobs are done')
+            stop.set()
+    logger.info('worker stopped\n{}'.format(METRICS.format_summary('stage')))
+
+
+def queue_status(db_session):
+    """
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :return: the number of jobs of each kind in each status, and the running jobs with their progress
+    :rtype: Tuple[Dict[str, Dict[str, int]], List[ghstats.orm.orm.Job]]
+    """
+    counts = {}
+    for kind, status, count in db_session.query(Job.kind, Job.status, func.count()).group_by(Job.kind, Job.status):
+        counts.setdefault(kind, dict.fromkeys(STATUSES, 0))[status] = count
+    running = db_session.query(Job).filter(Job.status == 'running').order_by(Job.id).all()
+    return counts, running
+
+
+def purge(db_session, days):
+    """
+    delete the jobs that have been done for more than the given number of days
+
+    :return: the number of jobs deleted
+    :rtype: int
+    """
+    return db_session.query(Job).filter(
+        Job.status == 'done',
+        Job.finished_at < func.timezone('utc', func.now()) - func.make_interval(0, 0, 0, days),
+    ).delete(synchronize_session=False)
+
+
+def _get_identities(db_session):
+    global _identities
+    with _identities_lock:
+        if _identities is None:
+            _identities = IdentityCache().preload(db_session)
+    return _identities
+
+
+def _forget_identities():
+    # the emails and users added by a job whose transaction was rolled back must not be used by the next job
+    with _identities_lock:
+        if _identities is not None:
+            _identities.clear()
+
+
+@handler('members')
+def _members(db_session, gh_session, lease):
+    org = db_session.query(Organisation).get(uuid.UUID(lease.payload['org_id']))
+    users = get_users(db_session, gh_session, [org])
+    lease.report(users=len(users))
+    lease.report(teams=len(get_teams(db_session, gh_session, [org])))
+    enqueue(db_session, [PROFILES_JOB])
+
+
+@handler('repos')
+def _repos(db_session, gh_session, lease):
+    org = db_session.query(Organisation).get(uuid.UUID(lease.payload['org_id']))
+    repos = get_repos(db_session, gh_session, [org])
+    queued = enqueue(db_session, [
+        ('commits', 'commits:{}'.format(repo.id), {'repo_id': str(repo.id)}) for repo in repos
+    ])
+    lease.report(repos=len(repos), queued=queued)
+
+
+@handler('commits')
+def _commits(db_session, gh_session, lease):
+    repo = db_session.query(Repo).get(uuid.UUID(lease.payload['repo_id']))  # type: Repo
+    if COMMIT_BACKEND == 'mirror':
+        lease.report(commits=ingest_repo(repo.id, identities=_get_identities(db_session)))
+        return
+    if COMMIT_BRANCHES == 'all' or not (COMMIT_BACKEND == 'rest' or COMMIT_FILES):
+        # walking every branch needs the parents of each commit as it is stored, and without details to fetch there is
+        # nothing worth spreading over jobs
+        lease.report(commits=get_commits(db_session, gh_session, [repo], identities=_get_identities(db_session)))
+        return
+    repo_id = _row_id(db_session, repo)
+    branch = repo.default_branch
+    sync_state = _get_sync_state(db_session, repo, branch) if branch is not None else None
+    last_commit_at = sync_state.last_commit_at if sync_state is not None else None
+    listed, batches = [], []
+    commits = _new_commits(db_session, gh_session, repo, repo_id, branch, sync_state, COMMIT_BACKEND, listed)
+    for sha, commit in commits:
+        lease.check()
+        if not batches or len(batches[-1]) >= COMMIT_DETAILS_BATCH:
+            batches.append([])
+            lease.report(commits=COMMIT_DETAILS_BATCH * (len(batches) - 1))
+        batches[-1].append(sha.hex())
+        if last_commit_at is None or commit.committed_at > last_commit_at:
+            last_commit_at = commit.committed_at
+    # the new commits are queued in the same transaction as the sync state, so it never gets ahead of the queue
+    enqueue(db_session, [
+        ('commit_details', 'commit_details:{}:{}'.format(repo_id, shas[0]), {'repo_id': str(repo_id), 'shas': shas})
+        for shas in batches
+    ])
+    if sync_state is not None and listed:
+        sync_state.head_sha = listed[0]
+        sync_state.last_commit_at = last_commit_at
+    if branch is not None and listed:
+        _update_refs(db_session, repo_id, {branch: listed[0]}, prune=False)
+    lease.report(commits=sum(len(shas) for shas in batches), batches=len(batches))
+
+
+@handler('commit_details')
+def _commit_details(db_session, gh_session, lease):
+    repo = db_session.query(Repo).get(uuid.UUID(lease.payload['repo_id']))  # type: Repo
+    repo_id = repo.id
+    shas = [bytes.fromhex(sha) for sha in lease.payload['shas']]
+    # an earlier attempt may have stored some of the commits before failing
+    known = ShaIndex().known(db_session, shas)
+    identities = _get_identities(db_session)
+    partition = repo_partition(repo.org.name, repo.name)
+    fetch = METRICS.bind(partial(_fetch_commit, gh_session, repo.url, partition=partition))
+    workers = max(COMMIT_FETCH_WORKERS, 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            CommitWriter(db_session, archive=gh_session.archive) as writer:
+        commits = bounded_map(executor, fetch, ((sha, None) for sha in shas if sha not in known), workers)
+        for commit_sha, commit in commits:
+            lease.check()
+            _store_commit(db_session, gh_session, writer, identities, repo_id, commit_sha, commit)
+    links = writer.pending_parents
+    if links:
+        enqueue(db_session, [('parents', 'parents:{}:{}'.format(repo_id, lease.payload['shas'][0]),
+                              {'links': [[child.hex(), parent.hex()] for child, parent in links]})])
+    if writer.commits_written:
+        enqueue(db_session, [PROFILES_JOB])
+    lease.report(commits=writer.commits_written, files=writer.files_written, pending_parents=len(links))
+
+
+@handler('profiles')
+def _profiles(db_session, gh_session, lease):
+    # commits each batch of profiles as it goes, so a retry only fetches those that are left
+    lease.report(profiles=enrich_users(db_session, gh_session, identities=_identities))
+
+
+@handler('parents')
+def _parents(db_session, gh_session, lease):
+    with CommitWriter(db_session, refresh_rollups=False) as writer:
+        writer.add_parent_links(
+            (bytes.fromhex(child), bytes.fromhex(parent)) for child, parent in lease.payload['links'])
+    waiting = writer.pending_parents
+    lease.report(linked=len(lease.payload['links']) - len(waiting), waiting=len(waiting))
+    if waiting and not lease.last_attempt:
+        raise RetryLater('{} links are waiting for their parent commits'.format(len(waiting)))
@@ -0,0 +1,322 @@
+"""
+Counts and times what a sync spends its time on: github requests (and their 202 retries), rate limit sleeps, sql
+statements and rows written. Every measurement is recorded against the pipeline stage and repo the calling thread is
+working on (see Metrics.labels), so a slow run can be broken down by where the time went.
+
+Measurements are kept in the process-wide METRICS registry. Worker processes send a snapshot of theirs back to be
+merged, and at the end of a run the totals are logged as a summary and optionally written to a file in the prometheus
+text format (for the node exporter's textfile collector) or as json.
+"""
+
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from sqlalchemy import event
+
+from ghstats.config import PROFILE_DIR, PROFILE_STAGES
+
+logger = logging.getLogger(__name__)
+
+LABELS = ('stage', 'repo')
+# the columns of the summary: (heading, metric name, whether to show the count or the total seconds of a timer)
+SUMMARY_COLUMNS = (
+    ('requests', 'http_requests', 'count'),
+    ('http s', 'http_requests', 'seconds'),
+    ('202s', 'http_202_retries', 'count'),
+    ('sleep s', 'rate_limit_sleep', 'seconds'),
+    ('sql', 'sql_statements', 'count'),
+    ('sql s', 'sql_statements', 'seconds'),
+    ('commits', 'commits_written', 'count'),
+    ('files', 'files_written', 'count'),
+)
+
+
+class Metrics(object):
+    """
+    A thread safe registry of counters and timers, each kept per (name, stage, repo). The stage and repo are taken from
+    the labels of the calling thread, which are set with labels().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = defaultdict(float)
+        # count, total seconds and slowest single observation of each timer
+        self._timers = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def current_labels(self):
+        """
+        :return: the labels of the calling thread
+        :rtype: Dict[str, str]
+        """
+        return getattr(self._local, 'labels', {})
+
+    @contextmanager
+    def labels(self, **labels):
+        """
+        record the measurements made by the calling thread within the block against the given labels (and those of any
+        enclosing block), eg:
+
+            with METRICS.labels(stage='commits'):
+                ...
+        """
+        unknown = set(labels) - set(LABELS)
+        if unknown:
+            raise ValueError('unknown labels: {}'.format(', '.join(sorted(unknown))))
+        previous = self.current_labels()
+        self._local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    def bind(self, fn):
+        """
+        wrap a function so that it records its measurements against the labels of the calling thread wherever it runs,
+        eg when submitting it to a thread pool
+
+        :param fn: the function to wrap
+        :type fn: Callable
+        :rtype: Callable
+        """
+        labels = self.current_labels()
+
+        @wraps(fn)
+        def bound(*args, **kwargs):
+            with self.labels(**labels):
+                return fn(*args, **kwargs)
+        return bound
+
+    def _key(self, name):
+        labels = self.current_labels()
+        return (name,) + tuple(labels.get(label) for label in LABELS)
+
+    def incr(self, name, value=1):
+        """
+        :param name: the name of the counter
+        :type name: str
+        :param value: the amount to increase it by
+        :type value: float
+        """
+        key = self._key(name)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, seconds):
+        """
+        :param name: the name of the timer
+        :type name: str
+        :param seconds: how long the timed operation took
+        :type seconds: float
+        """
+        key = self._key(name)
+        with self._lock:
+            timer = self._timers[key]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        time the block with the given timer
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def snapshot(self):
+        """
+        :return: the current value of every counter and timer, as a json serialisable dict that can be merged into the
+            registry of another process
+        :rtype: Dict[str, list]
+        """
+        with self._lock:
+            return {
+                'counters': [list(key) + [value] for key, value in sorted(self._counters.items(), key=_sort_key)],
+                'timers': [list(key) + list(value) for key, value in sorted(self._timers.items(), key=_sort_key)],
+            }
+
+    def merge(self, snapshot):
+        """
+        add the counters and timers of a snapshot (eg from a worker process) to this registry
+
+        :param snapshot: the snapshot to merge
+        :type snapshot: Dict[str, list]
+        """
+        width = len(LABELS) + 1
+        with self._lock:
+            for row in snapshot['counters']:
+                self._counters[tuple(row[:width])] += row[width]
+            for row in snapshot['timers']:
+                count, seconds, slowest = row[width:]
+                timer = self._timers[tuple(row[:width])]
+                timer[0] += count
+                timer[1] += seconds
+                timer[2] = max(timer[2], slowest)
+
+    def totals(self, by='stage'):
+        """
+        :param by: the label to group the measurements by
+        :type by: str
+        :return: the count and total seconds of each metric, per value of the label
+        :rtype: Dict[Union[str, None], Dict[str, Dict[str, float]]]
+        """
+        position = LABELS.index(by) + 1
+        totals = defaultdict(lambda: defaultdict(lambda: {'count': 0, 'seconds': 0.0}))
+        with self._lock:
+            for key, value in self._counters.items():
+                totals[key[position]][key[0]]['count'] += value
+            for key, (count, seconds, _) in self._timers.items():
+                totals[key[position]][key[0]]['count'] += count
+                totals[key[position]][key[0]]['seconds'] += seconds
+        return totals
+
+    def format_summary(self, by='stage', limit=None):
+        """
+        :param by: the label to group the measurements by
+        :type by: str
+        :param limit: only show this many groups, those with the most http and sql time first
+        :type limit: Union[int, None]
+        :return: a table of the main metrics, one line per value of the label
+        :rtype: str
+        """
+        totals = self.totals(by)
+
+        def busy(group):
+            return -(totals[group]['http_requests']['seconds'] + totals[group]['sql_statements']['seconds'])
+
+        groups = sorted(totals, key=busy if limit is not None else lambda group: group or '')[:limit]
+        lines = ['{:<40}'.format(by) + ''.join('{:>10}'.format(heading) for heading, _, _ in SUMMARY_COLUMNS)]
+        for group in groups:
+            cells = []
+            for _, name, field in SUMMARY_COLUMNS:
+                value = totals[group][name][field]
+                cells.append('{:>10.1f}'.format(value) if field == 'seconds' else '{:>10}'.format(int(value)))
+            lines.append('{:<40}'.format((group or '-')[:39]) + ''.join(cells))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, prefix='ghstats'):
+        """
+        :return: every counter and timer in the prometheus text exposition format. Each timer is exported as a
+            <name>_seconds_total counter, a <name>_count counter and a <name>_seconds_max gauge
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        width = len(LABELS) + 1
+        series = defaultdict(list)
+        for row in snapshot['counters']:
+            series[('{}_{}_total'.format(prefix, row[0]), 'counter')].append((row[1:width], row[width]))
+        for row in snapshot['timers']:
+            count, seconds, slowest = row[width:]
+            series[('{}_{}_count'.format(prefix, row[0]), 'counter')].append((row[1:width], count))
+            series[('{}_{}_seconds_total'.format(prefix, row[0]), 'counter')].append((row[1:width], seconds))
+            series[('{}_{}_seconds_max'.format(prefix, row[0]), 'gauge')].append((row[1:width], slowest))
+        lines = []
+        for (name, kind), samples in sorted(series.items()):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _prometheus_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        write every counter and timer to a file, as json if the path ends in .json and in the prometheus text format
+        otherwise. The file is replaced atomically, so a collector never reads a partly written file.
+
+        :param path: the file to write
+        :type path: str
+        """
+        if path.endswith('.json'):
+            content = json.dumps(dict(self.snapshot(), labels=list(LABELS)), indent=2)
+        else:
+            content = self.to_prometheus()
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+        logger.info('wrote metrics to {}'.format(path))
+
+
+def _sort_key(item):
+    return tuple('' if part is None else part for part in item[0])
+
+
+def _prometheus_labels(values):
+    labels = [
+        '{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in zip(LABELS, values) if value is not None
+    ]
+    return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+
+METRICS = Metrics()
+
+
+def record_response(response, *args, **kwargs):
+    """
+    requests response hook counting and timing each request made with a session (see get_gh_session)
+    """
+    METRICS.observe('http_requests', response.elapsed.total_seconds())
+
+
+def instrument_engine(engine, metrics=METRICS):
+    """
+    count and time every statement executed with an engine, as the 'sql_statements' timer
+
+    :param engine: the engine to instrument
+    :type engine: sqlalchemy.engine.Engine
+    :param metrics: the registry to record the statements in
+    :type metrics: Metrics
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        metrics.observe('sql_statements', time.perf_counter() - conn.info['metrics_start'].pop())
+
+
+@contextmanager
+def profile(stage, tag=None, stages=PROFILE_STAGES, profile_dir=PROFILE_DIR):
+    """
+    run the block under cProfile if the stage is one of the stages to profile, saving the stats to
+    <profile_dir>/<stage>[-<tag>]-<pid>.prof (to be read with pstats or snakeviz). Only the calling thread is profiled,
+    not the threads it hands work to.
+
+    :param stage: the name of the stage run in the block
+    :type stage: str
+    :param tag: added to the file name, eg the name of the org the stage is run for
+    :type tag: Union[str, None]
+    :param stages: the names of the stages to profile
+    :type stages: Iterable[str]
+    :param profile_dir: the directory to save the stats in
+    :type profile_dir: str
+    """
+    if stage not in stages:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, '{}-{}.prof'.format('-'.join(filter(None, (stage, tag))), os.getpid()))
+        profiler.dump_stats(path)
+        logger.info('saved the profile of {} to {}'.format(stage, path))
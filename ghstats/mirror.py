@@ -0,0 +1,334 @@
+"""
+Ingests commits from local bare mirror clones of each repo instead of the github api: history is walked with
+`git log --raw --numstat`, which gives everything get_commits stores for a commit without any api requests.
+"""
+
+import base64
+import logging
+import multiprocessing
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from ghstats.config import HTTP_GH_URL, MIRROR_DIR, MIRROR_PROCESSES, github_login, github_token
+from ghstats.config import COMMIT_BRANCHES
+from ghstats.gh import _get_sync_state, _store_commit, _get_refs, _update_refs
+from ghstats.identity import IdentityCache
+from ghstats.orm.orm import Commit, Repo
+from ghstats.records import CommitFile, CommitRecord
+from ghstats.session import SessionManager, get_session_maker
+from ghstats.writer import CommitWriter
+
+logger = logging.getLogger(__name__)
+
+# each commit starts with a record separator, its fields are separated by unit separators and the message comes last
+GIT_LOG_FORMAT = '%x1e%H%x1f%P%x1f%ae%x1f%at%x1f%ce%x1f%ct%x1f%B%x1f'
+FILE_STATUSES = {'A': 'added', 'D': 'removed', 'M': 'modified', 'R': 'renamed', 'C': 'copied', 'T': 'changed'}
+KNOWN_SHA_BATCH = 1000
+
+# the identity cache of this worker process, preloaded on first use
+_identities = None
+
+
+def mirror_path(org_name, repo_name, mirror_dir=MIRROR_DIR):
+    """
+    :return: the path of the bare mirror clone of the repo
+    :rtype: str
+    """
+    return os.path.join(mirror_dir, org_name, '{}.git'.format(repo_name))
+
+
+def clone_url(org_name, repo_name):
+    """
+    :return: the url to clone the repo from
+    :rtype: str
+    """
+    return '{}/{}/{}.git'.format(HTTP_GH_URL, org_name, repo_name)
+
+
+def _git_env():
+    """
+    :return: the environment to run git in, with the github credentials passed as a header. The header is set through
+        the environment rather than with -c, as the arguments of a process can be read by any user of the host, and is
+        never stored in the mirror's config
+    :rtype: Dict[str, str]
+    """
+    credentials = base64.b64encode('{}:{}'.format(github_login(), github_token()).encode()).decode()
+    # added to any config entries the environment already passes to git
+    count = int(os.environ.get('GIT_CONFIG_COUNT', '0'))
+    return dict(os.environ, **{
+        'GIT_CONFIG_COUNT': str(count + 1),
+        'GIT_CONFIG_KEY_{}'.format(count): 'http.extraHeader',
+        'GIT_CONFIG_VALUE_{}'.format(count): 'Authorization: Basic {}'.format(credentials),
+        'GIT_TERMINAL_PROMPT': '0',
+    })
+
+
+def _git(*args, cwd=None):
+    """
+    run a git command with the github credentials (see _git_env)
+
+    :return: the output of the command
+    :rtype: bytes
+    """
+    return subprocess.run(['git'] + list(args), cwd=cwd, env=_git_env(), check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout
+
+
+def update_mirror(path, url):
+    """
+    create a bare mirror clone of the repo at path, or fetch any new commits if it already exists
+
+    :param path: the path of the mirror
+    :type path: str
+    :param url: the url to clone from
+    :type url: str
+    """
+    if os.path.isdir(path):
+        _git('remote', 'update', '--prune', cwd=path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _git('clone', '--mirror', '--quiet', url, path)
+
+
+def rev_parse(path, rev):
+    """
+    :return: the sha of the commit rev points to in the mirror at path, or None if it does not exist
+    :rtype: Union[str, None]
+    """
+    try:
+        return _git('rev-parse', '--verify', '--quiet', '{}^{{commit}}'.format(rev), cwd=path).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def branch_heads(path):
+    """
+    :return: the sha of the head of each branch in the mirror at path, keyed by branch name
+    :rtype: Dict[str, bytes]
+    """
+    output = _git('for-each-ref', '--format=%(refname:lstrip=2)%00%(objectname)', 'refs/heads', cwd=path).decode()
+    return {name: bytes.fromhex(sha) for name, sha in (line.split('\0') for line in output.splitlines())}
+
+
+def _parse_files(diff):
+    """
+    parse the -z --raw and --numstat output of a single commit into the files it changed
+
+    :param diff: the raw and numstat output of the commit
+    :type diff: str
+    :return: the records of the files
+    :rtype: List[ghstats.records.CommitFile]
+    """
+    statuses, files = {}, []
+    tokens = iter(diff.split('\0'))
+    for token in tokens:
+        token = token.lstrip('\n')
+        if not token:
+            continue
+        if token.startswith(':'):
+            status = token.split()[-1][0]
+            if status in ('R', 'C'):
+                next(tokens)
+            statuses[next(tokens)] = FILE_STATUSES.get(status, 'modified')
+            continue
+        additions, deletions, filename = token.split('\t', 2)
+        if not filename:
+            next(tokens)
+            filename = next(tokens)
+        files.append(CommitFile(
+            filename=filename,
+            status=statuses.get(filename, 'modified'),
+            additions=int(additions) if additions != '-' else 0,
+            deletions=int(deletions) if deletions != '-' else 0,
+        ))
+    return files
+
+
+def parse_commit(record):
+    """
+    parse the git log output of a single commit into a commit record. As git does not know about github users, the
+    author and committer are always None.
+
+    :param record: the output of git log for one commit, without the leading record separator
+    :type record: str
+    :return: the record of the commit
+    :rtype: ghstats.records.CommitRecord
+    """
+    sha, parents, author_email, authored_at, committer_email, committed_at, rest = record.split('\x1f', 6)
+    message, _, diff = rest.rpartition('\x1f')
+    files = _parse_files(diff)
+    return CommitRecord(
+        sha=bytes.fromhex(sha),
+        parents=tuple(bytes.fromhex(parent) for parent in parents.split()),
+        message=message.rstrip('\n'),
+        author=None,
+        author_email=author_email,
+        authored_at=datetime.utcfromtimestamp(int(authored_at)),
+        committer=None,
+        committer_email=committer_email,
+        committed_at=datetime.utcfromtimestamp(int(committed_at)),
+        additions=sum(file.additions for file in files),
+        deletions=sum(file.deletions for file in files),
+        files=tuple(files),
+    )
+
+
+def iter_log(path, *revs):
+    """
+    walk the history of the mirror at path, newest first, yielding each commit as it is parsed. Merge commits are
+    diffed against their first parent, as the github api does.
+
+    :param path: the path of the mirror
+    :type path: str
+    :param revs: the revisions to walk, as accepted by git log
+    :type revs: str
+    :return: an iterator of the records of the commits
+    :rtype: Iterator[ghstats.records.CommitRecord]
+    """
+    command = ['git', 'log', '-z', '--raw', '--numstat', '-M', '--diff-merges=first-parent',
+               '--format={}'.format(GIT_LOG_FORMAT)] + list(revs) + ['--']
+    with subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE) as proc:
+        buf = b''
+        for chunk in iter(lambda: proc.stdout.read(1 << 16), b''):
+            records = (buf + chunk).split(b'\x1e')
+            buf = records.pop()
+            for record in records:
+                if record:
+                    yield parse_commit(record.decode('utf-8', errors='replace'))
+        if buf:
+            yield parse_commit(buf.decode('utf-8', errors='replace'))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def _new_commits(db_session, commits):
+    """
+    filter out commits that are already in the database, checking a batch of shas per query
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param commits: the records of the commits
+    :type commits: Iterable[ghstats.records.CommitRecord]
+    :return: an iterator of the commits not yet in the database
+    :rtype: Iterator[ghstats.records.CommitRecord]
+    """
+    commits = iter(commits)
+    while True:
+        batch = list(islice(commits, KNOWN_SHA_BATCH))
+        if not batch:
+            return
+        shas = [commit.sha for commit in batch]
+        known = {bytes(sha) for sha, in db_session.query(Commit.sha).filter(Commit.sha.in_(shas))}
+        for sha, commit in zip(shas, batch):
+            if sha not in known:
+                yield commit
+
+
+def _branch_revs(db_session, path, repo_id):
+    """
+    work out what to walk to find the new commits on every branch of the mirror: the heads of the branches that moved,
+    excluding everything reachable from the previously recorded heads
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param path: the path of the mirror
+    :type path: str
+    :param repo_id: the id of the Repo row
+    :type repo_id: uuid.UUID
+    :return: the revisions to pass to git log (empty if no branch moved) and the current head of each branch
+    :rtype: Tuple[List[str], Dict[str, bytes]]
+    """
+    heads = branch_heads(path)
+    known_heads = _get_refs(db_session, repo_id)
+    moved = [sha.hex() for name, sha in heads.items() if known_heads.get(name) != sha]
+    if not moved:
+        return [], heads
+    # a previous head may be gone after a force push, in which case more history is checked against the database
+    known = {sha.hex() for sha in known_heads.values() if sha is not None}
+    return moved + ['^{}'.format(sha) for sha in sorted(known) if rev_parse(path, sha) is not None], heads
+
+
+def ingest_repo(repo_id, mirror_dir=MIRROR_DIR, branches=COMMIT_BRANCHES, identities=None):
+    """
+    update the mirror of a repo and store any new commits on its default branch (or on all of its branches). Runs in
+    its own database session so it can be run in a worker process.
+
+    :param repo_id: the id of the Repo row object
+    :type repo_id: uuid.UUID
+    :param mirror_dir: the directory to keep the mirrors in
+    :type mirror_dir: str
+    :param branches: which branches to sync: 'default' or 'all'
+    :type branches: str
+    :param identities: the identity cache to resolve authors and committers with, the one of this process if None
+    :type identities: Union[ghstats.identity.IdentityCache, None]
+    :return: the number of new commits stored
+    :rtype: int
+    """
+    global _identities
+    with SessionManager(get_session_maker()) as db_session:
+        if identities is None:
+            if _identities is None:
+                _identities = IdentityCache().preload(db_session)
+            identities = _identities
+        repo = db_session.query(Repo).get(repo_id)  # type: Repo
+        org_name, repo_name, branch = repo.org.name, repo.name, repo.default_branch
+        path = mirror_path(org_name, repo_name, mirror_dir)
+        update_mirror(path, clone_url(org_name, repo_name))
+        sync_state, heads = None, {}
+        if branches == 'all':
+            revs, heads = _branch_revs(db_session, path, repo_id)
+        else:
+            head = rev_parse(path, branch if branch is not None else 'HEAD')
+            revs = [head] if head is not None else []
+            if head is not None and branch is not None:
+                heads[branch] = bytes.fromhex(head)
+                sync_state = _get_sync_state(db_session, repo, branch)
+            if sync_state is not None and sync_state.head_sha is not None:
+                previous_head = bytes(sync_state.head_sha).hex()
+                # after a force push the previous head may be gone, in which case the whole history is checked
+                if rev_parse(path, previous_head) is not None:
+                    revs.append('^{}'.format(previous_head))
+        last_commit_at = sync_state.last_commit_at if sync_state is not None else None
+        with CommitWriter(db_session) as writer:
+            commits = _new_commits(db_session, iter_log(path, *revs)) if revs else ()
+            for commit in commits:
+                _store_commit(db_session, None, writer, identities, repo_id, commit.sha, commit)
+                if last_commit_at is None or commit.committed_at > last_commit_at:
+                    last_commit_at = commit.committed_at
+            if sync_state is not None:
+                sync_state.head_sha = heads[branch]
+                sync_state.last_commit_at = last_commit_at
+        _update_refs(db_session, repo_id, heads, prune=branches == 'all')
+        logger.info('{}/{}: {} new commits'.format(org_name, repo_name, writer.commits_written))
+        return writer.commits_written
+
+
+def _init_worker(level):
+    # spawned workers start without the logging configuration of their parent
+    logging.basicConfig(level=level)
+
+
+def ingest_repos(repo_ids, processes=MIRROR_PROCESSES, mirror_dir=MIRROR_DIR):
+    """
+    ingest the given repos from their mirrors, up to `processes` repos at once. The worker processes are spawned rather
+    than forked, as the caller may have other threads running and database connections open (eg a pipeline stage).
+    Run it with a single process from a worker process, which would otherwise start a pool of its own.
+
+    :param repo_ids: the ids of the Repo row objects
+    :type repo_ids: Iterable[uuid.UUID]
+    :param processes: number of worker processes to update and parse mirrors in
+    :type processes: int
+    :param mirror_dir: the directory to keep the mirrors in
+    :type mirror_dir: str
+    :return: the number of new commits stored
+    :rtype: int
+    """
+    repo_ids = list(repo_ids)
+    if processes <= 1:
+        return sum(ingest_repo(repo_id, mirror_dir) for repo_id in repo_ids)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(logging.getLogger().getEffectiveLevel(),)) as executor:
+        return sum(executor.map(ingest_repo, repo_ids, [mirror_dir] * len(repo_ids)))
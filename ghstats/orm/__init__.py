@@ -1,8 +1,6 @@
 from sqlalchemy import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 
-from ghstats.config import DB_CONNECTION_STRING
-
 meta = MetaData(naming_convention={
     "ix": 'ix_%(column_0_label)s',
     "uq": "uq_%(table_name)s_%(column_0_name)s",
@@ -26,7 +24,6 @@ def dcim_base_str(self):
 GHDBase.__str__ = dcim_base_str
 
 if __name__ == '__main__':
-    from sqlalchemy import create_engine
+    from ghstats.session import get_engine
 
-    engine = create_engine(DB_CONNECTION_STRING)
-    GHDBase.metadata.create_all(engine)
+    GHDBase.metadata.create_all(get_engine())
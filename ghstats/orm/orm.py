@@ -1,5 +1,6 @@
-from sqlalchemy import Column, func, String, Table, ForeignKey, DateTime, text, Integer, Index, UniqueConstraint
-from sqlalchemy.dialects.postgresql import UUID, BYTEA
+from sqlalchemy import Column, func, String, Table, ForeignKey, DateTime, Date, text, Integer, Index, UniqueConstraint, \
+    BigInteger
+from sqlalchemy.dialects.postgresql import UUID, BYTEA, JSONB
 from sqlalchemy.orm import relationship
 
 from ghstats.config import BASE_GH_URL
@@ -20,7 +21,8 @@ team_user_table = Table(
 commit_parent_table = Table(
     'commit_parent', GHDBase.metadata,
     Column('child_id', UUID(as_uuid=True), ForeignKey('commits.id'), primary_key=True),
-    Column('parent_id', UUID(as_uuid=True), ForeignKey('commits.id'), primary_key=True)
+    Column('parent_id', UUID(as_uuid=True), ForeignKey('commits.id'), primary_key=True),
+    Index('commit_parent_parent_id_index', 'parent_id'),
 )
 
 
@@ -65,6 +67,11 @@ class Email(GHDBase):
 
 class User(UniqueNamed, ExtID, GHDBase):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('users_profile_pending_index', 'id', postgresql_where=text('profile_fetched_at IS NULL')),
+    )
+    # when the profile of the user (and so their public email) was last fetched, None until it has been
+    profile_fetched_at = Column(DateTime(timezone=False))
 
     orgs = relationship("Organisation", secondary=organisation_user_table, back_populates="users")
     teams = relationship("Team", secondary=team_user_table, back_populates="users")
@@ -130,16 +137,20 @@ class Repo(Named, ExtID, GHDBase):
 
     org_id = Column(UUID(as_uuid=True), ForeignKey('orgs.id'))
     org = relationship("Organisation", back_populates="repos")
+    default_branch = Column(String)
     commits = relationship("Commit")
     refs = relationship("Ref", back_populates="repo")
+    sync_states = relationship("SyncState", back_populates="repo")
 
-    def __init__(self, ext_id, name, org, commits=None):
+    def __init__(self, ext_id, name, org, commits=None, default_branch=None):
         super().__init__(name=name)
         self.ext_id = ext_id
 
         self.org = org
         if commits is not None:
             self.commits = commits
+        if default_branch is not None:
+            self.default_branch = default_branch
 
     @property
     def url(self):
@@ -152,6 +163,7 @@ class Commit(Named, GHDBase):
     __table_args__ = (
         Index('committed_at_index', 'committed_at'),
         Index('authored_at_index', 'authored_at'),
+        Index('commits_repo_id_authored_at_index', 'repo_id', 'authored_at'),
     )
 
     committer_id = Column(UUID(as_uuid=True), ForeignKey('users.id'))
@@ -166,7 +178,7 @@ class Commit(Named, GHDBase):
     authored_at = Column(DateTime(timezone=False))
     repo_id = Column(UUID(as_uuid=True), ForeignKey('repos.id'))
     repo = relationship("Repo", back_populates="commits")
-    sha = Column(BYTEA(length=40), nullable=False, unique=True)
+    sha = Column(BYTEA(length=20), nullable=False, unique=True)
     additions = Column(Integer)
     deletions = Column(Integer)
     files = relationship('File', back_populates='commit')
@@ -200,33 +212,143 @@ class Commit(Named, GHDBase):
             self.authored_at = authored_at
 
 
+class Path(GHDBase):
+    """
+    A file path, stored once and referenced by id from every change to the file. The text_pattern_ops index serves
+    prefix (LIKE 'dir/%') matches, so the paths under a directory are found without a scan.
+    """
+    __tablename__ = 'paths'
+    __table_args__ = (
+        Index('paths_path_prefix_index', 'path', postgresql_ops={'path': 'text_pattern_ops'}),
+    )
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False, unique=True)
+    files = relationship('File', back_populates='path')
+
+    def __init__(self, path):
+        self.path = path
+
+
 class File(GHDBase):
     __tablename__ = 'files'
     __table_args__ = (
-        Index('filename_index', 'filename'),
+        Index('files_path_id_index', 'path_id'),
         Index('status_index', 'status'),
     )
 
     id = Column(UUID(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
-    filename = Column(String, nullable=False)
+    path_id = Column(Integer, ForeignKey('paths.id'), nullable=False)
+    path = relationship('Path', back_populates='files')
     additions = Column(Integer, nullable=False, default=0)
     deletions = Column(Integer, nullable=False, default=0)
     status = Column(String)
     commit_id = Column(UUID(as_uuid=True), ForeignKey('commits.id'))
     commit = relationship('Commit', back_populates='files')
 
-    def __init__(self, commit, filename, status, additions, deletions):
+    def __init__(self, commit, path, status, additions, deletions):
         self.commit = commit
-        self.filename = filename
+        self.path = path
         self.status = status
         self.additions = additions
         self.deletions = deletions
 
+    @property
+    def filename(self):
+        return self.path.path
+
 
 class Ref(Named, GHDBase):
     __tablename__ = 'refs'
+    __table_args__ = (
+        UniqueConstraint('repo_id', 'name', name='unique_ref_name_per_repo'),
+    )
 
     head_id = Column(UUID(as_uuid=True), ForeignKey('commits.id'))
     head = relationship('Commit', back_populates='refs')
     repo_id = Column(UUID(as_uuid=True), ForeignKey('repos.id'))
     repo = relationship("Repo", back_populates="refs")
+
+
+class SyncState(GHDBase):
+    """
+    The high-water mark of the commits synced from a branch of a repo: the newest commit seen on the branch and the
+    latest commit date synced so far.
+    """
+    __tablename__ = 'sync_state'
+    __table_args__ = (
+        UniqueConstraint('repo_id', 'branch', name='unique_sync_state_per_branch'),
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
+    repo_id = Column(UUID(as_uuid=True), ForeignKey('repos.id'), nullable=False)
+    repo = relationship("Repo", back_populates="sync_states")
+    branch = Column(String, nullable=False)
+    head_sha = Column(BYTEA(length=20))
+    last_commit_at = Column(DateTime(timezone=False))
+    synced_at = Column(DateTime(timezone=False), server_default=text("timezone('utc', now())"),
+                       onupdate=text("timezone('utc', now())"))
+
+    def __init__(self, repo, branch, head_sha=None, last_commit_at=None):
+        self.repo = repo
+        self.branch = branch
+        if head_sha is not None:
+            self.head_sha = head_sha
+        if last_commit_at is not None:
+            self.last_commit_at = last_commit_at
+
+
+class DailyContribution(GHDBase):
+    """
+    The commits, additions and deletions authored by a user in a repo on a day (by authored_at, in utc). Commits whose
+    author is not a known user are rolled up with a null user_id. Kept up to date by the CommitWriter, which recomputes
+    the rows of every (repo, day) a batch of new commits touches.
+    """
+    __tablename__ = 'daily_contributions'
+    __table_args__ = (
+        Index('daily_contributions_repo_id_day_index', 'repo_id', 'day'),
+        Index('daily_contributions_org_id_day_index', 'org_id', 'day'),
+        Index('daily_contributions_user_id_day_index', 'user_id', 'day'),
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=func.uuid_generate_v4())
+    day = Column(Date, nullable=False)
+    repo_id = Column(UUID(as_uuid=True), ForeignKey('repos.id'), nullable=False)
+    repo = relationship("Repo")
+    org_id = Column(UUID(as_uuid=True), ForeignKey('orgs.id'))
+    org = relationship("Organisation")
+    user_id = Column(UUID(as_uuid=True), ForeignKey('users.id'))
+    user = relationship("User")
+    commits = Column(Integer, nullable=False, default=0)
+    additions = Column(Integer, nullable=False, default=0)
+    deletions = Column(Integer, nullable=False, default=0)
+
+
+class Job(GHDBase):
+    """
+    A unit of sync work in the queue shared by `ghstats worker` processes (see ghstats.jobs). A worker claims a job by
+    leasing it; a job whose lease expires without being renewed is claimed again by another worker. Failed jobs are
+    retried with a backoff until they have been attempted max_attempts times.
+
+    key identifies the work a job does, so the same work is never queued twice at once.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        Index('jobs_status_run_after_index', 'status', 'run_after'),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    kind = Column(String, nullable=False)
+    key = Column(String, nullable=False, unique=True)
+    payload = Column(JSONB, nullable=False)
+    # pending, running, done or failed
+    status = Column(String, nullable=False, server_default='pending')
+    attempts = Column(Integer, nullable=False, server_default='0')
+    max_attempts = Column(Integer, nullable=False, server_default='5')
+    run_after = Column(DateTime(timezone=False), nullable=False, server_default=text("timezone('utc', now())"))
+    leased_by = Column(String)
+    lease_expires_at = Column(DateTime(timezone=False))
+    progress = Column(JSONB)
+    error = Column(String)
+    created_at = Column(DateTime(timezone=False), server_default=text("timezone('utc', now())"))
+    finished_at = Column(DateTime(timezone=False))
@@ -0,0 +1,250 @@
+"""
+Runs the sync as a dependency graph of stages. Each org's stages run in their own worker process, and within an org,
+stages whose dependencies are done run concurrently, each with its own database session.
+"""
+
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+from ghstats.config import COMMIT_FETCH_WORKERS, SYNC_PROCESSES, COMMIT_BACKEND, METRICS_PATH, \
+    PROFILE_STAGES, MIRROR_PROCESSES, github_credentials
+from ghstats.gh import get_orgs, get_users, get_teams, get_repos, get_commits, enrich_users
+from ghstats.metrics import METRICS, profile
+from ghstats.mirror import ingest_repos
+from ghstats.orm.orm import Organisation, Repo
+from ghstats.ratelimit import RateLimitManager, RATE_LIMIT_BUFFER
+from ghstats.session import SessionManager, get_session_maker, dispose_engine, get_gh_session
+
+logger = logging.getLogger(__name__)
+
+Stage = namedtuple('Stage', ['name', 'run', 'requires'])
+StageResult = namedtuple('StageResult', ['org', 'stage', 'status', 'seconds', 'rows'])
+
+# whether this is a worker process syncing an org, rather than the process running the sync
+_in_worker = False
+
+
+def _sync_users(db_session, gh_session, org, inputs):
+    return [row.id for row in get_users(db_session, gh_session, [org])]
+
+
+def _sync_teams(db_session, gh_session, org, inputs):
+    return [row.id for row in get_teams(db_session, gh_session, [org])]
+
+
+def _sync_repos(db_session, gh_session, org, inputs):
+    return [row.id for row in get_repos(db_session, gh_session, [org])]
+
+
+def _sync_commits(db_session, gh_session, org, inputs):
+    if COMMIT_BACKEND == 'mirror':
+        # orgs synced in worker processes already update as many mirrors at once as there are processes
+        return ingest_repos(inputs['repos'], processes=1 if _in_worker else MIRROR_PROCESSES)
+    repos = db_session.query(Repo).filter(Repo.id.in_(inputs['repos'])).all() if inputs['repos'] else []
+    return get_commits(db_session, gh_session, repos)
+
+
+# teams need the users to exist to record membership, commits need them to avoid racing the users stage to insert them
+STAGES = (
+    Stage('users', _sync_users, ()),
+    Stage('repos', _sync_repos, ()),
+    Stage('teams', _sync_teams, ('users',)),
+    Stage('commits', _sync_commits, ('users', 'repos')),
+)
+
+
+def _run_stage(stage, gh_session, org_id, inputs, profile_stages=PROFILE_STAGES):
+    """
+    run a single stage in its own database session, recording its metrics against the stage (and profiling it if it
+    is one of profile_stages)
+
+    :param stage: the stage to run
+    :type stage: Stage
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param org_id: the id of the Organisation row to run the stage for
+    :type org_id: uuid.UUID
+    :param inputs: the outputs of the stages this stage requires, keyed by stage name
+    :type inputs: Dict[str, Any]
+    :param profile_stages: the names of the stages to run under cProfile
+    :type profile_stages: Iterable[str]
+    :return: the output of the stage
+    """
+    with METRICS.labels(stage=stage.name), SessionManager(get_session_maker()) as db_session:
+        org = db_session.query(Organisation).get(org_id)
+        with profile(stage.name, tag=org.name, stages=profile_stages):
+            output = stage.run(db_session, gh_session, org, inputs)
+        if gh_session.archive is not None:
+            gh_session.archive.flush()
+        return output
+
+
+def run_org(org_id, org_name, stages=STAGES, rate_limit_buffer=RATE_LIMIT_BUFFER, profile_stages=PROFILE_STAGES):
+    """
+    run all stages for a single org, starting each stage as soon as the stages it requires have finished. If a stage
+    fails, the stages that require it are skipped.
+
+    :param org_id: the id of the Organisation row
+    :type org_id: uuid.UUID
+    :param org_name: the login name of the organisation
+    :type org_name: str
+    :param stages: the stages to run
+    :type stages: Iterable[Stage]
+    :param rate_limit_buffer: number of requests to leave unused on each credential
+    :type rate_limit_buffer: int
+    :param profile_stages: the names of the stages to run under cProfile
+    :type profile_stages: Iterable[str]
+    :return: the result of each stage
+    :rtype: List[StageResult]
+    """
+    gh_session = get_gh_session(rate_limits=RateLimitManager(github_credentials(), buffer=rate_limit_buffer))
+    pending = {stage.name: stage for stage in stages}
+    outputs, failed, running, started, results = {}, set(), {}, {}, []
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(required in failed for required in stage.requires):
+                    logger.warning('{}/{}: skipped'.format(org_name, name))
+                    failed.add(name)
+                    results.append(StageResult(org_name, name, 'skipped', 0.0, None))
+                    del pending[name]
+                elif all(required in outputs for required in stage.requires):
+                    inputs = {required: outputs[required] for required in stage.requires}
+                    running[executor.submit(_run_stage, stage, gh_session, org_id, inputs, profile_stages)] = stage
+                    started[name] = time.monotonic()
+                    del pending[name]
+            if not running:
+                if pending:
+                    raise ValueError('stages with unknown requirements: {}'.format(', '.join(pending)))
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                seconds = time.monotonic() - started[stage.name]
+                try:
+                    outputs[stage.name] = future.result()
+                except Exception:
+                    logger.exception('{}/{}: failed after {:.1f}s'.format(org_name, stage.name, seconds))
+                    failed.add(stage.name)
+                    results.append(StageResult(org_name, stage.name, 'failed', seconds, None))
+                    continue
+                output = outputs[stage.name]
+                rows = len(output) if isinstance(output, (list, tuple, set)) else output
+                logger.info('{}/{}: done in {:.1f}s ({} rows)'.format(org_name, stage.name, seconds, rows))
+                results.append(StageResult(org_name, stage.name, 'ok', seconds, rows))
+    if gh_session.response_cache is not None:
+        logger.info('{}: response cache: {} hits, {} misses'.format(org_name, *gh_session.response_cache.stats()))
+    return results
+
+
+def _init_worker():
+    global _in_worker
+    _in_worker = True
+    # connections in the pool were inherited from the parent process and must not be shared with it
+    dispose_engine()
+
+
+def _run_org_in_worker(org_id, org_name, **kwargs):
+    """
+    run_org in a worker process, also returning the metrics of the org to be merged into those of the parent process
+    """
+    METRICS.reset()
+    return run_org(org_id, org_name, **kwargs), METRICS.snapshot()
+
+
+def run_profiles(db_session, gh_session, profile_stages=PROFILE_STAGES):
+    """
+    fetch the profiles of the users the orgs' stages stored without one (see ghstats.gh.enrich_users). Run once every
+    org is done, so commits are never stored waiting on a profile.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param profile_stages: the names of the stages to run under cProfile
+    :type profile_stages: Iterable[str]
+    :return: the result of the stage
+    :rtype: StageResult
+    """
+    start = time.monotonic()
+    try:
+        with METRICS.labels(stage='profiles'), profile('profiles', stages=profile_stages):
+            fetched = enrich_users(db_session, gh_session)
+    except Exception:
+        db_session.rollback()
+        seconds = time.monotonic() - start
+        logger.exception('profiles: failed after {:.1f}s'.format(seconds))
+        return StageResult('*', 'profiles', 'failed', seconds, None)
+    seconds = time.monotonic() - start
+    logger.info('profiles: done in {:.1f}s ({} rows)'.format(seconds, fetched))
+    return StageResult('*', 'profiles', 'ok', seconds, fetched)
+
+
+def format_summary(results):
+    """
+    :param results: the results of the stages that were run
+    :type results: Iterable[StageResult]
+    :return: a table of the results, one line per org and stage
+    :rtype: str
+    """
+    lines = ['{:<30}{:<10}{:<10}{:>10}{:>10}'.format('org', 'stage', 'status', 'seconds', 'rows')]
+    for result in results:
+        lines.append('{:<30}{:<10}{:<10}{:>10.1f}{:>10}'.format(
+            result.org, result.stage, result.status, result.seconds, '' if result.rows is None else result.rows))
+    return '\n'.join(lines)
+
+
+def run_sync(db_session, gh_session, org_names, processes=SYNC_PROCESSES, metrics_path=METRICS_PATH,
+             profile_stages=PROFILE_STAGES):
+    """
+    get the given orgs and then run the stages of each org in the database, with up to `processes` orgs at once, and
+    finally fetch the profiles of the new users. The metrics of the run are logged at the end, and written to
+    metrics_path if set.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param gh_session: the requests session with the github api
+    :type gh_session: requests.sessions.Session
+    :param org_names: list of organisation login names
+    :type org_names: List[str]
+    :param processes: number of worker processes to run orgs in
+    :type processes: int
+    :param metrics_path: the file to write the metrics of the run to (see ghstats.metrics.Metrics.write), if any
+    :type metrics_path: Union[str, None]
+    :param profile_stages: the names of the stages to run under cProfile
+    :type profile_stages: Iterable[str]
+    :return: the result of each stage of each org
+    :rtype: List[StageResult]
+    """
+    start = time.monotonic()
+    orgs = [(org.id, org.name) for org in get_orgs(db_session, gh_session, org_names)]
+    if gh_session.archive is not None:
+        gh_session.archive.flush()
+    db_session.commit()
+    results = []
+    if processes <= 1:
+        for org_id, org_name in orgs:
+            results.extend(run_org(org_id, org_name, profile_stages=profile_stages))
+    else:
+        # every process has its own view of the rate limit budgets, so leave room for all of their requests in flight
+        buffer = RATE_LIMIT_BUFFER * processes * max(COMMIT_FETCH_WORKERS, 1)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as executor:
+            futures = {
+                executor.submit(_run_org_in_worker, org_id, org_name, rate_limit_buffer=buffer,
+                                profile_stages=profile_stages): org_name
+                for org_id, org_name in orgs
+            }
+            for finished, future in enumerate(as_completed(futures), 1):
+                org_results, metrics = future.result()
+                results.extend(org_results)
+                METRICS.merge(metrics)
+                logger.info('{}: finished ({} of {} orgs)'.format(futures[future], finished, len(orgs)))
+    results.append(run_profiles(db_session, gh_session, profile_stages=profile_stages))
+    logger.info('sync finished in {:.1f}s\n{}'.format(time.monotonic() - start, format_summary(results)))
+    logger.info('metrics per stage:\n{}'.format(METRICS.format_summary('stage')))
+    logger.info('busiest repos:\n{}'.format(METRICS.format_summary('repo', limit=10)))
+    if metrics_path:
+        METRICS.write(metrics_path)
+    return results
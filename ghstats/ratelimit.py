@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from functools import partial
+from urllib.parse import urlsplit
+
+from requests.auth import AuthBase, HTTPBasicAuth
+
+from ghstats.metrics import METRICS
+from ghstats.utils import hms
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BUFFER = 5
+# extra seconds to wait after github says the rate limit resets
+RESET_SLACK = 60
+# the rate limit resources (as named by the x-ratelimit-resource header) of the rest and graphql apis, whose budgets
+# github counts separately
+CORE = 'core'
+GRAPHQL = 'graphql'
+
+
+class Credential(object):
+    """
+    A github login and token along with what is known about its rate limit budget for each resource
+    """
+
+    def __init__(self, login, token):
+        """
+        :param login: the github login
+        :type login: str
+        :param token: the oauth token of the login
+        :type token: str
+        """
+        self.login = login
+        self.token = token
+        # by resource. Unknown until a response tells us otherwise (or after the rate limit has reset)
+        self.remaining = {}  # type: Dict[str, int]
+        self.reset_at = {}  # type: Dict[str, float]
+
+    def headroom(self, buffer, resource=CORE):
+        """
+        :param buffer: number of requests to always leave unused
+        :type buffer: int
+        :param resource: the rate limit resource
+        :type resource: str
+        :return: the number of requests that can still be made with this credential
+        :rtype: float
+        """
+        if resource not in self.remaining:
+            return float('inf')
+        return self.remaining[resource] - buffer
+
+
+class RateLimitManager(object):
+    """
+    Tracks the rate limit budget of a pool of github credentials and hands out the one with the most headroom for each
+    request. Only when every credential is exhausted does it block until the earliest one resets.
+
+    Each resource (the core rest api, graphql) has its own budget per credential, as github counts them separately.
+    The remaining budget of a credential is decremented as soon as it is handed out, so concurrent requests can not
+    overspend it, and corrected (downwards only, until the rate limit resets) from the headers of each response.
+    """
+
+    def __init__(self, credentials, buffer=RATE_LIMIT_BUFFER):
+        """
+        :param credentials: the login and token of each credential
+        :type credentials: List[Tuple[str, str]]
+        :param buffer: number of requests to always leave unused on each credential
+        :type buffer: int
+        """
+        if not credentials:
+            raise ValueError('at least one github credential is required')
+        self.credentials = [Credential(login, token) for login, token in credentials]
+        self.buffer = buffer
+        self._lock = threading.Lock()
+
+    def _refresh(self, now):
+        for credential in self.credentials:
+            for resource, reset_at in list(credential.reset_at.items()):
+                if reset_at <= now:
+                    del credential.remaining[resource], credential.reset_at[resource]
+
+    def acquire(self, resource=CORE):
+        """
+        get the credential with the most headroom, waiting for a rate limit reset if every credential is exhausted
+
+        :param resource: the rate limit resource the request is charged to
+        :type resource: str
+        :return: the credential to make the next request with
+        :rtype: Credential
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refresh(now)
+                credential = max(self.credentials, key=lambda c: c.headroom(self.buffer, resource))
+                if credential.headroom(self.buffer, resource) > 0:
+                    if resource in credential.remaining:
+                        credential.remaining[resource] -= 1
+                    return credential
+                delay = min(c.reset_at[resource] for c in self.credentials) - now + RESET_SLACK
+            logger.info('all {} github credentials are out of requests, waiting {}:{}:{}'.format(
+                len(self.credentials), *hms(int(delay))))
+            with METRICS.timer('rate_limit_sleep'):
+                time.sleep(max(delay, 1))
+
+    def update(self, credential, response):
+        """
+        update the known budget of a credential from the rate limit headers of a response made with it
+
+        :param credential: the credential the request was made with
+        :type credential: Credential
+        :param response: the response from a github api call
+        :type response: requests.models.Response
+        """
+        remaining = response.headers.get('x-ratelimit-remaining')
+        reset_at = response.headers.get('x-ratelimit-reset')
+        if remaining is None or reset_at is None:
+            return
+        resource = response.headers.get('x-ratelimit-resource', CORE)
+        remaining, reset_at = int(remaining), float(reset_at)
+        with self._lock:
+            if resource not in credential.remaining or reset_at > credential.reset_at[resource]:
+                credential.remaining[resource] = remaining
+                credential.reset_at[resource] = reset_at
+            else:
+                credential.remaining[resource] = min(credential.remaining[resource], remaining)
+
+    def budget(self, resource=CORE):
+        """
+        :param resource: the rate limit resource
+        :type resource: str
+        :return: the known remaining requests and reset time of each credential. remaining is None when unknown
+        :rtype: List[Dict[str, Union[str, int, float, None]]]
+        """
+        with self._lock:
+            self._refresh(time.time())
+            return [
+                dict(login=c.login, remaining=c.remaining.get(resource), reset_at=c.reset_at.get(resource, 0.0))
+                for c in self.credentials
+            ]
+
+    def headroom(self, resource=CORE):
+        """
+        :param resource: the rate limit resource
+        :type resource: str
+        :return: the total number of requests that can be made before a request has to wait for a reset
+        :rtype: float
+        """
+        with self._lock:
+            self._refresh(time.time())
+            return sum(max(c.headroom(self.buffer, resource), 0) for c in self.credentials)
+
+
+class RotatingAuth(AuthBase):
+    """
+    requests auth which signs each request with the credential a RateLimitManager hands out and reports the response
+    back to it
+    """
+
+    def __init__(self, manager):
+        """
+        :param manager: the rate limit manager to get credentials from
+        :type manager: RateLimitManager
+        """
+        self.manager = manager
+
+    def _on_response(self, credential, response, **kwargs):
+        self.manager.update(credential, response)
+        return response
+
+    def __call__(self, r):
+        # graphql queries are POSTed to <...>/graphql and charged to their own budget rather than the rest api's
+        resource = GRAPHQL if urlsplit(r.url).path.endswith('/graphql') else CORE
+        credential = self.manager.acquire(resource)
+        r = HTTPBasicAuth(credential.login, credential.token)(r)
+        r.register_hook('response', partial(self._on_response, credential))
+        return r
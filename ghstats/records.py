@@ -0,0 +1,79 @@
+"""
+Compact records of the github commit payloads, holding only the fields that are stored. Commit details carry the full
+patch of every file they change, which can be megabytes, so they are projected to a record as soon as they are decoded
+and the payload is dropped, instead of being kept around while the commit waits to be stored.
+"""
+
+from ghstats.utils import parse_gh_date
+
+
+class CommitFile(object):
+    """
+    A file changed by a commit, without its patch
+    """
+    __slots__ = ('filename', 'status', 'additions', 'deletions')
+
+    def __init__(self, filename, status, additions, deletions):
+        self.filename = filename  # type: str
+        self.status = status  # type: str
+        self.additions = additions  # type: int
+        self.deletions = deletions  # type: int
+
+
+class CommitRecord(object):
+    """
+    The fields of a github commit that are stored. author and committer are the id and login of the github user, or
+    None if the email is not linked to a github account.
+    """
+    __slots__ = ('sha', 'parents', 'message', 'author', 'author_email', 'authored_at', 'committer', 'committer_email',
+                 'committed_at', 'additions', 'deletions', 'files')
+
+    def __init__(self, sha, parents, message, author, author_email, authored_at, committer, committer_email,
+                 committed_at, additions=0, deletions=0, files=()):
+        self.sha = sha  # type: bytes
+        self.parents = parents  # type: Tuple[bytes, ...]
+        self.message = message  # type: str
+        self.author = author  # type: Union[Dict[str, Union[int, str]], None]
+        self.author_email = author_email  # type: Union[str, None]
+        self.authored_at = authored_at  # type: datetime.datetime
+        self.committer = committer  # type: Union[Dict[str, Union[int, str]], None]
+        self.committer_email = committer_email  # type: Union[str, None]
+        self.committed_at = committed_at  # type: datetime.datetime
+        self.additions = additions  # type: int
+        self.deletions = deletions  # type: int
+        self.files = files  # type: Tuple[CommitFile, ...]
+
+
+def _user(user):
+    return {'id': user['id'], 'login': user['login']} if user else None
+
+
+def commit_record(payload):
+    """
+    project a github commit object onto a CommitRecord. Commits from a listing have no stats or files, which are left
+    at zero and empty.
+
+    :param payload: github commit object from api (or in its shape, see ghstats.graphql and ghstats.mirror)
+    :type payload: dict
+    :return: the record of the commit
+    :rtype: CommitRecord
+    """
+    commit = payload['commit']
+    stats = payload.get('stats') or {}
+    return CommitRecord(
+        sha=bytes.fromhex(payload['sha']),
+        parents=tuple(bytes.fromhex(parent['sha']) for parent in payload.get('parents', ())),
+        message=commit['message'],
+        author=_user(payload.get('author')),
+        author_email=commit['author']['email'],
+        authored_at=parse_gh_date(commit['author']['date']),
+        committer=_user(payload.get('committer')),
+        committer_email=commit['committer']['email'],
+        committed_at=parse_gh_date(commit['committer']['date']),
+        additions=stats.get('additions', 0),
+        deletions=stats.get('deletions', 0),
+        files=tuple(
+            CommitFile(file['filename'], file['status'], file['additions'], file['deletions'])
+            for file in payload.get('files', ())
+        ),
+    )
@@ -0,0 +1,208 @@
+"""
+Rebuilds the database from the payload archive (see ghstats.archive) without any github requests, eg after changing how
+commits are mapped to rows. The orgs, with their members and teams, are replayed first, then the repos are replayed in
+worker processes, one repo partition at a time.
+
+Replaying only adds what is not in the database yet, except that the members of each org and team are set to those of
+its last archived listing. With replace, the commits of each repo are deleted and rebuilt from the archive in a single
+transaction, so a replay that fails leaves the repo as it was. Profiles are not archived: those of the users first seen
+in the archive are fetched by the next sync (see enrich_users).
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from sqlalchemy import or_, select
+
+from ghstats.archive import list_partitions, iter_partition
+from ghstats.config import ARCHIVE_DIR, REINGEST_PROCESSES
+from ghstats.gh import _upsert_by_ext_id, _store_members, _store_teams, _store_team_members, _store_repos, \
+    _store_commit, _get_refs, _update_refs, _sync_membership, _user_ids
+from ghstats.identity import IdentityCache
+from ghstats.orm.orm import Organisation, Repo, Commit, File, Ref, DailyContribution, commit_parent_table, \
+    organisation_user_table
+from ghstats.records import commit_record
+from ghstats.session import SessionManager, get_session_maker, dispose_engine
+from ghstats.shaindex import ShaIndex
+from ghstats.writer import CommitWriter
+
+logger = logging.getLogger(__name__)
+
+REPLAY_BATCH = 1000
+
+# the identity cache of this worker process, preloaded on first use
+_identities = None
+
+
+def _latest_by_id(payloads, key=lambda payload: payload['id']):
+    """
+    :return: the last payload of each id, as later payloads replace earlier ones
+    :rtype: List[dict]
+    """
+    return list({key(payload): payload for payload in payloads}.values())
+
+
+def _batches(items, size=REPLAY_BATCH):
+    items = iter(items)
+    return iter(lambda: list(islice(items, size)), [])
+
+
+def reingest_org(db_session, directory, partition):
+    """
+    replay the archived payloads of an org: the org itself, its members and its teams with their members
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param directory: the root directory of the archive
+    :type directory: str
+    :param partition: the partition of the org
+    :type partition: Tuple[str, ...]
+    :return: the Organisation row object, or None if the org is neither archived nor in the database
+    :rtype: Union[ghstats.orm.orm.Organisation, None]
+    """
+    payloads = {'org': [], 'member': [], 'membership': [], 'team': [], 'team_members': []}
+    for kind, payload in iter_partition(directory, partition):
+        payloads[kind].append(payload)
+    rows = [dict(ext_id=org['id'], name=org['login']) for org in _latest_by_id(payloads['org'])]
+    _upsert_by_ext_id(db_session, Organisation, rows, ['name'])
+    org = db_session.query(Organisation).filter(Organisation.name == partition[-1]).scalar()
+    if org is None:
+        logger.warning('{}: not in the archive or the database, skipped'.format(partition[-1]))
+        return None
+    user_ids = []
+    for users in _batches(_latest_by_id(payloads['member'])):
+        user_ids.extend(row.id for row in _store_members(db_session, users))
+    if payloads['membership']:
+        # the members listed by the last sync, so those who had left by then are removed
+        membership = payloads['membership'][-1]
+        _sync_membership(db_session, organisation_user_table.c.org_id, org.id,
+                         _user_ids(db_session, membership['members']), membership['complete'])
+    else:
+        # archived before the membership was, so it is not known who left
+        _sync_membership(db_session, organisation_user_table.c.org_id, org.id, user_ids, remove=False)
+    team_rows = {}
+    for teams in _batches(_latest_by_id(payloads['team'])):
+        team_rows.update((team_row.ext_id, team_row) for team_row in _store_teams(db_session, org.id, teams))
+    for team_members in _latest_by_id(payloads['team_members'], key=lambda payload: payload['team']):
+        if team_members['team'] in team_rows:
+            _store_team_members(db_session, team_rows[team_members['team']], team_members['members'],
+                                remove=team_members.get('complete', True))
+    logger.info('{}: replayed {} members and {} teams'.format(org.name, len(payloads['member']), len(team_rows)))
+    return org
+
+
+def _clear_repo(db_session, repo_id):
+    """
+    delete the commits of a repo, with their files, parent links, daily contributions and refs. The deletion is not
+    committed, so that it only is along with the replayed commits
+
+    :return: the heads of the refs of the repo, to be restored once the commits are replayed
+    :rtype: Dict[str, bytes]
+    """
+    heads = _get_refs(db_session, repo_id)
+    commit_ids = select([Commit.id]).where(Commit.repo_id == repo_id)
+    db_session.query(Ref).filter(Ref.repo_id == repo_id).delete(synchronize_session=False)
+    db_session.execute(commit_parent_table.delete().where(or_(
+        commit_parent_table.c.child_id.in_(commit_ids), commit_parent_table.c.parent_id.in_(commit_ids))))
+    db_session.query(File).filter(File.commit_id.in_(commit_ids)).delete(synchronize_session=False)
+    db_session.query(Commit).filter(Commit.repo_id == repo_id).delete(synchronize_session=False)
+    db_session.query(DailyContribution).filter(DailyContribution.repo_id == repo_id).delete(synchronize_session=False)
+    return heads
+
+
+def reingest_repo(directory, partition, replace=False):
+    """
+    replay the archived payloads of a repo: the repo itself, then each of its commits that is not in the database. Runs
+    in its own database session so it can be run in a worker process.
+
+    :param directory: the root directory of the archive
+    :type directory: str
+    :param partition: the partition of the repo
+    :type partition: Tuple[str, ...]
+    :param replace: whether to delete the commits of the repo and rebuild them all from the archive, in one transaction.
+        Only use this if the archive has been kept since the repo was first synced, or the commits missing from it are
+        lost
+    :type replace: bool
+    :return: the number of commits stored
+    :rtype: int
+    """
+    global _identities
+    _, org_name, repo_name = partition
+    with SessionManager(get_session_maker()) as db_session:
+        if _identities is None:
+            _identities = IdentityCache().preload(db_session)
+        org = db_session.query(Organisation).filter(Organisation.name == org_name).scalar()
+        repos = _latest_by_id(payload for _, payload in iter_partition(directory, partition, kinds=('repo',)))
+        if org is not None and repos:
+            _store_repos(db_session, org.id, repos)
+        repo = db_session.query(Repo).join(Organisation).filter(
+            Organisation.name == org_name, Repo.name == repo_name).scalar()  # type: Repo
+        if repo is None:
+            logger.warning('{}/{}: not in the archive or the database, skipped'.format(org_name, repo_name))
+            return 0
+        repo_id = repo.id
+        heads = _clear_repo(db_session, repo_id) if replace else {}
+        index = ShaIndex() if replace else ShaIndex.load(db_session, repo_id)
+        commits = (commit_record(payload) for _, payload in iter_partition(directory, partition, kinds=('commit',)))
+        try:
+            # when replacing, nothing is committed until every commit is replayed and the refs are restored
+            with CommitWriter(db_session, commit_batches=not replace) as writer:
+                for batch in _batches(commits):
+                    known = index.known(db_session, [commit.sha for commit in batch])
+                    for commit in batch:
+                        if commit.sha not in known and commit.sha not in index:
+                            index.add(commit.sha)
+                            _store_commit(db_session, None, writer, _identities, repo_id, commit.sha, commit)
+            if heads:
+                _update_refs(db_session, repo_id, heads, prune=False)
+        except Exception:
+            # the emails and users added by the rolled back transaction must not be used for the next repo
+            _identities.clear()
+            raise
+        logger.info('{}/{}: replayed {} commits'.format(org_name, repo_name, writer.commits_written))
+        return writer.commits_written
+
+
+def _init_worker():
+    # connections in the pool were inherited from the parent process and must not be shared with it
+    dispose_engine()
+
+
+def reingest(db_session, directory=ARCHIVE_DIR, processes=REINGEST_PROCESSES, orgs=None, replace=False):
+    """
+    rebuild the database from the archive: the orgs first, then up to `processes` repos at once
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param directory: the root directory of the archive
+    :type directory: str
+    :param processes: number of worker processes to replay repos in
+    :type processes: int
+    :param orgs: only replay these orgs (and their repos), all of them if None
+    :type orgs: Union[Iterable[str], None]
+    :param replace: whether to delete the commits of each repo and rebuild them all from the archive
+    :type replace: bool
+    :return: the number of commits stored
+    :rtype: int
+    """
+    if not directory:
+        raise ValueError('no archive to reingest from, set [ARCHIVE] path or pass one')
+    orgs = set(orgs) if orgs is not None else None
+    for partition in list_partitions(directory, 'orgs'):
+        if orgs is None or partition[-1] in orgs:
+            reingest_org(db_session, directory, partition)
+    db_session.commit()
+    partitions = [
+        partition for partition in list_partitions(directory, 'repos') if orgs is None or partition[1] in orgs
+    ]
+    if processes <= 1:
+        replayed = sum(reingest_repo(directory, partition, replace) for partition in partitions)
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as executor:
+            replayed = sum(executor.map(
+                reingest_repo, [directory] * len(partitions), partitions, [replace] * len(partitions)))
+    if replace:
+        # the replaced commits are new rows, which an incremental export would add alongside those it exported before
+        logger.warning('commits were replaced, run `ghstats export --full` to rebuild any exported datasets')
+    return replayed
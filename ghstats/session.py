@@ -1,12 +1,61 @@
+"""
+Factories for the connections to the database and the github api. Nothing is created when the module is imported: the
+engine is created by the first call to get_engine (or get_session_maker) in each process, so importing the package
+costs no connection setup and needs no database or github settings.
+"""
+
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from ghstats.config import DB_CONNECTION_STRING, GITHUB_USERNAME, GITHUB_OAUTH_TOKEN
+from ghstats.archive import PayloadArchive
+from ghstats.cache import ResponseCache, CachingAdapter
+from ghstats.config import BASE_GH_URL, RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_SIZE, ARCHIVE_DIR, DB_POOL_SIZE, \
+    DB_MAX_OVERFLOW, HTTP_POOL_SIZE, db_connection_string, github_credentials
+from ghstats.metrics import instrument_engine, record_response
+from ghstats.ratelimit import RateLimitManager, RotatingAuth
+
+_engine = None
+_session_maker = None
+_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    :return: the engine of this process, created (with the configured pool size) on first use
+    :rtype: sqlalchemy.engine.Engine
+    """
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = create_engine(db_connection_string(), pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+            instrument_engine(_engine)
+        return _engine
 
-engine = create_engine(DB_CONNECTION_STRING)
 
-Session = sessionmaker(bind=engine)
+def get_session_maker():
+    """
+    :return: the session maker bound to the engine of this process
+    :rtype: sqlalchemy.orm.session.sessionmaker
+    """
+    global _session_maker
+    engine = get_engine()
+    with _lock:
+        if _session_maker is None:
+            _session_maker = sessionmaker(bind=engine)
+        return _session_maker
+
+
+def dispose_engine():
+    """
+    close the pooled connections of the engine, if it has been created. Worker processes must call this first, as the
+    connections they inherited from their parent must not be shared with it.
+    """
+    if _engine is not None:
+        _engine.dispose()
 
 
 class SessionManager(object):
@@ -41,13 +90,37 @@ class SessionManager(object):
             return True
 
 
-def get_gh_session():
+def get_gh_session(cache_path=RESPONSE_CACHE_PATH, cache_max_size=RESPONSE_CACHE_MAX_SIZE, rate_limits=None,
+                   archive_dir=ARCHIVE_DIR, pool_size=HTTP_POOL_SIZE):
+    """
+    Create a requests session with the github api. Each request is made with whichever of the configured credentials
+    has the most rate limit left.
+
+    :param cache_path: sqlite file to cache responses in, if any
+    :type cache_path: Union[str, None]
+    :param cache_max_size: maximum size of the cached response bodies in bytes
+    :type cache_max_size: int
+    :param rate_limits: the rate limit manager to share with other sessions. One is created if None
+    :type rate_limits: Union[ghstats.ratelimit.RateLimitManager, None]
+    :param archive_dir: directory to archive the payloads stored from the session's responses in, if any
+    :type archive_dir: Union[str, None]
+    :param pool_size: number of connections to keep open per host, which should be at least the number of threads
+        making requests with the session
+    :type pool_size: int
+    :rtype: requests.sessions.Session
+    """
     s = requests.Session()
-    s.auth = (GITHUB_USERNAME, GITHUB_OAUTH_TOKEN)
+    s.rate_limits = rate_limits if rate_limits is not None else RateLimitManager(github_credentials())
+    s.auth = RotatingAuth(s.rate_limits)
     s.headers.update({'Accept': 'application/vnd.github.v3+json'})
-    s.headers.update({'User-Agent': GITHUB_USERNAME})
+    # github asks for the login of the account making the requests
+    s.headers.update({'User-Agent': s.rate_limits.credentials[0].login})
+    s.hooks['response'].append(record_response)
+    s.response_cache = None
+    s.archive = PayloadArchive(archive_dir) if archive_dir else None
+    for prefix in ('https://', 'http://'):
+        s.mount(prefix, HTTPAdapter(pool_maxsize=pool_size))
+    if cache_path:
+        s.response_cache = ResponseCache(cache_path, cache_max_size)
+        s.mount(BASE_GH_URL, CachingAdapter(s.response_cache, pool_maxsize=pool_size))
     return s
-
-
-db_session_manager = SessionManager(Session)
-gh_session_manager = get_gh_session()
@@ -0,0 +1,115 @@
+import logging
+from bisect import bisect_left
+
+from ghstats.orm.orm import Commit
+
+logger = logging.getLogger(__name__)
+
+SHA_SIZE = 20
+# the least number of shas added to an index before they are merged into its digests
+MERGE_SIZE = 10000
+
+
+class _Digests(object):
+    """
+    read-only sequence view of a bytes object of concatenated, fixed size digests, for bisect
+    """
+
+    def __init__(self, blob):
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.blob) // SHA_SIZE
+
+    def __getitem__(self, i):
+        return self.blob[i * SHA_SIZE:(i + 1) * SHA_SIZE]
+
+
+class ShaIndex(object):
+    """
+    A set of commit shas held as a single sorted bytes object of 20 byte digests, which takes 20 bytes per commit
+    where a python set of bytes objects takes around 90. Membership is a binary search. Shas added after the index was
+    built are kept in a small set, which is merged into the digests once it holds a quarter as many shas (and at least
+    merge_size), so that adding every commit of a repo costs memory and time in proportion to their number.
+
+    Commit shas are unique across repos, so an index of one repo's commits can not tell that a commit is new: use
+    known() to also check the shas it does not contain against the database, in a single query.
+    """
+
+    def __init__(self, shas=(), merge_size=MERGE_SIZE):
+        """
+        :param shas: the shas to build the index from
+        :type shas: Iterable[bytes]
+        :param merge_size: the least number of added shas to merge into the digests at once
+        :type merge_size: int
+        """
+        self._digests = _Digests(b''.join(sorted(set(shas))))
+        self._added = set()
+        self.merge_size = merge_size
+
+    @classmethod
+    def load(cls, db_session, repo_id, batch_size=10000):
+        """
+        build the index of the commits of a repo, streaming the shas from the database in sorted order
+
+        :param db_session: the database session
+        :type db_session: sqlalchemy.orm.session.Session
+        :param repo_id: the id of the Repo row
+        :type repo_id: uuid.UUID
+        :param batch_size: number of shas to fetch at once
+        :type batch_size: int
+        :return: the index
+        :rtype: ShaIndex
+        """
+        index = cls()
+        q = db_session.query(Commit.sha).filter(Commit.repo_id == repo_id).order_by(Commit.sha).yield_per(batch_size)
+        index._digests = _Digests(b''.join(bytes(sha) for sha, in q))
+        logger.debug('indexed {} known commits of repo {}'.format(len(index), repo_id))
+        return index
+
+    def __len__(self):
+        return len(self._digests) + len(self._added)
+
+    def __contains__(self, sha):
+        if sha in self._added:
+            return True
+        i = bisect_left(self._digests, sha)
+        return i < len(self._digests) and self._digests[i] == sha
+
+    def add(self, sha):
+        """
+        :param sha: the sha of a commit to add to the index
+        :type sha: bytes
+        """
+        if sha not in self:
+            self._added.add(sha)
+            if len(self._added) >= max(self.merge_size, len(self._digests) // 4):
+                self.merge()
+
+    def merge(self):
+        """
+        fold the shas added since the index was built into the sorted digests
+        """
+        if self._added:
+            blob = self._digests.blob
+            shas = [blob[i:i + SHA_SIZE] for i in range(0, len(blob), SHA_SIZE)]
+            self._digests = _Digests(b''.join(sorted(shas + list(self._added))))
+            self._added = set()
+
+    def known(self, db_session, shas):
+        """
+        find which of the given shas are commits in the index or in the database, querying the database once for all
+        the shas not in the index
+
+        :param db_session: the database session
+        :type db_session: sqlalchemy.orm.session.Session
+        :param shas: the shas of the commits to look up
+        :type shas: List[bytes]
+        :return: the shas that are known
+        :rtype: Set[bytes]
+        """
+        known = {sha for sha in shas if sha in self}
+        unknown = [sha for sha in shas if sha not in known]
+        if unknown:
+            known.update(bytes(sha) for sha, in db_session.query(Commit.sha).filter(Commit.sha.in_(unknown)))
+        return known
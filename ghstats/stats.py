@@ -0,0 +1,254 @@
+"""
+Contribution stats served from the daily_contributions rollup rather than by scanning commits, and the queries that
+keep the rollup up to date. Stats of the files under a directory are served from the prefix index of the paths table.
+"""
+
+import logging
+
+from sqlalchemy import func, text, distinct
+
+from ghstats.orm.orm import DailyContribution, Commit, File, Path, team_user_table
+
+logger = logging.getLogger(__name__)
+
+# serialises the refreshes of the given repos until the end of the transaction. Without it, two transactions refreshing
+# the same day both delete the rows the other has not committed yet and both insert theirs, counting the day twice. The
+# locks are taken in a fixed order so that two transactions refreshing the same repos cannot deadlock
+LOCK_REPOS_QUERY = text('''
+SELECT pg_advisory_xact_lock(repo_key)
+FROM (
+    SELECT DISTINCT hashtext(repo_id) AS repo_key FROM unnest(CAST(:repo_ids AS TEXT[])) AS touched (repo_id) ORDER BY 1
+) AS keys
+''')
+# recomputes the rows of the given (repo, day) pairs from the commits authored in the repo on that day
+DELETE_DAYS_QUERY = text('''
+DELETE FROM daily_contributions AS rollup
+USING unnest(CAST(:repo_ids AS UUID[]), CAST(:days AS DATE[])) AS touched (repo_id, day)
+WHERE rollup.repo_id = touched.repo_id AND rollup.day = touched.day
+''')
+INSERT_DAYS_QUERY = text('''
+INSERT INTO daily_contributions (day, repo_id, org_id, user_id, commits, additions, deletions)
+SELECT touched.day, touched.repo_id, repos.org_id, commits.author_id, count(*),
+       coalesce(sum(commits.additions), 0), coalesce(sum(commits.deletions), 0)
+FROM unnest(CAST(:repo_ids AS UUID[]), CAST(:days AS DATE[])) AS touched (repo_id, day)
+JOIN commits ON commits.repo_id = touched.repo_id
+    AND commits.authored_at >= touched.day AND commits.authored_at < touched.day + 1
+JOIN repos ON repos.id = touched.repo_id
+GROUP BY touched.day, touched.repo_id, repos.org_id, commits.author_id
+''')
+REBUILD_QUERY = text('''
+INSERT INTO daily_contributions (day, repo_id, org_id, user_id, commits, additions, deletions)
+SELECT CAST(commits.authored_at AS DATE), commits.repo_id, repos.org_id, commits.author_id, count(*),
+       coalesce(sum(commits.additions), 0), coalesce(sum(commits.deletions), 0)
+FROM commits
+JOIN repos ON repos.id = commits.repo_id
+WHERE commits.authored_at IS NOT NULL
+GROUP BY CAST(commits.authored_at AS DATE), commits.repo_id, repos.org_id, commits.author_id
+''')
+
+GROUP_COLUMNS = {
+    'user': DailyContribution.user_id,
+    'repo': DailyContribution.repo_id,
+    'org': DailyContribution.org_id,
+    'team': team_user_table.c.team_id,
+}
+PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def refresh_days(db_session, repo_days):
+    """
+    recompute the rollup rows of the given days of the given repos. Run in the same transaction as the commits that
+    touched them, the rollup is never out of step with the commits table. Transactions refreshing the same repo wait
+    for each other, so each one recomputes the days from the commits the other committed.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param repo_days: the (repo id, day) pairs to recompute
+    :type repo_days: Iterable[Tuple[uuid.UUID, datetime.date]]
+    """
+    repo_days = sorted(set(repo_days))
+    if not repo_days:
+        return
+    params = {
+        'repo_ids': [str(repo_id) for repo_id, _ in repo_days],
+        'days': [day for _, day in repo_days],
+    }
+    db_session.execute(LOCK_REPOS_QUERY, params)
+    db_session.execute(DELETE_DAYS_QUERY, params)
+    db_session.execute(INSERT_DAYS_QUERY, params)
+
+
+def rebuild(db_session):
+    """
+    recompute the whole rollup from the commits table, eg after commits were loaded without refreshing it
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :return: the number of rollup rows
+    :rtype: int
+    """
+    # refreshes started meanwhile wait for the rebuild to commit, rather than adding to the rows it inserts
+    db_session.execute(text('LOCK TABLE daily_contributions IN EXCLUSIVE MODE'))
+    db_session.query(DailyContribution).delete(synchronize_session=False)
+    rows = db_session.execute(REBUILD_QUERY).rowcount
+    logger.info('rebuilt daily contributions: {} rows'.format(rows))
+    return rows
+
+
+def contributions_query(db_session, by=('user',), period='week', since=None, until=None, org_id=None, repo_id=None,
+                        user_id=None, team_id=None):
+    """
+    build the query of the commits, additions and deletions per group and period. Grouping by or filtering on a team
+    counts the contributions of its current members.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param by: what to group by, any of 'user', 'repo', 'org' and 'team'
+    :type by: Iterable[str]
+    :param period: the period to group days into, one of PERIODS, or None for the totals over the whole range
+    :type period: Union[str, None]
+    :param since: only count contributions on or after this day
+    :type since: Union[datetime.date, None]
+    :param until: only count contributions before this day
+    :type until: Union[datetime.date, None]
+    :param org_id: only count contributions to the repos of this org
+    :type org_id: Union[uuid.UUID, None]
+    :param repo_id: only count contributions to this repo
+    :type repo_id: Union[uuid.UUID, None]
+    :param user_id: only count contributions of this user
+    :type user_id: Union[uuid.UUID, None]
+    :param team_id: only count contributions of the members of this team
+    :type team_id: Union[uuid.UUID, None]
+    :return: a query of rows with a <group>_id column per group, a 'period' column (the first day of the period) if
+        period is not None, and 'commits', 'additions' and 'deletions' columns, ordered by period
+    :rtype: sqlalchemy.orm.query.Query
+    """
+    by = tuple(by)
+    unknown = set(by) - set(GROUP_COLUMNS)
+    if unknown:
+        raise ValueError('unknown groups: {}'.format(', '.join(sorted(unknown))))
+    if period is not None and period not in PERIODS:
+        raise ValueError('unknown period: {}'.format(period))
+    groups = [GROUP_COLUMNS[name].label('{}_id'.format(name)) for name in by]
+    if period is not None:
+        groups.append(func.date_trunc(period, DailyContribution.day).label('period'))
+    q = db_session.query(
+        *groups,
+        func.sum(DailyContribution.commits).label('commits'),
+        func.sum(DailyContribution.additions).label('additions'),
+        func.sum(DailyContribution.deletions).label('deletions')
+    ).select_from(DailyContribution)
+    if 'team' in by or team_id is not None:
+        q = q.join(team_user_table, team_user_table.c.user_id == DailyContribution.user_id)
+    if since is not None:
+        q = q.filter(DailyContribution.day >= since)
+    if until is not None:
+        q = q.filter(DailyContribution.day < until)
+    if org_id is not None:
+        q = q.filter(DailyContribution.org_id == org_id)
+    if repo_id is not None:
+        q = q.filter(DailyContribution.repo_id == repo_id)
+    if user_id is not None:
+        q = q.filter(DailyContribution.user_id == user_id)
+    if team_id is not None:
+        q = q.filter(team_user_table.c.team_id == team_id)
+    if groups:
+        q = q.group_by(*groups)
+    if period is not None:
+        q = q.order_by('period')
+    return q
+
+
+def contributions(db_session, by=('user',), period='week', **filters):
+    """
+    run contributions_query, eg to get the lines added per author per week of an org:
+
+        contributions(db_session, by=('user',), period='week', org_id=org.id)
+
+    :return: rows with a <group>_id column per group, a 'period' column if period is not None, and 'commits',
+        'additions' and 'deletions' columns, ordered by period
+    :rtype: List[sqlalchemy.util.KeyedTuple]
+    """
+    return contributions_query(db_session, by=by, period=period, **filters).all()
+
+
+def top_contributors(db_session, since=None, until=None, org_id=None, repo_id=None, team_id=None, limit=10,
+                     order_by='commits'):
+    """
+    the users with the most commits (or additions or deletions) over a range of days
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param since: only count contributions on or after this day
+    :type since: Union[datetime.date, None]
+    :param until: only count contributions before this day
+    :type until: Union[datetime.date, None]
+    :param org_id: only count contributions to the repos of this org
+    :type org_id: Union[uuid.UUID, None]
+    :param repo_id: only count contributions to this repo
+    :type repo_id: Union[uuid.UUID, None]
+    :param team_id: only count contributions of the members of this team
+    :type team_id: Union[uuid.UUID, None]
+    :param limit: the number of users to return
+    :type limit: int
+    :param order_by: one of 'commits', 'additions' or 'deletions'
+    :type order_by: str
+    :return: rows with 'user_id', 'commits', 'additions' and 'deletions' columns, most contributions first
+    :rtype: List[sqlalchemy.util.KeyedTuple]
+    """
+    if order_by not in ('commits', 'additions', 'deletions'):
+        raise ValueError('unknown order: {}'.format(order_by))
+    q = contributions_query(db_session, by=('user',), period=None, since=since, until=until, org_id=org_id,
+                            repo_id=repo_id, team_id=team_id)
+    return q.filter(DailyContribution.user_id.isnot(None)).order_by(text('{} DESC'.format(order_by))).limit(limit).all()
+
+
+def _prefix_pattern(prefix):
+    """
+    :return: a LIKE pattern matching the strings starting with prefix
+    :rtype: str
+    """
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def subtree_churn(db_session, prefix, since=None, until=None, repo_id=None, per_path=False):
+    """
+    the commits, additions and deletions of the changes to the files under a directory (or any other path prefix),
+    eg subtree_churn(db_session, 'services/billing/'). The paths are found with the prefix index of the paths table and
+    their changes with the path_id index of the files table, so neither table is scanned.
+
+    :param db_session: the database session
+    :type db_session: sqlalchemy.orm.session.Session
+    :param prefix: the path prefix, with a trailing / to match a directory
+    :type prefix: str
+    :param since: only count commits authored on or after this time
+    :type since: Union[datetime.datetime, None]
+    :param until: only count commits authored before this time
+    :type until: Union[datetime.datetime, None]
+    :param repo_id: only count commits to this repo
+    :type repo_id: Union[uuid.UUID, None]
+    :param per_path: whether to return a row per path rather than the totals of the subtree
+    :type per_path: bool
+    :return: rows with 'commits', 'additions' and 'deletions' columns, and a 'path' column if per_path
+    :rtype: List[sqlalchemy.util.KeyedTuple]
+    """
+    columns = [
+        func.count(distinct(File.commit_id)).label('commits'),
+        func.coalesce(func.sum(File.additions), 0).label('additions'),
+        func.coalesce(func.sum(File.deletions), 0).label('deletions'),
+    ]
+    if per_path:
+        columns.insert(0, Path.path.label('path'))
+    q = db_session.query(*columns).select_from(File).join(Path, Path.id == File.path_id).filter(
+        Path.path.like(_prefix_pattern(prefix), escape='\\'))
+    if since is not None or until is not None or repo_id is not None:
+        q = q.join(Commit, Commit.id == File.commit_id)
+    if since is not None:
+        q = q.filter(Commit.authored_at >= since)
+    if until is not None:
+        q = q.filter(Commit.authored_at < until)
+    if repo_id is not None:
+        q = q.filter(Commit.repo_id == repo_id)
+    if per_path:
+        q = q.group_by(Path.path).order_by(Path.path)
+    return q.all()
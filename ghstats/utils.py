@@ -1,8 +1,16 @@
 import logging
 import re
 import time
+from collections import deque
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from ghstats.metrics import METRICS
+
 logger = logging.getLogger(__name__)
 LINK_RE = re.compile(r'<(?P<link>.+)>; rel="next"')
 
@@ -27,10 +35,11 @@ def time_to_reset(response):
 
     :param response: the response from a github api call
     :type response: requests.models.Response
-    :return: number of seconds until github resets rate limit
-    :rtype: int
+    :return: number of seconds until github resets rate limit, or None if the response does not say
+    :rtype: Union[int, None]
     """
-    return int(float(response.headers.get('x-ratelimit-reset')) - time.time())
+    reset_at = response.headers.get('x-ratelimit-reset')
+    return None if reset_at is None else int(float(reset_at) - time.time())
 
 
 def rate_limit_remaining(response):
@@ -39,15 +48,121 @@ def rate_limit_remaining(response):
 
     :param response: the response from a github api call
     :type response: requests.models.Response
-    :return: number of requests left until github applies rate limit
-    :rtype: int
+    :return: number of requests left until github applies rate limit, or None if the response does not say
+    :rtype: Union[int, None]
+    """
+    remaining = response.headers.get('x-ratelimit-remaining')
+    return None if remaining is None else int(remaining)
+
+
+def bounded_map(executor, fn, iterable, window):
+    """
+    Like executor.map, but only keeps `window` calls in flight at once and consumes `iterable` lazily. Results are
+    yielded in the same order as the input.
+
+    :param executor: the executor to run the calls in
+    :type executor: concurrent.futures.Executor
+    :param fn: the function to call for each item
+    :type fn: Callable
+    :param iterable: the items to call fn with
+    :type iterable: Iterable
+    :param window: maximum number of calls in flight at once
+    :type window: int
+    :return: the results of fn, in input order
+    :rtype: Iterator
     """
-    return int(response.headers.get('x-ratelimit-remaining'))
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def decode_json(response):
+    """
+    decode the json body of a response, with orjson if it is installed (the 'fast' extra), which parses large payloads
+    several times faster than the json module
+
+    :param response: the response from a github api call
+    :type response: requests.models.Response
+    :return: the decoded body
+    :rtype: Any
+    :raises ValueError: if the body is not valid json
+    """
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+def _get_page(session, url):
+    """
+    Get a single page of a request, waiting for github to finish computing the result if it responds with a 202.
+    Rate limiting is left to the session's RotatingAuth.
+
+    :param session: the requests session
+    :type session: requests.sessions.Session
+    :param url: github api url to get
+    :type url: str
+    :return: the response for the page
+    :rtype: requests.models.Response
+    """
+    while True:
+        response = session.get(url)
+        rate_limit, reset = rate_limit_remaining(response), time_to_reset(response)
+        # responses from a cache, a proxy or an enterprise server without rate limiting carry no rate limit headers
+        if rate_limit is not None and reset is not None:
+            logger.debug('{:<6}{:<10}{}'.format(rate_limit, '{}:{}:{}'.format(*hms(reset)), url))
+        if response.status_code != 202:
+            return response
+        METRICS.incr('http_202_retries')
+        time.sleep(2)
+
+
+def iter_pages(session, url):
+    """
+    Go through all pages of a request, yielding the results of each page as it arrives
+
+    :param session: the requests session
+    :type session: requests.sessions.Session
+    :param url: github api url to get
+    :type url: str
+    :return: an iterator of the list of results in each page and the response code of that page
+    :rtype: Iterator[Tuple[list, int]]
+    """
+    while url is not None:
+        response = _get_page(session, url)
+        try:
+            resp = decode_json(response)
+            items = resp if isinstance(resp, list) else [resp]
+        except ValueError:
+            logger.error(response.text)
+            items = []
+        next_page = LINK_RE.match(response.headers['link']) if 'link' in response.headers else None
+        url = next_page.group('link') if next_page else None
+        yield items, response.status_code
+
+
+def iter_all(session, url):
+    """
+    Go through all pages of a request, yielding each result as it arrives
+
+    :param session: the requests session
+    :type session: requests.sessions.Session
+    :param url: github api url to get
+    :type url: str
+    :return: an iterator of all results
+    :rtype: Iterator[dict]
+    """
+    for items, _ in iter_pages(session, url):
+        yield from items
 
 
 def get_all(session, url, agg=None):
     """
-    Go through all pages of a request and return the aggregated result
+    Go through all pages of a request and return the aggregated result. Prefer iter_all for requests which may return
+    many pages.
 
     :param session: the requests session
     :type session: requests.sessions.Session
@@ -59,27 +174,10 @@ def get_all(session, url, agg=None):
     :rtype: Tuple[list, int]
     """
     agg = [] if agg is None else agg
-    response = session.get(url)
-    rate_limit = rate_limit_remaining(response)
-    if rate_limit < 5:
-        time.sleep(time_to_reset(response) + 60)
-    logger.debug('{:<6}{:<10}{}'.format(rate_limit, '{}:{}:{}'.format(*hms(time_to_reset(response))), url))
-    if response.status_code == 202:
-        time.sleep(2)
-        return get_all(session, url, agg)
-    try:
-        resp = response.json()
-        if isinstance(resp, list):
-            agg += resp
-        else:
-            agg.append(resp)
-    except ValueError:
-        logger.error(response.text)
-    next_page = LINK_RE.match(response.headers['link']) if 'link' in response.headers else None
-    if next_page:
-        return get_all(session, next_page.group('link'), agg)
-    else:
-        return agg, response.status_code
+    status_code = None
+    for items, status_code in iter_pages(session, url):
+        agg += items
+    return agg, status_code
 
 
 def parse_gh_date(date):
@@ -91,4 +189,20 @@ def parse_gh_date(date):
     :return: the timestamp as a datetime object
     :rtype: datetime.datetime
     """
-    return datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
+    # the format is fixed, so slicing it is much faster than strptime, which is kept for anything else
+    if len(date) != 20 or date[4] != '-' or date[7] != '-' or date[10] != 'T' or date[19] != 'Z':
+        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(date[11:13]), int(date[14:16]),
+                    int(date[17:19]))
+
+
+def format_gh_date(date):
+    """
+    return the given datetime as an ISO 8601 timestamp as used by the github api
+
+    :param date: the timestamp as a datetime object
+    :type date: datetime.datetime
+    :return: a timestamp in ISO 8601 format: YYYY-MM-DDTHH:MM:SSZ
+    :rtype: str
+    """
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,258 @@
+import io
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from ghstats.config import WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_METHOD, REFRESH_ROLLUPS, PATH_CACHE_SIZE
+from ghstats.metrics import METRICS
+from ghstats.orm.orm import Commit, File
+from ghstats.stats import refresh_days
+
+logger = logging.getLogger(__name__)
+
+COMMIT_COLUMNS = (
+    'id', 'name', 'sha', 'repo_id', 'additions', 'deletions', 'committer_id', 'committer_email_id', 'committed_at',
+    'author_id', 'author_email_id', 'authored_at',
+)
+FILE_COLUMNS = ('id', 'commit_id', 'path_id', 'status', 'additions', 'deletions')
+
+# links each (child sha, parent sha) pair by looking up the ids of both commits
+PARENT_LINK_QUERY = text('''
+INSERT INTO commit_parent (child_id, parent_id)
+SELECT child.id, parent.id
+FROM unnest(CAST(:children AS BYTEA[]), CAST(:parents AS BYTEA[])) AS link (child_sha, parent_sha)
+JOIN commits child ON child.sha = link.child_sha
+JOIN commits parent ON parent.sha = link.parent_sha
+ON CONFLICT DO NOTHING
+''')
+# paths are inserted in sorted order so concurrent writers inserting the same new paths can not deadlock
+INSERT_PATHS_QUERY = text('''
+INSERT INTO paths (path)
+SELECT path FROM unnest(CAST(:paths AS TEXT[])) AS path ORDER BY path
+ON CONFLICT DO NOTHING
+''')
+PATH_IDS_QUERY = text('SELECT path, id FROM paths WHERE path = ANY(CAST(:paths AS TEXT[]))')
+KNOWN_PARENTS_QUERY = text('SELECT sha FROM commits WHERE sha = ANY(CAST(:shas AS BYTEA[]))')
+
+
+def _copy_value(value):
+    """
+    encode a value for the text format of postgres' COPY
+
+    :param value: the value to encode
+    :type value: Union[None, str, bytes, int, datetime.datetime, uuid.UUID]
+    :return: the encoded value
+    :rtype: str
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CommitWriter(object):
+    """
+    Buffers new commits and their file changes and writes them to the database in bulk. A batch is written (and
+    committed in its own transaction) once batch_size commits are buffered or flush_interval seconds have passed since
+    the last write, so a failure only ever loses the batch being written.
+
+    Commit and file ids are generated client side so file rows can reference their commit without a round trip.
+    Parent links are written by sha, so they can be recorded before the parent commit is stored. As history is walked
+    newest first, a link whose parent is not in the database yet is kept until a later batch writes the parent.
+
+    The path of each file is interned in the paths table, with the ids of recently written paths cached.
+
+    With refresh_rollups, the daily contributions of every (repo, day) a batch touches are recomputed in the same
+    transaction.
+
+    With an archive, the archived payloads are flushed before each batch is committed, so every commit written can be
+    rebuilt from the archive.
+
+    Without commit_batches, the batches are written in the transaction of the session, for the caller to commit.
+    """
+
+    def __init__(self, db_session, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL,
+                 method=WRITE_METHOD, refresh_rollups=REFRESH_ROLLUPS, archive=None, commit_batches=True):
+        """
+        :param db_session: the database session
+        :type db_session: sqlalchemy.orm.session.Session
+        :param batch_size: number of commits to buffer before writing them
+        :type batch_size: int
+        :param flush_interval: maximum number of seconds to buffer commits for
+        :type flush_interval: float
+        :param method: how to write a batch: 'insert' for multi-row INSERTs or 'copy' for postgres' COPY
+        :type method: str
+        :param refresh_rollups: whether to refresh the daily contributions of the days touched by each batch
+        :type refresh_rollups: bool
+        :param archive: the payload archive the commits are added to, if any
+        :type archive: Union[ghstats.archive.PayloadArchive, None]
+        :param commit_batches: whether to commit each batch once it is written
+        :type commit_batches: bool
+        """
+        if method not in ('insert', 'copy'):
+            raise ValueError('unknown write method: {}'.format(method))
+        self.db_session = db_session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.method = method
+        self.refresh_rollups = refresh_rollups
+        self.archive = archive
+        self.commit_batches = commit_batches
+        self.commits_written = 0
+        self.files_written = 0
+        self._commits = []
+        self._files = []
+        self._parents = []
+        self._path_ids = OrderedDict()
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+            if self._parents:
+                logger.debug('dropped {} links to parents that were never stored'.format(len(self._parents)))
+        return False
+
+    @property
+    def pending_parents(self):
+        """
+        :return: the (child sha, parent sha) links that are waiting for their parent commit to be stored
+        :rtype: List[Tuple[bytes, bytes]]
+        """
+        return list(self._parents)
+
+    def add_parent_links(self, links):
+        """
+        buffer links between commits that may already be stored, eg the pending_parents of another writer
+
+        :param links: the (child sha, parent sha) of each link
+        :type links: Iterable[Tuple[bytes, bytes]]
+        """
+        self._parents.extend(links)
+
+    def add(self, commit, files, parents=()):
+        """
+        buffer a commit and its file changes, writing the buffered batch if it is due
+
+        :param commit: the values of the commits row, keyed by column name (without id)
+        :type commit: Dict[str, Any]
+        :param files: the values of each files row, keyed by column name (without id and commit_id), with the 'filename'
+            of the file in place of its path_id
+        :type files: List[Dict[str, Any]]
+        :param parents: the shas of the parents of the commit
+        :type parents: Iterable[bytes]
+        :return: the id of the new commit
+        :rtype: uuid.UUID
+        """
+        commit_id = uuid.uuid4()
+        self._commits.append(dict(commit, id=commit_id))
+        self._files.extend(dict(file, id=uuid.uuid4(), commit_id=commit_id) for file in files)
+        self._parents.extend((commit['sha'], parent) for parent in parents)
+        if len(self._commits) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return commit_id
+
+    def flush(self):
+        """
+        write all buffered commits and files, along with any other pending changes in the session, in one transaction
+        (which is committed if commit_batches)
+        """
+        try:
+            self.db_session.flush()
+            if self._commits:
+                self._write(Commit.__table__, COMMIT_COLUMNS, self._commits)
+            path_ids = self._intern_paths() if self._files else {}
+            if self._files:
+                self._write(File.__table__, FILE_COLUMNS, self._files)
+            parents = self._write_parents() if self._parents else []
+            if self.refresh_rollups:
+                refresh_days(self.db_session, {
+                    (commit['repo_id'], commit['authored_at'].date())
+                    for commit in self._commits if commit['authored_at'] is not None
+                })
+            if self.archive is not None:
+                self.archive.flush()
+            if self.commit_batches:
+                self.db_session.commit()
+        except Exception:
+            logger.exception('failed to write a batch of {} commits and {} files'.format(
+                len(self._commits), len(self._files)))
+            self.db_session.rollback()
+            self._commits, self._files, self._parents = [], [], []
+            raise
+        self._parents = parents
+        self._cache_paths(path_ids)
+        self.commits_written += len(self._commits)
+        self.files_written += len(self._files)
+        METRICS.incr('commits_written', len(self._commits))
+        METRICS.incr('files_written', len(self._files))
+        logger.debug('wrote {} commits and {} files'.format(len(self._commits), len(self._files)))
+        self._commits, self._files = [], []
+        self._last_flush = time.monotonic()
+
+    def _intern_paths(self):
+        """
+        set the path_id of each buffered file, inserting the paths that are not in the paths table yet
+
+        :return: the id of each path of the buffered files
+        :rtype: Dict[str, int]
+        """
+        path_ids = {}
+        missing = []
+        for path in {file['filename'] for file in self._files}:
+            if path in self._path_ids:
+                path_ids[path] = self._path_ids[path]
+                self._path_ids.move_to_end(path)
+            else:
+                missing.append(path)
+        if missing:
+            self.db_session.execute(INSERT_PATHS_QUERY, {'paths': missing})
+            path_ids.update(self.db_session.execute(PATH_IDS_QUERY, {'paths': missing}).fetchall())
+        for file in self._files:
+            file['path_id'] = path_ids[file['filename']]
+        return path_ids
+
+    def _cache_paths(self, path_ids):
+        # only called once the paths are committed, so a rolled back batch never leaves unknown ids in the cache
+        self._path_ids.update(path_ids)
+        while len(self._path_ids) > PATH_CACHE_SIZE:
+            self._path_ids.popitem(last=False)
+
+    def _write_parents(self):
+        """
+        write the buffered parent links whose parent commit is in the database
+
+        :return: the links that could not be written yet
+        :rtype: List[Tuple[bytes, bytes]]
+        """
+        shas = list({bytes(parent) for _, parent in self._parents})
+        known = {bytes(sha) for sha, in self.db_session.execute(KNOWN_PARENTS_QUERY, {'shas': shas})}
+        links = [link for link in self._parents if bytes(link[1]) in known]
+        if links:
+            children, parents = zip(*links)
+            self.db_session.execute(PARENT_LINK_QUERY, {'children': list(children), 'parents': list(parents)})
+        return [link for link in self._parents if bytes(link[1]) not in known]
+
+    def _write(self, table, columns, rows):
+        if self.method == 'copy':
+            buf = io.StringIO()
+            for row in rows:
+                buf.write('\t'.join(_copy_value(row.get(column)) for column in columns))
+                buf.write('\n')
+            buf.seek(0)
+            cursor = self.db_session.connection().connection.cursor()
+            cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(columns)), buf)
+        else:
+            for i in range(0, len(rows), 1000):
+                self.db_session.execute(table.insert().values([
+                    {column: row.get(column) for column in columns} for row in rows[i:i + 1000]
+                ]))
@@ -38,6 +38,11 @@ setup(
     ],
     packages=find_packages(),
     install_requires=install_requires,
+    extras_require={
+        'export': ['pyarrow>=8'],
+        'analytics': ['numpy'],
+        'fast': ['orjson'],
+    },
     scripts=['bin/ghstats'],
     tests_require=tests_require,
 )
@@ -0,0 +1,41 @@
+import os
+
+# the settings are read when ghstats.config is first imported, so a local config.ini or response cache must not leak
+# into the tests
+os.environ['GH_DATA_CONFIG'] = os.devnull
+os.environ['GH_CACHE_PATH'] = ''
+os.environ.pop('GH_ARCHIVE_DIR', None)
+
+import pytest  # noqa: E402
+
+# the sqlalchemy url of a throwaway postgres database, in which every table is dropped and recreated by the tests that
+# need one. They are skipped if it is not set
+TEST_DB_ENV = 'GH_TEST_DB'
+
+
+@pytest.fixture
+def session_maker():
+    """
+    :return: a session maker for a freshly created schema in the test database
+    :rtype: sqlalchemy.orm.session.sessionmaker
+    """
+    url = os.getenv(TEST_DB_ENV)
+    if not url:
+        pytest.skip('{} is not set'.format(TEST_DB_ENV))
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from ghstats.orm import GHDBase
+
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        connection.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+    GHDBase.metadata.drop_all(engine)
+    GHDBase.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def credentials(monkeypatch):
+    monkeypatch.setenv('GITHUB_LOGIN', 'someone')
+    monkeypatch.setenv('GITHUB_TOKEN', 'secret')
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from ghstats.archive import PayloadArchive, iter_partition, repo_partition
+from ghstats.gh import _archive_commit
+from ghstats.records import commit_record
+
+PAYLOAD = {
+    'sha': 'a' * 40,
+    'html_url': 'https://github.com/org/repo/commit/' + 'a' * 40,
+    'parents': [{'sha': 'b' * 40}],
+    'commit': {
+        'message': 'fix the thing',
+        'author': {'name': 'Someone', 'email': 'someone@example.com', 'date': '2020-01-02T03:04:05Z'},
+        'committer': {'name': 'Someone', 'email': 'someone@example.com', 'date': '2020-01-02T03:04:06Z'},
+        'verification': {'verified': False},
+    },
+    'author': {'login': 'someone', 'id': 1, 'type': 'User'},
+    'committer': None,
+    'stats': {'additions': 3, 'deletions': 1, 'total': 4},
+    'files': [{'filename': 'a.py', 'status': 'modified', 'additions': 3, 'deletions': 1, 'changes': 4,
+               'patch': '@@ -1 +1,3 @@\n-old\n+new\n+new\n+new'}],
+}
+
+
+def test_commits_are_archived_as_decoded_without_patches(tmpdir):
+    archive = PayloadArchive(str(tmpdir))
+    partition = repo_partition('org', 'repo')
+    _archive_commit(SimpleNamespace(archive=archive), partition, PAYLOAD)
+    archive.flush()
+
+    (kind, archived), = iter_partition(str(tmpdir), partition)
+
+    assert kind == 'commit'
+    assert 'patch' not in archived['files'][0]
+    assert 'patch' in PAYLOAD['files'][0]
+    # fields the records do not keep are still there to be mapped by a later reingest
+    assert archived['html_url'] == PAYLOAD['html_url']
+    assert archived['commit']['verification'] == {'verified': False}
+    assert archived['files'][0]['changes'] == 4
+    record = commit_record(archived)
+    assert (record.sha.hex(), record.additions, record.files[0].filename) == ('a' * 40, 3, 'a.py')
+
+
+def test_commits_are_not_archived_without_a_partition(tmpdir):
+    archive = PayloadArchive(str(tmpdir))
+    _archive_commit(SimpleNamespace(archive=archive), None, PAYLOAD)
+    archive.flush()
+
+    assert not tmpdir.listdir()
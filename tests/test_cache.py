@@ -0,0 +1,30 @@
+import json
+
+import requests
+
+from benchmarks.stub import StubServer, fixture_name
+from ghstats.cache import CachingAdapter, ResponseCache
+
+SHA = 'a' * 40
+
+
+def _record(directory, path, body):
+    with open(str(directory.join(fixture_name(path))), 'w') as f:
+        json.dump({'status': 200, 'headers': {'ETag': '"{}"'.format(path)}, 'body': body}, f)
+
+
+def test_caching_adapter_skips_commit_details(tmpdir):
+    _record(tmpdir, '/repos/org/repo/commits', [{'sha': SHA}])
+    _record(tmpdir, '/repos/org/repo/commits/{}'.format(SHA), {'sha': SHA, 'files': [{'patch': '@@ -1 +1 @@'}]})
+    cache = ResponseCache(str(tmpdir.join('cache.sqlite')), 1024 * 1024)
+    session = requests.Session()
+    session.mount('http://', CachingAdapter(cache))
+
+    with StubServer(str(tmpdir)) as base_url:
+        for path in ('/repos/org/repo/commits', '/repos/org/repo/commits/{}'.format(SHA)):
+            assert session.get(base_url + path).status_code == 200
+
+        assert cache.get(base_url + '/repos/org/repo/commits') is not None
+        assert cache.get(base_url + '/repos/org/repo/commits/{}'.format(SHA)) is None
+    assert cache.stats() == (0, 1)
+    cache.close()
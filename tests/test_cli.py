@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin', 'ghstats')
+
+# loads the cli in a fresh interpreter and lists the ghstats modules it imported, without running a command
+LIST_IMPORTS = '''
+import sys
+from importlib.machinery import SourceFileLoader
+SourceFileLoader('cli', sys.argv[1]).load_module().get_parser().parse_args(['export'])
+print(' '.join(sorted(sys.modules)))
+'''
+
+
+def test_cli_imports_the_module_of_a_subcommand_only_when_it_runs():
+    modules = subprocess.run([sys.executable, '-c', LIST_IMPORTS, CLI], check=True, stdout=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.dirname(CLI))).stdout.decode().split()
+
+    assert 'ghstats.session' in modules
+    assert not {'ghstats.export', 'ghstats.jobs', 'ghstats.pipeline', 'ghstats.reingest', 'pyarrow'} & set(modules)
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import pytest
+
+from ghstats.export import export, read_watermark
+from ghstats.orm.orm import Commit, Organisation, Repo
+
+pytest.importorskip('pyarrow')
+
+
+def _commit(db_session, repo, i):
+    db_session.add(Commit(bytes([i]) * 20, 'commit {}'.format(i), repo, 1, 0, committed_at=datetime(2020, 1, i),
+                          authored_at=datetime(2020, 1, i)))
+
+
+def test_export_waits_for_the_commits_of_open_transactions(session_maker, tmpdir):
+    export_dir = str(tmpdir)
+    db_session = session_maker()
+    repo = Repo(1, 'repo', Organisation(1, 'org'))
+    db_session.add(repo)
+    _commit(db_session, repo, 1)
+    db_session.commit()
+    # a long transaction (eg reingest --replace) whose commits are added when it started, but committed after
+    writer = session_maker()
+    _commit(writer, writer.query(Repo).one(), 2)
+    writer.flush()
+
+    assert export(db_session, export_dir, settle_seconds=0) == (1, 0)
+    db_session.commit()
+    writer.commit()
+    writer.close()
+    assert read_watermark(export_dir) < db_session.query(Commit.added_at).filter(Commit.name == 'commit 2').scalar()
+
+    assert export(db_session, export_dir, settle_seconds=0) == (1, 0)
+    db_session.close()
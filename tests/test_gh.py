@@ -0,0 +1,74 @@
+import json
+from types import SimpleNamespace
+
+from benchmarks.stub import StubServer, fixture_name
+from ghstats import gh
+from ghstats.gh import _new_commits, enrich_users
+from ghstats.identity import IdentityCache
+from ghstats.orm.orm import Email, User
+from ghstats.session import get_gh_session
+
+
+def _sha(name):
+    return name.encode().ljust(20, b'\0')
+
+
+def _commit(name, *parents):
+    return SimpleNamespace(sha=_sha(name), parents=tuple(_sha(parent) for parent in parents))
+
+
+def test_new_commits_of_a_branch_merged_after_the_last_sync(monkeypatch):
+    """
+    the default branch was synced at head, then a feature branch dated before it was merged:
+
+        * merge (newest)
+        |\\
+        * | head (previously synced)
+        | * feature-2 (dated before head)
+        | * feature-1
+        |/
+        * base
+        * root
+    """
+    listing = [
+        _commit('merge', 'head', 'feature-2'), _commit('head', 'base'), _commit('feature-2', 'feature-1'),
+        _commit('feature-1', 'base'), _commit('base', 'root'), _commit('root'),
+    ]
+    stored = {_sha('head'), _sha('base'), _sha('root')}
+    lookups = []
+
+    def known_shas(db_session, shas):
+        lookups.append(shas)
+        return stored.intersection(shas)
+
+    monkeypatch.setattr(gh, '_list_commits', lambda gh_session, repo, branch, backend, partition=None: iter(listing))
+    monkeypatch.setattr(gh, '_known_shas', known_shas)
+    listed = []
+    sync_state = SimpleNamespace(head_sha=_sha('head'))
+
+    commits = list(_new_commits(None, None, None, None, 'main', sync_state, 'rest', listed))
+
+    assert [sha for sha, _ in commits] == [_sha('merge'), _sha('feature-2'), _sha('feature-1')]
+    assert listed == [_sha('merge')]
+    # the previous head is known without a lookup
+    assert _sha('head') not in lookups[0]
+
+
+def test_enrich_users_invalidates_the_emails_it_links(session_maker, credentials, tmpdir, monkeypatch):
+    with open(str(tmpdir.join(fixture_name('/users/someone'))), 'w') as f:
+        json.dump({'status': 200, 'headers': {}, 'body': {'id': 1, 'login': 'someone', 'email': 'me@example.com'}}, f)
+    db_session = session_maker()
+    db_session.add_all([User(1, 'someone'), Email('me@example.com')])
+    db_session.commit()
+    email_id = db_session.query(Email.id).scalar()
+    identities = IdentityCache()
+    identities.put_email('me@example.com', email_id, None)
+    gh_session = get_gh_session(cache_path=None, archive_dir=None)
+
+    with StubServer(str(tmpdir)) as base_url:
+        monkeypatch.setattr(gh, 'BASE_GH_URL', base_url)
+        assert enrich_users(db_session, gh_session, identities=identities) == 1
+
+    assert identities.get_email('me@example.com') is None
+    assert db_session.query(Email.user_id).scalar() is not None
+    db_session.close()
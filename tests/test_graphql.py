@@ -0,0 +1,140 @@
+import importlib
+from datetime import datetime
+
+import pytest
+
+from benchmarks.stub import StubServer
+from ghstats import config
+from ghstats.graphql import GraphQLError, iter_history, _utc_date
+from ghstats.ratelimit import RateLimitManager
+from ghstats.session import get_gh_session
+
+
+def _node(i, date='2020-01-01T00:00:00Z'):
+    actor = {
+        'email': 'user{}@example.com'.format(i),
+        'date': date,
+        'user': {'databaseId': i, 'login': 'user{}'.format(i)},
+    }
+    return {
+        'oid': '{:040x}'.format(i),
+        'message': 'commit {}'.format(i),
+        'parents': {'nodes': [{'oid': '{:040x}'.format(i - 1)}] if i > 1 else []},
+        'additions': i,
+        'deletions': 1,
+        'author': actor,
+        'committer': dict(actor, user=None),
+    }
+
+
+def _history(nodes, has_next_page=False, end_cursor=None):
+    return {'data': {'repository': {'ref': {'target': {'history': {
+        'pageInfo': {'hasNextPage': has_next_page, 'endCursor': end_cursor},
+        'nodes': nodes,
+    }}}}}}
+
+
+class GraphQLStub(object):
+    """
+    answers the history queries of iter_history with the given responses, one per request, recording the requests
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        return 200, {}, self.responses.pop(0)
+
+
+@pytest.fixture
+def gh_session():
+    return get_gh_session(cache_path=None, rate_limits=RateLimitManager([('someone', 'secret')]), archive_dir=None)
+
+
+def _iter_history(gh_session, stub, **kwargs):
+    with StubServer(post_handlers={'/graphql': stub}) as base_url:
+        return list(iter_history(gh_session, 'org', 'repo', url=base_url + '/graphql', **kwargs))
+
+
+def test_iter_history_follows_the_end_cursor(gh_session):
+    stub = GraphQLStub(
+        _history([_node(3), _node(2)], has_next_page=True, end_cursor='cursor-1'),
+        _history([_node(1)]),
+    )
+
+    commits = _iter_history(gh_session, stub, page_size=2, branch='main')
+
+    assert [commit['sha'] for commit in commits] == ['{:040x}'.format(i) for i in (3, 2, 1)]
+    assert [request['variables']['cursor'] for request in stub.requests] == [None, 'cursor-1']
+    assert all(request['variables']['first'] == 2 for request in stub.requests)
+    assert stub.requests[0]['variables']['branch'] == 'refs/heads/main'
+    assert commits[0]['author'] == {'id': 3, 'login': 'user3'}
+    assert commits[0]['committer'] is None
+    assert commits[0]['stats'] == {'additions': 3, 'deletions': 1}
+    assert commits[0]['parents'] == [{'sha': '{:040x}'.format(2)}]
+    assert commits[-1]['parents'] == []
+
+
+def test_iter_history_sends_the_since_cutoff(gh_session):
+    stub = GraphQLStub(_history([_node(1)]), _history([_node(1)]))
+
+    _iter_history(gh_session, stub, since=datetime(2020, 1, 2, 3, 4, 5))
+    _iter_history(gh_session, stub)
+
+    assert stub.requests[0]['variables']['since'] == '2020-01-02T03:04:05Z'
+    assert stub.requests[1]['variables'].get('since') is None
+    assert 'branch' not in stub.requests[1]['variables']
+
+
+def test_iter_history_converts_dates_to_utc(gh_session):
+    stub = GraphQLStub(_history([
+        _node(2, date='2020-01-05T10:00:00+10:00'),
+        _node(1, date='2020-01-04T20:30:00-05:00'),
+    ]))
+
+    commits = _iter_history(gh_session, stub)
+
+    assert [commit['commit']['author']['date'] for commit in commits] == [
+        '2020-01-05T00:00:00Z', '2020-01-05T01:30:00Z']
+
+
+@pytest.mark.parametrize('date, expected', [
+    ('2016-06-19T17:26:57+10:00', '2016-06-19T07:26:57Z'),
+    ('2016-06-19T17:26:57-09:30', '2016-06-20T02:56:57Z'),
+    ('2016-06-19T17:26:57Z', '2016-06-19T17:26:57Z'),
+    ('2016-06-19T17:26:57+00:00', '2016-06-19T17:26:57Z'),
+])
+def test_utc_date(date, expected):
+    assert _utc_date(date) == expected
+
+
+def test_iter_history_raises_the_errors_of_a_response(gh_session):
+    stub = GraphQLStub({'data': None, 'errors': [{'message': 'Something went wrong'}, {'message': 'and again'}]})
+
+    with pytest.raises(GraphQLError) as e:
+        _iter_history(gh_session, stub)
+
+    assert str(e.value) == 'Something went wrong; and again'
+    assert len(e.value.errors) == 2
+
+
+def test_iter_history_of_a_missing_branch_is_empty(gh_session):
+    stub = GraphQLStub({'data': {'repository': {'ref': None}}})
+
+    assert _iter_history(gh_session, stub, branch='gone') == []
+
+
+@pytest.mark.parametrize('api_url, graphql_url', [
+    ('https://api.github.com', 'https://api.github.com/graphql'),
+    ('https://github.example.com/api/v3', 'https://github.example.com/api/graphql'),
+    ('https://github.example.com/api/v3/', 'https://github.example.com/api/graphql'),
+])
+def test_graphql_url_follows_the_api_url(monkeypatch, api_url, graphql_url):
+    monkeypatch.setenv('GH_API_URL', api_url)
+    try:
+        assert importlib.reload(config).GRAPHQL_URL == graphql_url
+    finally:
+        monkeypatch.undo()
+        importlib.reload(config)
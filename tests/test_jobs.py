@@ -0,0 +1,113 @@
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from ghstats import jobs
+from ghstats.identity import IdentityCache
+from ghstats.jobs import Lease, LeaseLost, _Heartbeat, claim, enqueue, handler, run_job
+from ghstats.orm.orm import Job, Organisation
+
+
+@pytest.fixture
+def queue(session_maker, monkeypatch):
+    """
+    :return: a session maker for the test database, which the job queue uses too
+    :rtype: sqlalchemy.orm.session.sessionmaker
+    """
+    monkeypatch.setattr(jobs, 'get_session_maker', lambda: session_maker)
+    monkeypatch.setattr(jobs, 'get_engine', lambda: session_maker.kw['bind'])
+    monkeypatch.setitem(jobs.HANDLERS, 'test', None)
+    return session_maker
+
+
+def _claim(session_maker, kind):
+    db_session = session_maker()
+    enqueue(db_session, [(kind, '{}:1'.format(kind), {})])
+    db_session.commit()
+    lease = claim(db_session, 'worker:0', kinds=[kind])
+    db_session.commit()
+    db_session.close()
+    return lease
+
+
+def _run(lease, **kwargs):
+    return run_job(lease, SimpleNamespace(archive=None), **kwargs)
+
+
+def _job(session_maker):
+    db_session = session_maker()
+    job = db_session.query(Job).one()
+    db_session.close()
+    return job
+
+
+def test_run_job_marks_the_job_done(queue):
+    @handler('test')
+    def run(db_session, gh_session, lease):
+        db_session.add(Organisation(1, 'org'))
+        lease.report(orgs=1)
+
+    assert _run(_claim(queue, 'test'))
+
+    job = _job(queue)
+    assert (job.status, job.progress) == ('done', {'orgs': 1})
+    assert queue().query(Organisation).count() == 1
+
+
+def test_run_job_rolls_back_once_the_lease_is_lost(queue):
+    @handler('test')
+    def run(db_session, gh_session, lease):
+        db_session.add(Organisation(1, 'org'))
+        # eg the heartbeat failed to renew the lease and another worker claimed the job again
+        lease.lost = True
+        db_session.commit()
+
+    assert not _run(_claim(queue, 'test'))
+
+    assert _job(queue).status == 'running'
+    assert queue().query(Organisation).count() == 0
+
+
+def test_run_job_does_not_complete_a_job_claimed_again(queue):
+    @handler('test')
+    def run(db_session, gh_session, lease):
+        db_session.add(Organisation(1, 'org'))
+        # the lease expired and the job was claimed again, by another attempt of the same worker
+        lease.attempts -= 1
+
+    assert not _run(_claim(queue, 'test'))
+
+    assert _job(queue).status == 'running'
+    assert queue().query(Organisation).count() == 0
+
+
+def test_run_job_forgets_the_identities_of_a_rolled_back_job(queue, monkeypatch):
+    identities = IdentityCache()
+    monkeypatch.setattr(jobs, '_identities', identities)
+
+    @handler('test')
+    def run(db_session, gh_session, lease):
+        identities.put_email('someone@example.com', uuid.uuid4(), None)
+        raise RuntimeError('boom')
+
+    assert not _run(_claim(queue, 'test'))
+
+    assert identities.get_email('someone@example.com') is None
+    assert _job(queue).status == 'pending'
+
+
+def test_heartbeat_gives_up_the_lease_when_it_can_not_renew_it(monkeypatch):
+    def get_engine():
+        raise OSError('the database went away')
+
+    monkeypatch.setattr(jobs, 'get_engine', get_engine)
+    lease = Lease(1, 'test', {}, 1, 5, 'worker:0')
+    heartbeat = _Heartbeat(lease, seconds=0.03)
+
+    heartbeat.start()
+    heartbeat.join(5)
+
+    assert not heartbeat.is_alive()
+    with pytest.raises(LeaseLost):
+        lease.check()
@@ -0,0 +1,52 @@
+import uuid
+
+import pytest
+
+from ghstats import pipeline
+from ghstats.pipeline import Stage, run_org
+
+
+@pytest.fixture
+def stub_stages(monkeypatch, credentials):
+    """
+    run stages without a database: each stage is called with only the github session and the outputs it requires
+    """
+    def run_stage(stage, gh_session, org_id, inputs, profile_stages=()):
+        return stage.run(None, gh_session, None, inputs)
+
+    monkeypatch.setattr(pipeline, '_run_stage', run_stage)
+
+
+def test_run_org_runs_stages_after_their_requirements(stub_stages):
+    calls = []
+
+    def stage(name, output):
+        def run(db_session, gh_session, org, inputs):
+            assert gh_session.headers['User-Agent'] == 'someone'
+            calls.append((name, inputs))
+            return output
+        return run
+
+    stages = (
+        Stage('users', stage('users', [1, 2]), ()),
+        Stage('repos', stage('repos', [3]), ()),
+        Stage('commits', stage('commits', 7), ('users', 'repos')),
+    )
+    results = run_org(uuid.uuid4(), 'some-org', stages=stages)
+
+    assert {(result.stage, result.status, result.rows) for result in results} == {
+        ('users', 'ok', 2), ('repos', 'ok', 1), ('commits', 'ok', 7)}
+    assert calls[-1] == ('commits', {'users': [1, 2], 'repos': [3]})
+
+
+def test_run_org_skips_the_stages_requiring_a_failed_one(stub_stages):
+    def fail(db_session, gh_session, org, inputs):
+        raise RuntimeError('boom')
+
+    stages = (
+        Stage('repos', fail, ()),
+        Stage('commits', lambda *args: 0, ('repos',)),
+    )
+    results = run_org(uuid.uuid4(), 'some-org', stages=stages)
+
+    assert {(result.stage, result.status) for result in results} == {('repos', 'failed'), ('commits', 'skipped')}
@@ -0,0 +1,66 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.stub import StubServer
+from ghstats import utils
+from ghstats.ratelimit import CORE, GRAPHQL, RateLimitManager
+from ghstats.session import get_gh_session
+from ghstats.utils import _get_page
+
+
+def _response(status_code=200, **headers):
+    return SimpleNamespace(status_code=status_code, headers={
+        'x-ratelimit-{}'.format(key): str(value) for key, value in headers.items()})
+
+
+def test_update_tracks_each_resource_separately():
+    manager = RateLimitManager([('someone', 'secret')], buffer=0)
+    credential = manager.credentials[0]
+    reset_at = time.time() + 600
+
+    manager.update(credential, _response(remaining=4000, reset=reset_at))
+    manager.update(credential, _response(remaining=100, reset=reset_at, resource=GRAPHQL))
+    manager.acquire(GRAPHQL)
+
+    assert manager.budget() == [dict(login='someone', remaining=4000, reset_at=reset_at)]
+    assert manager.budget(GRAPHQL) == [dict(login='someone', remaining=99, reset_at=reset_at)]
+
+
+def test_acquire_picks_the_credential_with_the_most_headroom_for_the_resource():
+    manager = RateLimitManager([('one', 'secret'), ('two', 'secret')], buffer=0)
+    one, two = manager.credentials
+    reset_at = time.time() + 600
+    manager.update(one, _response(remaining=10, reset=reset_at))
+    manager.update(two, _response(remaining=5, reset=reset_at))
+    manager.update(one, _response(remaining=0, reset=reset_at, resource=GRAPHQL))
+
+    assert manager.acquire(CORE) is one
+    assert manager.acquire(GRAPHQL) is two
+    assert manager.headroom(CORE) == 14
+
+
+def test_graphql_queries_are_not_charged_to_the_rest_budget(credentials):
+    reset_at = int(time.time()) + 600
+    graphql_headers = {'X-RateLimit-Remaining': '4999', 'X-RateLimit-Reset': str(reset_at),
+                       'X-RateLimit-Resource': GRAPHQL}
+    manager = RateLimitManager([('someone', 'secret')], buffer=0)
+    manager.update(manager.credentials[0], _response(remaining=10, reset=reset_at))
+    gh_session = get_gh_session(cache_path=None, rate_limits=manager, archive_dir=None)
+
+    with StubServer(post_handlers={'/graphql': lambda request: (200, graphql_headers, {'data': {}})}) as base_url:
+        gh_session.post(base_url + '/graphql', json={'query': '{}'})
+
+    assert manager.budget(CORE)[0]['remaining'] == 10
+    assert manager.budget(GRAPHQL)[0]['remaining'] == 4999
+
+
+@pytest.mark.parametrize('headers', [{}, dict(remaining=10, reset=time.time() + 60)])
+def test_get_page_retries_a_202(monkeypatch, headers):
+    responses = [_response(202, **headers), _response(200, **headers)]
+    session = SimpleNamespace(get=lambda url: responses.pop(0))
+    monkeypatch.setattr(utils.time, 'sleep', lambda seconds: None)
+
+    assert _get_page(session, 'https://api.github.com/repos/org/repo/stats/contributors').status_code == 200
+    assert not responses
@@ -0,0 +1,33 @@
+import hashlib
+
+from ghstats.shaindex import ShaIndex
+
+
+def _sha(i):
+    return hashlib.sha1(str(i).encode()).digest()
+
+
+def test_added_shas_are_merged_into_the_digests():
+    index = ShaIndex((_sha(i) for i in range(100)), merge_size=10)
+
+    for i in range(100, 200):
+        index.add(_sha(i))
+        index.add(_sha(i))
+
+    assert len(index) == 200
+    assert len(index._added) < 50
+    assert all(_sha(i) in index for i in range(200))
+    assert _sha(200) not in index
+    blob = index._digests.blob
+    digests = [blob[i:i + 20] for i in range(0, len(blob), 20)]
+    assert digests == sorted(digests)
+
+
+def test_merge_folds_every_added_sha():
+    index = ShaIndex([_sha(1)])
+    index.add(_sha(2))
+
+    index.merge()
+
+    assert (len(index), len(index._added)) == (2, 0)
+    assert _sha(1) in index and _sha(2) in index